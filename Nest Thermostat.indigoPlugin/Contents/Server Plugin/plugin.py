@@ -7,9 +7,20 @@
 import os
 import sys
 import random
-import urllib2
 import urllib
+import urlparse
+import httplib
+import socket
 import time
+import threading
+import collections
+import heapq
+import bisect
+import contextlib
+import Queue
+import email.utils
+import array
+import base64
 # Need json support; Use "simplejson" for Indigo support
 try:
 	import simplejson as json
@@ -19,21 +30,169 @@ except:
 # Time limit for the cache to exist between requiring an update
 NEST_CACHE_REFRESH_TIMEOUT=5
 
-# Time limit between auth token refreshes
+# Lifetime assumed for a login token when the Nest website doesn't say when it expires (in seconds)
 NEST_AUTH_REFRESH_TIMEOUT=3600
 
+# Time before a login token expires that a new one is fetched in the background (in seconds).
+# Tokens that live less than twice this long are replaced halfway through their lifetime.
+NEST_AUTH_REFRESH_AHEAD=600
+
+# Time to wait before trying a background login again after one failed (in seconds)
+NEST_AUTH_RETRY_WAIT=60
+
 # Maximum number of retries before deciding that sending a command failed
 NEST_MAX_RETRIES=5
 
-# Time to wait between retries (in seconds)
+# Time to wait before the first retry (in seconds). Later retries wait twice as long as the one
+# before, give or take a random half to keep retries from many devices from lining up.
 NEST_RETRY_WAIT=0.1
 
+# Longest time that sending and verifying a command may take, retries included (in seconds)
+NEST_VERIFY_DEADLINE=30
+
+# Time limits for opening a connection to the Nest website and for waiting on its responses (in seconds)
+NEST_CONNECT_TIMEOUT=10
+NEST_READ_TIMEOUT=30
+
+# Consecutive failed requests to a Nest.com account (network errors, timeouts and 5xx answers)
+# after which its circuit breaker opens and requests fail at once instead of being sent
+NEST_BREAKER_FAILURES=3
+
+# Time an open circuit breaker waits before letting a single probe request through (in seconds).
+# Each failed probe doubles the wait, up to NEST_BREAKER_WAIT_MAX.
+NEST_BREAKER_WAIT=30
+NEST_BREAKER_WAIT_MAX=600
+
+# Time a probe may take before another thread may send one instead (in seconds), in case the
+# probing thread never reports back
+NEST_BREAKER_PROBE_TIMEOUT=NEST_CONNECT_TIMEOUT+NEST_READ_TIMEOUT+5
+
+# Circuit breaker states
+NEST_BREAKER_CLOSED="closed"
+NEST_BREAKER_OPEN="open"
+NEST_BREAKER_HALF_OPEN="half open"
+
+# Requests each Nest.com account may send per minute, and how many may be sent at once after a
+# quiet spell. Background polls leave the last NEST_RATE_RESERVE of them for actions.
+NEST_RATE_LIMIT=60
+NEST_RATE_BURST=20
+NEST_RATE_RESERVE=5
+
+# Longest time an action's request waits for the account's request budget (in seconds)
+NEST_RATE_WAIT_MAX=10
+
+# Most that poll intervals are stretched by as an account's request budget runs out
+NEST_RATE_SLOWDOWN_MAX=4
+
+# Request priorities: actions (changes, reading them back and logins) go ahead of background polls
+NEST_PRIORITY_ACTION=0
+NEST_PRIORITY_POLL=1
+
+# Maximum number of idle keep-alive connections kept open to each Nest host
+NEST_POOL_MAX_IDLE=4
+
+# Time that changes to the same Nest bucket are collected for before they are sent together (in seconds)
+NEST_WRITE_COALESCE_WINDOW=0.2
+
+# Time between polls of a thermostat that is busy: heating, cooling, running the fan or
+# waiting for a new target temperature to take effect (in seconds)
+NEST_POLL_INTERVAL=3
+
+# Time between polls of an idle thermostat (in seconds)
+NEST_POLL_INTERVAL_IDLE=30
+
+# Time between polls of an idle thermostat whose location is set to away (in seconds)
+NEST_POLL_INTERVAL_AWAY=120
+
+# Longest time between polls of a thermostat whose polls keep failing (in seconds)
+NEST_POLL_BACKOFF_MAX=600
+
+# Number of accounts that can be polled at the same time
+NEST_POLL_WORKERS=4
+
+# Time a poll of an account may take before its thermostats are treated as failed (in seconds)
+NEST_POLL_DEADLINE=20
+
+# Number of actions that can be sent to the Nest website at the same time
+NEST_COMMAND_WORKERS=2
+
+# Time an action has for the Nest to report the change before it is treated as failed (in seconds)
+NEST_COMMAND_TIMEOUT=30
+
+# Longest time the Nest website may hold a subscription open before answering (in seconds)
+NEST_SUBSCRIBE_TIMEOUT=90
+
+# Time to wait before subscribing again after a subscription failed (in seconds)
+NEST_SUBSCRIBE_RETRY_WAIT=30
+
+# Shortest time between two subscriptions, so a server that answers at once can't cause a busy loop
+NEST_SUBSCRIBE_MIN_INTERVAL=1
+
+# Time between safety polls while subscribed to changes (in seconds)
+NEST_SUBSCRIBE_POLL_INTERVAL=300
+
+# Upper bounds of the buckets that NestMetrics sorts timings into (in seconds)
+NEST_METRICS_BUCKETS=(0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,25,60,150,300,600)
+
+# Time between writes to the metrics file, when one is set (in seconds)
+NEST_METRICS_FILE_INTERVAL=60
+
+# Size at which the metrics file is moved aside (to the same name ending in .1) and started again
+NEST_METRICS_FILE_MAX_BYTES=1024*1024
+
+# Format of traffic recordings made by NestRecordingTransport
+NEST_RECORDING_VERSION=1
+
+# Request and response headers kept in traffic recordings; the others (e.g. the login token) are left out
+NEST_RECORDED_HEADERS=("if-none-match","etag","content-type","x-nl-user-id",
+					"x-nl-skv-key","x-nl-skv-version","x-nl-skv-timestamp")
+
+# Format of the session cache file; files in any other format are ignored
+NEST_DISK_CACHE_VERSION=1
+
+# HTTP statuses with which the Nest website turns down a login's username or password
+NEST_LOGIN_REJECTED=(400,401,403)
+
+# Oldest status document from the session cache file that devices may start with (in seconds)
+NEST_DISK_CACHE_MAX_AGE=86400
+
+# Time between writes of the session cache file (in seconds)
+NEST_DISK_CACHE_SAVE_INTERVAL=300
+
 # Simple constant mapping for fan, heat/cool type, etc.
 NEST_FAN_MAP={'auto on':"auto",'on': "on", 'auto': "auto", 'always on': "on", '1': "on", '0': "auto"}
 NEST_AWAY_MAP={'on':True,'away':True,'off':False,'home':False,True:True, False:False}
 NEST_HEAT_COOL_MAP={'cool':'cool','cooling':'cool','heat':'heat','heating':
 					'heat','range':'range','both':'range','auto':"range",'off':'off'}
 
+# Thermostat history: raw samples are kept for NEST_HISTORY_RAW_RETENTION seconds and rolled up
+# into (interval, retention) totals, in seconds. Each interval must be a multiple of the first.
+NEST_HISTORY_RAW_RETENTION=6*3600
+NEST_HISTORY_ROLLUPS=((300,7*86400),(3600,366*86400))
+
+# Longest time between two samples that counts as the thermostat staying as the first sample
+# showed (in seconds); longer gaps (the plugin or Nest.com was down) are left out of the totals
+NEST_HISTORY_MAX_GAP=900
+
+# Time between saves of the history file (in seconds), and the version of its format. Each save
+# appends the new samples to a journal next to it; the whole file is only rewritten (and the
+# journal emptied) every NEST_HISTORY_COMPACT_INTERVAL seconds and when the plugin stops.
+NEST_HISTORY_SAVE_INTERVAL=600
+NEST_HISTORY_COMPACT_INTERVAL=86400
+NEST_HISTORY_VERSION=1
+
+# Longest time the plugin waits for the history file to be written when it stops (in seconds)
+NEST_HISTORY_SHUTDOWN_TIMEOUT=30
+
+# Heat and AC starts are counted over this long (in seconds) for the cycles per hour states
+NEST_RUNTIME_CYCLE_WINDOW=3600
+
+# What the thermostat is doing, for the hvacState device state
+NEST_HVAC_IDLE="idle"
+NEST_HVAC_HEATING="heating"
+NEST_HVAC_COOLING="cooling"
+NEST_HVAC_FAN="fan"
+
 # Nest URL Constants. These shouldn't be changed.
 NEST_URLS="urls"
 NEST_TRANSPORT_URL="transport_url"
@@ -42,15 +201,25 @@ NEST_STATUS_URL_FRAGMENT="/v2/mobile/user."
 NEST_SHARED_URL_FRAGMENT="/v2/put/shared."
 NEST_DEVICE_URL_FRAGMENT="/v2/put/device."
 NEST_STRUCTURE_URL_FRAGMENT="/v2/put/structure."
+NEST_SUBSCRIBE_URL_FRAGMENT="/v2/subscribe"
 
 # Nest Data Constants. These shouldn't be changed.
 NEST_USER_ID="userid"
 NEST_ACCESS_TOKEN="access_token"
+NEST_EXPIRES_IN="expires_in"
 NEST_DEVICE_DATA="device"
 NEST_SHARED_DATA="shared"
 NEST_STRUCTURE_DATA="structure"
 NEST_STRUCTURE_NAME="name"
 NEST_DEVICE_NAME="name"
+NEST_BUCKET_VERSION="$version"
+NEST_BUCKET_TIMESTAMP="$timestamp"
+NEST_BUCKET_TYPES=(NEST_DEVICE_DATA,NEST_SHARED_DATA,NEST_STRUCTURE_DATA)
+
+# Response headers identifying the bucket a subscription returns
+NEST_SKV_KEY_HEADER="x-nl-skv-key"
+NEST_SKV_VERSION_HEADER="x-nl-skv-version"
+NEST_SKV_TIMESTAMP_HEADER="x-nl-skv-timestamp"
 
 # Nest Status Constants. These shouldn't be changed, but if the module is expanded,
 # new constants can be placed here.
@@ -68,9 +237,2461 @@ NEST_FAN_ON="hvac_fan_state"
 NEST_TEMP_SCALE="temperature_scale"
 NEST_AWAY="away"
 
+# Nest attributes holding temperatures, which the Nest website always reports in C
+NEST_TEMPERATURE_ATTRIBUTES=(NEST_CURRENT_TEMP,NEST_TARGET_TEMP,NEST_RANGE_TEMP_LOW,NEST_RANGE_TEMP_HIGH)
+
+# Largest difference (in degrees of the Nest's scale) for which two temperatures are the same setting
+NEST_TEMP_TOLERANCE=0.25
+
+# Step that temperatures shown in Indigo are rounded to unless set in the plugin's preferences (in degrees)
+NEST_DISPLAY_ROUNDING=1.0
+
+# Everything Indigo needs from a thermostat, read in a single pass by NestThermostat.snapshot().
+# Temperatures are in the Nest's scale at full precision.
+NestSnapshot=collections.namedtuple("NestSnapshot",["temp","humidity","fan_mode","heat_cool_mode",
+										"target_temp","target_change_pending","range_low","range_high",
+										"heat_on","ac_on","fan_on","away","temp_scale","timestamp"])
+
+# What a Nest.com login returns, with the headers to send on each request and when the token expires
+NestCredentials=collections.namedtuple("NestCredentials",["access_token","transport_url","user_id",
+										"header","expires_at"])
+
+# A complete HTTP response read by NestConnectionPool
+NestResponse=collections.namedtuple("NestResponse",["status","headers","body"])
+
+class NestHTTPError(Exception):
+	"""Raised when the Nest website answers a request with an error status."""
+	def __init__(self, status, reason, body=""):
+		Exception.__init__(self,"HTTP %d %s" % (status,reason))
+		self.status=status
+		self.reason=reason
+		self.body=body
+
+class NestPasswordError(Exception):
+	"""Raised when the Nest website turns down a password other than the one an account's session already uses."""
+	def __init__(self, username, error):
+		Exception.__init__(self,u"Nest.com didn't accept this password for %s (%s); the thermostats already using the account keep theirs" %
+							(username,error))
+		self.error=error
+
+class NestUnavailableError(Exception):
+	"""Raised instead of sending a request while an account's circuit breaker is open."""
+	def __init__(self, retry_in):
+		Exception.__init__(self,"Nest.com isn't answering; trying again in %d seconds" % max(retry_in+0.5,1))
+		self.retry_in=retry_in
+
+class NestRateLimitedError(Exception):
+	"""Raised instead of sending a request when an account's request budget is used up."""
+	def __init__(self, retry_in):
+		Exception.__init__(self,"too many requests to Nest.com; trying again in %d seconds" % max(retry_in+0.5,1))
+		self.retry_in=retry_in
+
+class NestCircuitBreaker:
+
+	def __init__(self, failures=NEST_BREAKER_FAILURES, wait=NEST_BREAKER_WAIT, max_wait=NEST_BREAKER_WAIT_MAX,
+				 probe_timeout=NEST_BREAKER_PROBE_TIMEOUT):
+		"""Initialize the circuit breaker of a Nest.com account
+		
+				While closed, requests are sent as usual. After failures consecutive failures it
+				opens, and requests fail at once with NestUnavailableError. Once wait seconds have
+				passed it is half open: the next thread to make a request sends it as a probe (and
+				may make further requests) while every other thread still gets NestUnavailableError.
+				A successful probe closes the breaker; a failed one opens it again for twice as long,
+				up to max_wait seconds. A probe that is given up without an answer (see release())
+				lets the next request probe at once, and a probe that hasn't reported back after
+				probe_timeout seconds can be taken over by another thread.
+		
+				Arguments:
+					failures - Consecutive failures that open the breaker
+					wait - Time (in seconds) the breaker stays open after it first opens
+					max_wait - Longest time (in seconds) the breaker stays open
+					probe_timeout - Time (in seconds) a probe may take before another thread may probe
+		"""
+		self._failures_allowed=failures
+		self._initial_wait=wait
+		self._max_wait=max_wait
+		self._lock=threading.Lock()
+		self._state=NEST_BREAKER_CLOSED
+		self._failures=0
+		self._wait=wait
+		self._probe_at=0
+		self._prober=None
+		self._probe_timeout=probe_timeout
+		self._opened_at=None
+
+	@staticmethod
+	def is_outage(error):
+		"""Returns True if an exception means the Nest website is unreachable or failing."""
+		if (isinstance(error,NestHTTPError)):
+			return error.status>=500
+		return isinstance(error,(socket.error,httplib.HTTPException))
+
+	def before_request(self):
+		"""Raises NestUnavailableError unless a request may be sent now."""
+		with self._lock:
+			if (self._state==NEST_BREAKER_CLOSED):
+				return
+			if (self._state==NEST_BREAKER_HALF_OPEN and self._prober is threading.current_thread()):
+				return
+			now=time.time()
+			if (self._state==NEST_BREAKER_HALF_OPEN and now>=self._probe_at+self._probe_timeout):
+				NEST_METRICS.count("breaker_probe_timeouts")
+				self._state=NEST_BREAKER_OPEN
+			if (self._state==NEST_BREAKER_OPEN and now>=self._probe_at):
+				self._state=NEST_BREAKER_HALF_OPEN
+				self._prober=threading.current_thread()
+				self._probe_at=now
+				NEST_METRICS.count("breaker_probes")
+				return
+			NEST_METRICS.count("breaker_rejected")
+			if (self._state==NEST_BREAKER_HALF_OPEN):
+				# Another thread is probing; its answer decides, or it times out
+				raise NestUnavailableError(self._probe_at+self._probe_timeout-now)
+			raise NestUnavailableError(self._probe_at-now)
+
+	def release(self):
+		"""Gives up this thread's probe without an answer (the request was never sent), so the next request probes."""
+		with self._lock:
+			if (self._state==NEST_BREAKER_HALF_OPEN and self._prober is threading.current_thread()):
+				self._state=NEST_BREAKER_OPEN
+				self._prober=None
+				self._probe_at=time.time()
+
+	def succeeded(self):
+		"""Records a request that got an answer, closing the breaker."""
+		with self._lock:
+			self._state=NEST_BREAKER_CLOSED
+			self._failures=0
+			self._wait=self._initial_wait
+			self._prober=None
+			self._opened_at=None
+
+	def failed(self):
+		"""Records a request that failed because of an outage (see is_outage())."""
+		with self._lock:
+			self._failures+=1
+			if (self._state==NEST_BREAKER_HALF_OPEN):
+				self._wait=min(self._wait*2,self._max_wait)
+			elif (self._state==NEST_BREAKER_OPEN or self._failures<self._failures_allowed):
+				return
+			else:
+				NEST_METRICS.count("breaker_opened")
+				self._opened_at=time.time()
+			self._state=NEST_BREAKER_OPEN
+			self._prober=None
+			self._probe_at=time.time()+self._wait
+
+	def get_state(self):
+		"""Returns NEST_BREAKER_CLOSED, NEST_BREAKER_OPEN or NEST_BREAKER_HALF_OPEN."""
+		return self._state
+
+	def seconds_until_probe(self,now=None):
+		"""Returns the time until the breaker lets a probe through (0 unless it is open)."""
+		with self._lock:
+			if (self._state!=NEST_BREAKER_OPEN):
+				return 0
+			return max(self._probe_at-(now or time.time()),0)
+
+	def get_opened_at(self):
+		"""Returns when the breaker opened, or None while it is closed."""
+		return self._opened_at
+
+class NestRateLimiter:
+
+	def __init__(self, rate=NEST_RATE_LIMIT, burst=NEST_RATE_BURST, reserve=NEST_RATE_RESERVE, max_wait=NEST_RATE_WAIT_MAX):
+		"""Initialize the request budget of a Nest.com account
+		
+				A token bucket shared by every request to the account: it holds up to burst tokens,
+				gains rate tokens a minute and each request takes one. Actions (NEST_PRIORITY_ACTION)
+				wait up to max_wait seconds for a token. Background polls (NEST_PRIORITY_POLL) never
+				wait: they fail at once with NestRateLimitedError while an action is waiting or while
+				taking a token would leave fewer than reserve, so actions get through even when polls
+				have used up the rest.
+		
+				Arguments:
+					rate - Tokens gained per minute
+					burst - Most tokens held
+					reserve - Tokens only actions may use
+					max_wait - Longest time (in seconds) an action waits for a token
+		"""
+		self._per_minute=rate
+		self._rate=rate/60.0
+		self._burst=burst
+		self._reserve=reserve
+		self._max_wait=max_wait
+		self._lock=threading.Lock()
+		self._refilled=threading.Condition(self._lock)
+		self._tokens=float(burst)
+		self._updated=time.time()
+		self._actions_waiting=0
+		# When each of the requests of the last minute was sent
+		self._recent=collections.deque()
+
+	def _refill(self,now):
+		self._tokens=min(self._tokens+(now-self._updated)*self._rate,self._burst)
+		self._updated=now
+
+	def _take(self,now):
+		self._tokens-=1
+		self._recent.append(now)
+		while (self._recent[0]<now-60):
+			self._recent.popleft()
+
+	def acquire(self,priority):
+		"""Takes a token for a request, raising NestRateLimitedError if there isn't one to be had."""
+		start=time.time()
+		with self._lock:
+			self._refill(start)
+			if (priority!=NEST_PRIORITY_ACTION):
+				if (self._actions_waiting or self._tokens<self._reserve+1):
+					NEST_METRICS.count("rate_limited_polls")
+					raise NestRateLimitedError(max(self._reserve+1-self._tokens,1)/self._rate)
+				self._take(start)
+				return
+			self._actions_waiting+=1
+			try:
+				now=start
+				while (self._tokens<1):
+					wait=(1-self._tokens)/self._rate
+					if (now+wait>start+self._max_wait):
+						NEST_METRICS.count("rate_limited_actions")
+						raise NestRateLimitedError(wait)
+					self._refilled.wait(wait)
+					now=time.time()
+					self._refill(now)
+				self._take(now)
+			finally:
+				self._actions_waiting-=1
+		if (now>start):
+			NEST_METRICS.observe("rate_limit_wait",now-start)
+
+	def poll_interval_factor(self):
+		"""Returns how much to stretch poll intervals by: 1 while at least half the budget is left,
+		rising to NEST_RATE_SLOWDOWN_MAX as it runs out."""
+		with self._lock:
+			self._refill(time.time())
+			left=self._tokens/self._burst
+		if (left>=0.5):
+			return 1.0
+		return 1.0+(NEST_RATE_SLOWDOWN_MAX-1.0)*min((0.5-left)*2,1.0)
+
+	def get_stats(self):
+		"""Returns the requests sent in the last minute, the limit per minute and the tokens left."""
+		with self._lock:
+			now=time.time()
+			self._refill(now)
+			while (self._recent and self._recent[0]<now-60):
+				self._recent.popleft()
+			return {"used":len(self._recent),"limit":self._per_minute,"available":int(self._tokens)}
+
+class NestTemperatureConverter:
+
+	def __init__(self, scale):
+		"""Initialize a converter between the Nest website's C and a Nest's temperature scale
+		
+				Conversions keep full precision; rounding for display is left to the caller. Use
+				NestTemperatureConverter.for_scale() to share the converter for each scale.
+		
+				Arguments:
+					scale - 'F' or 'C', as the Nest reports in its temperature_scale attribute
+		"""
+		self.scale=scale
+		self._fahrenheit=(scale=="F")
+
+	@classmethod
+	def for_scale(cls,scale):
+		"""Returns the shared converter for a temperature scale ('F' or 'C')."""
+		converter=NEST_TEMP_CONVERTERS.get(scale)
+		if (converter is None):
+			converter=NEST_TEMP_CONVERTERS.setdefault(scale,cls(scale))
+		return converter
+
+	def from_nest(self,temp):
+		"""Converts a temperature reported by the Nest website (C) to the Nest's scale."""
+		if (self._fahrenheit):
+			return temp*1.8+32
+		return float(temp)
+
+	def to_nest(self,temp):
+		"""Converts a temperature in the Nest's scale to C, for sending to the Nest website."""
+		if (self._fahrenheit):
+			return (temp-32)/1.8
+		return float(temp)
+
+	def convert_record(self,attributes,keys=NEST_TEMPERATURE_ATTRIBUTES):
+		"""Returns a dictionary of the given temperature attributes converted to the Nest's scale."""
+		if (self._fahrenheit):
+			return dict((key,attributes[key]*1.8+32) for key in keys)
+		return dict((key,float(attributes[key])) for key in keys)
+
+	def matches(self,first,second,tolerance=NEST_TEMP_TOLERANCE):
+		"""Returns True if two temperatures in the Nest's scale are the same setting."""
+		return abs(first-second)<=tolerance
+
+# Converters shared by every thermostat, keyed by temperature scale
+NEST_TEMP_CONVERTERS=dict()
+
+class NestHistogram:
+	"""Counts timings by bucket, so percentiles can be estimated without keeping every timing."""
+	def __init__(self):
+		self.count=0
+		self.total=0.0
+		self.min=None
+		self.max=None
+		self.buckets=[0]*(len(NEST_METRICS_BUCKETS)+1)
+
+	def observe(self,seconds):
+		self.count+=1
+		self.total+=seconds
+		if (self.min is None or seconds<self.min):
+			self.min=seconds
+		if (self.max is None or seconds>self.max):
+			self.max=seconds
+		self.buckets[bisect.bisect_left(NEST_METRICS_BUCKETS,seconds)]+=1
+
+	def percentile(self,fraction):
+		"""Returns the upper bound of the bucket holding the given fraction (0-1) of the timings."""
+		if (not self.count):
+			return None
+		needed=fraction*self.count
+		seen=0
+		for (index,count) in enumerate(self.buckets):
+			seen+=count
+			if (seen>=needed and index<len(NEST_METRICS_BUCKETS)):
+				return min(NEST_METRICS_BUCKETS[index],self.max)
+		return self.max
+
+	def summary(self):
+		return {"count":self.count,"mean":self.total/self.count if self.count else None,
+				"min":self.min,"max":self.max,"p50":self.percentile(0.5),
+				"p90":self.percentile(0.9),"p99":self.percentile(0.99)}
+
+class NestMetrics:
+
+	def __init__(self):
+		"""Initialize a thread safe collection of timings and counters.
+		
+				Timings are kept in NestHistogram buckets by name (and optionally a label, such as
+				a device name), so recording one costs the same however long the plugin runs.
+		"""
+		self._lock=threading.Lock()
+		self._started=time.time()
+		self._histograms=dict()
+		self._counters=collections.defaultdict(int)
+
+	def observe(self,name,seconds,label=None):
+		"""Records a timing (in seconds), e.g. how long a request took."""
+		with self._lock:
+			histogram=self._histograms.get((name,label))
+			if (histogram is None):
+				histogram=self._histograms[(name,label)]=NestHistogram()
+			histogram.observe(seconds)
+
+	def count(self,name,amount=1):
+		"""Adds to a counter, e.g. the number of retries."""
+		with self._lock:
+			self._counters[name]+=amount
+
+	@contextlib.contextmanager
+	def timer(self,name,label=None):
+		"""Times the body of a with statement, whether or not it raises an exception."""
+		start=time.time()
+		try:
+			yield
+		finally:
+			self.observe(name,time.time()-start,label)
+
+	def get_stats(self):
+		"""Returns the counters and a summary of each timing (count, mean, min, max and percentiles).
+		
+				Timings recorded with a label are listed as 'name[label]'.
+		"""
+		with self._lock:
+			timings=dict()
+			for ((name,label),histogram) in self._histograms.items():
+				timings[name if label is None else "%s[%s]" % (name,label)]=histogram.summary()
+			return {"since":self._started,"counters":dict(self._counters),"timings":timings}
+
+	def reset(self):
+		"""Forgets every timing and counter."""
+		with self._lock:
+			self._started=time.time()
+			self._histograms=dict()
+			self._counters=collections.defaultdict(int)
+
+# Timings and counters for every session, thermostat and device in the plugin
+NEST_METRICS=NestMetrics()
+
+class NestConnectionPool:
+
+	def __init__(self, connect_timeout=NEST_CONNECT_TIMEOUT, read_timeout=NEST_READ_TIMEOUT,
+				max_idle=NEST_POOL_MAX_IDLE, context=None):
+		"""Initialize a pool of keep-alive HTTP(S) connections, kept separately for each host
+		
+				Connections are handed to one request at a time and put back once the response
+				has been read, so the TCP connection and TLS handshake are paid for once per
+				connection instead of once per request.
+		
+				Arguments:
+					connect_timeout - Time limit (in seconds) for opening a connection
+					read_timeout - Time limit (in seconds) for each wait on a response
+					max_idle - Maximum number of idle connections kept open per host
+					context - An ssl.SSLContext for HTTPS connections (Python 2.7.9 and later),
+							e.g. to trust a local test server
+		"""
+		self._lock=threading.Lock()
+		self._idle=dict()
+		self._connect_timeout=connect_timeout
+		self._read_timeout=read_timeout
+		self._max_idle=max_idle
+		self._context=context
+		self._stats={"requests":0,"reused":0,"handshakes":0,"retries":0,"errors":0}
+
+	def set_timeouts(self,connect_timeout,read_timeout):
+		"""Changes the time limits used by connections opened from now on."""
+		self._connect_timeout=connect_timeout
+		self._read_timeout=read_timeout
+
+	def get_stats(self):
+		"""Returns a copy of the request counters.
+		
+				'requests' counts requests made, 'reused' those sent on an existing connection and
+				'handshakes' the connections opened (each one a TCP connection and, for HTTPS, a
+				TLS handshake). 'retries' counts requests resent because an idle connection had
+				been closed by the server, and 'errors' requests that failed.
+		"""
+		with self._lock:
+			return dict(self._stats)
+
+	def _count(self,key):
+		with self._lock:
+			self._stats[key]+=1
+
+	def _checkout(self,scheme,host,port):
+		with self._lock:
+			idle=self._idle.get((scheme,host,port))
+			if (idle):
+				self._stats["reused"]+=1
+				return (idle.pop(),True)
+			self._stats["handshakes"]+=1
+		if (scheme=="https"):
+			if (self._context is not None):
+				connection=httplib.HTTPSConnection(host,port,timeout=self._connect_timeout,context=self._context)
+			else:
+				connection=httplib.HTTPSConnection(host,port,timeout=self._connect_timeout)
+		else:
+			connection=httplib.HTTPConnection(host,port,timeout=self._connect_timeout)
+		connection.connect()
+		# Requests are small and answered one at a time, so don't let Nagle's algorithm delay them
+		connection.sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+		connection.sock.settimeout(self._read_timeout)
+		return (connection,False)
+
+	def _checkin(self,scheme,host,port,connection):
+		with self._lock:
+			idle=self._idle.setdefault((scheme,host,port),[])
+			if (len(idle)<self._max_idle):
+				idle.append(connection)
+				return
+		connection.close()
+
+	def request(self,method,url,body=None,headers=None,timeout=None):
+		"""Sends a request and returns the NestResponse.
+		
+				Raises NestHTTPError if the server answers with an error status, socket.timeout if
+				it doesn't answer in time, or another socket/httplib exception if the request fails.
+		
+				Arguments:
+					method - 'GET' or 'POST'
+					url - The full URL to request
+					body - The request body (string), if any
+					headers - A dictionary of extra request headers
+					timeout - Time limit (in seconds) for the response, instead of the pool's read timeout
+		"""
+		parts=urlparse.urlsplit(url)
+		scheme=parts.scheme.lower()
+		port=parts.port or (443 if scheme=="https" else 80)
+		path=parts.path or "/"
+		if (parts.query):
+			path=path+"?"+parts.query
+		self._count("requests")
+		retried=False
+		while True:
+			(connection,reused)=self._checkout(scheme,parts.hostname,port)
+			try:
+				if (timeout is not None):
+					connection.sock.settimeout(timeout)
+				connection.request(method,path,body,headers or {})
+				response=connection.getresponse()
+				data=response.read()
+			except socket.timeout:
+				connection.close()
+				self._count("errors")
+				raise
+			except (httplib.HTTPException,socket.error):
+				connection.close()
+				# The server may have closed an idle connection; try once more on a fresh one
+				if (reused and not retried):
+					retried=True
+					self._count("retries")
+					continue
+				self._count("errors")
+				raise
+			if (response.will_close):
+				connection.close()
+			else:
+				connection.sock.settimeout(self._read_timeout)
+				self._checkin(scheme,parts.hostname,port,connection)
+			if (response.status>=400):
+				self._count("errors")
+				raise NestHTTPError(response.status,response.reason,data)
+			return NestResponse(response.status,dict(response.getheaders()),data)
+
+	def close(self):
+		"""Closes every idle connection."""
+		with self._lock:
+			idle=self._idle
+			self._idle=dict()
+		for connections in idle.values():
+			for connection in connections:
+				connection.close()
+
+# Connections shared by every session, so all accounts reuse the same connections to the Nest hosts
+NEST_CONNECTION_POOL=NestConnectionPool()
+
+# What sessions send their requests through (see set_nest_transport())
+NEST_TRANSPORT=NEST_CONNECTION_POOL
+
+def nest_request_kind(url):
+	"""Returns 'login', 'status', 'put' or 'subscribe' for a Nest URL, or its path for anything else."""
+	path=urlparse.urlsplit(url).path
+	if (NEST_STATUS_URL_FRAGMENT in path):
+		return "status"
+	if ("/v2/put/" in path):
+		return "put"
+	if (path.endswith(NEST_SUBSCRIBE_URL_FRAGMENT)):
+		return "subscribe"
+	if (path==urlparse.urlsplit(NEST_LOGIN_URL).path):
+		return "login"
+	return path
+
+class NestRecordingTransport:
+
+	def __init__(self, path, transport=None):
+		"""Initialize a transport that sends requests on through another one and records them
+		
+				Each request is appended to the file at path as a JSON line holding when it was
+				sent, how long it took and the response or error, so the traffic can be played
+				back by a NestReplayTransport. Every recording starts with a "start" event, so a
+				file the plugin has recorded to across restarts holds one run after another. Passwords, tokens and any headers not in
+				NEST_RECORDED_HEADERS are left out. Other events (e.g. the actions that caused
+				the requests) can be added with note().
+		
+				Arguments:
+					path - The file to append to
+					transport - What to send requests through (NEST_CONNECTION_POOL by default)
+		"""
+		self._transport=transport or NEST_CONNECTION_POOL
+		self._lock=threading.Lock()
+		self._file=open(path,"a")
+		self.note("start",{"version":NEST_RECORDING_VERSION})
+
+	@staticmethod
+	def _kept_headers(headers):
+		return dict((key.lower(),value) for (key,value) in (headers or {}).items() if key.lower() in NEST_RECORDED_HEADERS)
+
+	@staticmethod
+	def _redact_request(body):
+		# Logins are form encoded and carry the password
+		if (body and "password=" in body):
+			return urllib.urlencode([(key,"" if key=="password" else value) for (key,value) in urlparse.parse_qsl(body)])
+		return body
+
+	@staticmethod
+	def _redact_response(body):
+		if (body and NEST_ACCESS_TOKEN in body):
+			try:
+				data=json.loads(body)
+			except ValueError:
+				return body
+			if (isinstance(data,dict) and NEST_ACCESS_TOKEN in data):
+				data[NEST_ACCESS_TOKEN]="recorded"
+				return json.dumps(data)
+		return body
+
+	def _write(self,entry):
+		line=json.dumps(entry)+"\n"
+		with self._lock:
+			if (self._file is not None):
+				self._file.write(line)
+				self._file.flush()
+
+	def note(self,kind,values):
+		"""Adds an event (a dictionary of values that json can encode) of the given kind to the recording."""
+		entry=dict(values)
+		entry.update({"type":kind,"time":time.time()})
+		self._write(entry)
+
+	def request(self,method,url,body=None,headers=None,timeout=None):
+		"""Sends a request like NestConnectionPool.request() and records it."""
+		entry={"type":"request","time":time.time(),"method":method,"url":url,"body":self._redact_request(body),
+				"headers":self._kept_headers(headers),"timeout":timeout}
+		try:
+			response=self._transport.request(method,url,body,headers,timeout)
+		except NestHTTPError as e:
+			entry.update({"elapsed":time.time()-entry["time"],"status":e.status,"reason":e.reason,
+						"response_body":self._redact_response(e.body)})
+			self._write(entry)
+			raise
+		except socket.timeout:
+			entry.update({"elapsed":time.time()-entry["time"],"error":"timeout"})
+			self._write(entry)
+			raise
+		except (httplib.HTTPException,socket.error) as e:
+			entry.update({"elapsed":time.time()-entry["time"],"error":str(e) or e.__class__.__name__})
+			self._write(entry)
+			raise
+		entry.update({"elapsed":time.time()-entry["time"],"status":response.status,
+					"response_headers":self._kept_headers(response.headers),
+					"response_body":self._redact_response(response.body)})
+		self._write(entry)
+		return response
+
+	def set_timeouts(self,connect_timeout,read_timeout):
+		self._transport.set_timeouts(connect_timeout,read_timeout)
+
+	def get_stats(self):
+		return self._transport.get_stats()
+
+	def close(self):
+		"""Stops recording; the transport underneath stays open."""
+		with self._lock:
+			if (self._file is not None):
+				self._file.close()
+				self._file=None
+
+class NestReplayTransport:
+
+	def __init__(self, path, latency_scale=1.0):
+		"""Initialize a transport that answers requests from a recording made by NestRecordingTransport
+		
+				Requests are matched to recorded ones by method and URL path (the host may differ),
+				in the order they were recorded, and each is answered after the time it originally
+				took multiplied by latency_scale. Answers recorded before an earlier one that was
+				already due (by time.time(), so playback should run on the recording's clock) are
+				skipped, so a request sees what the Nest website reported at the time. Recorded
+				errors and timeouts are raised again. A request with no recorded answer left gets
+				the last answer to the same URL again (and is counted as missed), or fails with
+				socket.error if there never was one. If the file holds several runs (the plugin was
+				restarted while recording to it), only the last one, from its final "start" event
+				on, is played back, as the earlier runs' answers would be handed to requests they
+				were never meant for.
+		
+				Arguments:
+					path - The recording
+					latency_scale - What to multiply recorded response times by (0 answers at once)
+		"""
+		self._latency_scale=latency_scale
+		self._lock=threading.Lock()
+		self._answers=dict()
+		self._last_answers=dict()
+		self._events=[]
+		self._recorded=dict()
+		self._replayed=dict()
+		self._missed=0
+		self._skipped=0
+		self._span=(None,None)
+		self._runs=0
+		with open(path) as recording:
+			entries=[json.loads(line) for line in recording if line.strip()]
+		for (index,entry) in enumerate(entries):
+			if (entry.get("type")=="start"):
+				self._runs+=1
+				last=index
+		if (self._runs):
+			entries=entries[last:]
+		for entry in entries:
+			self._span=(min(self._span[0],entry["time"]) if self._span[0] is not None else entry["time"],
+						max(self._span[1],entry["time"]+entry.get("elapsed",0)))
+			if (entry.get("type")!="request"):
+				self._events.append(entry)
+				continue
+			self._answers.setdefault(self._key(entry["method"],entry["url"]),collections.deque()).append(entry)
+			kind=nest_request_kind(entry["url"])
+			self._recorded[kind]=self._recorded.get(kind,0)+1
+
+	@staticmethod
+	def _key(method,url):
+		parts=urlparse.urlsplit(url)
+		return (method,parts.path+("?"+parts.query if parts.query else ""))
+
+	def get_events(self):
+		"""Returns the recording's other events (see NestRecordingTransport.note()), oldest first."""
+		return list(self._events)
+
+	def get_time_span(self):
+		"""Returns when the recording's first entry was made and its last request finished."""
+		return self._span
+
+	def get_run_count(self):
+		"""Returns the number of runs in the file, of which only the last is played back."""
+		return self._runs
+
+	def request(self,method,url,body=None,headers=None,timeout=None):
+		"""Answers a request like NestConnectionPool.request(), from the recording."""
+		kind=nest_request_kind(url)
+		with self._lock:
+			self._replayed[kind]=self._replayed.get(kind,0)+1
+			key=self._key(method,url)
+			answers=self._answers.get(key)
+			if (answers):
+				now=time.time()
+				while (len(answers)>1 and answers[1]["time"]<=now):
+					answers.popleft()
+					self._skipped+=1
+				entry=self._last_answers[key]=answers.popleft()
+			else:
+				entry=self._last_answers.get(key)
+				self._missed+=1
+		if (entry is None):
+			raise socket.error("no recorded answer left for %s %s" % (method,url))
+		if (self._latency_scale>0):
+			time.sleep(entry.get("elapsed",0)*self._latency_scale)
+		if (entry.get("error")=="timeout"):
+			raise socket.timeout("timed out")
+		if (entry.get("error")):
+			raise socket.error(entry["error"])
+		if (entry["status"]>=400):
+			raise NestHTTPError(entry["status"],entry.get("reason",""),entry.get("response_body") or "")
+		return NestResponse(entry["status"],entry.get("response_headers") or {},
+							(entry.get("response_body") or "").encode("utf8"))
+
+	def get_request_counts(self):
+		"""Returns the number of requests of each kind (see nest_request_kind()) in the recording and replayed."""
+		with self._lock:
+			return dict((kind,{"recorded":self._recorded.get(kind,0),"replayed":self._replayed.get(kind,0)})
+						for kind in set(self._recorded)|set(self._replayed))
+
+	def set_timeouts(self,connect_timeout,read_timeout):
+		pass
+
+	def get_stats(self):
+		"""Returns the requests answered, those with no recorded answer left and the recorded answers unused."""
+		with self._lock:
+			return {"requests":sum(self._replayed.values()),"missed":self._missed,
+					"unused":self._skipped+sum(len(answers) for answers in self._answers.values())}
+
+	def close(self):
+		pass
+
+def set_nest_transport(transport):
+	"""Sends the requests of every session, existing and new, through transport.
+	
+			A transport has the request(), set_timeouts(), get_stats() and close() methods of
+			NestConnectionPool; use NEST_CONNECTION_POOL to go back to sending requests directly.
+	"""
+	global NEST_TRANSPORT
+	NEST_TRANSPORT=transport
+	with NEST_SESSIONS_LOCK:
+		for session in NEST_SESSIONS.values():
+			session._pool=transport
+
+class NestWriteQueue:
+
+	def __init__(self, send, window=NEST_WRITE_COALESCE_WINDOW):
+		"""Initialize a queue that merges changes to the same Nest bucket into a single request
+		
+				Changes queued for a URL within window seconds of the first one are merged (the
+				last value queued for each key wins) and sent as one request. Requests to the same
+				URL are never sent concurrently, so changes queued while one is being sent go out in
+				the next request, in order.
+		
+				Arguments:
+					send - Called as send(url,values) to send the merged values; its return value
+							(or exception) completes the futures of every merged change
+					window - Time (in seconds) to collect changes for before sending them
+		"""
+		self._send=send
+		self._window=window
+		self._lock=threading.Lock()
+		self._batches=dict()
+		self._sending=set()
+		self._stats={"queued":0,"sent":0}
+
+	def put(self,url,values):
+		"""Queues a change and returns the NestFuture of the request that sends it.
+		
+				Arguments:
+					url - The URL of the bucket to change
+					values - A dictionary of the bucket keys to change and their new values
+		"""
+		future=NestFuture()
+		with self._lock:
+			self._stats["queued"]+=1
+			batch=self._batches.get(url)
+			if (batch is None):
+				batch={"values":dict(),"futures":[],"ready":False}
+				self._batches[url]=batch
+				timer=threading.Timer(self._window,self._window_closed,[url])
+				timer.daemon=True
+				timer.start()
+			batch["values"].update(values)
+			batch["futures"].append(future)
+		return future
+
+	def get_stats(self):
+		"""Returns the number of changes queued and the number of requests actually sent."""
+		with self._lock:
+			return dict(self._stats)
+
+	def _window_closed(self,url):
+		with self._lock:
+			batch=self._batches[url]
+			batch["ready"]=True
+			if (url in self._sending):
+				# Sent as soon as the request in progress finishes
+				return
+			del self._batches[url]
+			self._sending.add(url)
+		while (batch is not None):
+			try:
+				result=self._send(url,batch["values"])
+			except Exception as e:
+				for future in batch["futures"]:
+					future.set_error(e)
+			else:
+				for future in batch["futures"]:
+					future.set_result(result)
+			with self._lock:
+				self._stats["sent"]+=1
+				batch=self._batches.get(url)
+				if (batch is not None and batch["ready"]):
+					del self._batches[url]
+				else:
+					batch=None
+					self._sending.discard(url)
+
+class NestBucket(object):
+	"""A compact record of the fields of a Nest status bucket that the plugin reads.
+	
+			Status buckets on Nest.com carry many fields (schedules, learning data and so on)
+			that the plugin never looks at. Each bucket type has a subclass that lists the fields
+			it keeps in FIELDS (and __slots__); a downloaded bucket is projected onto a record and
+			the decoded document is dropped. Records are read like the dictionaries they came
+			from: record[field] raises KeyError for a field the record doesn't keep.
+	"""
+	__slots__=("version","timestamp")
+	FIELDS=()
+
+	@classmethod
+	def project(cls,bucket):
+		"""Returns a record of the fields the subclass keeps from a decoded bucket (a dictionary)."""
+		record=cls()
+		record.version=bucket.get(NEST_BUCKET_VERSION)
+		record.timestamp=bucket.get(NEST_BUCKET_TIMESTAMP)
+		for field in cls.FIELDS:
+			setattr(record,field,bucket.get(field))
+		return record
+
+	def updated(self,values):
+		"""Returns a copy of the record with the fields in values changed (others in values are ignored)."""
+		bucket=self.to_dict()
+		bucket.update(values)
+		return self.project(bucket)
+
+	def to_dict(self):
+		"""Returns the record as a bucket dictionary, e.g. for the session cache file."""
+		bucket=dict((field,getattr(self,field)) for field in self.FIELDS)
+		bucket[NEST_BUCKET_VERSION]=self.version
+		bucket[NEST_BUCKET_TIMESTAMP]=self.timestamp
+		return bucket
+
+	def get(self,field,default=None):
+		try:
+			value=self[field]
+		except KeyError:
+			return default
+		return default if value is None else value
+
+	def __getitem__(self,field):
+		if (field==NEST_BUCKET_VERSION):
+			return self.version
+		if (field==NEST_BUCKET_TIMESTAMP):
+			return self.timestamp
+		if (field not in self.FIELDS):
+			raise KeyError(field)
+		return getattr(self,field)
+
+class NestDeviceBucket(NestBucket):
+	"""The fields of a 'device' bucket (settings of the thermostat hardware) that the plugin reads."""
+	FIELDS=(NEST_CURRENT_HUMIDITY,NEST_CURRENT_FAN_MODE,NEST_TEMP_SCALE)
+	__slots__=FIELDS
+
+class NestSharedBucket(NestBucket):
+	"""The fields of a 'shared' bucket (temperatures and HVAC state) that the plugin reads."""
+	FIELDS=(NEST_DEVICE_NAME,NEST_CURRENT_TEMP,NEST_TARGET_TEMP,NEST_TARGET_CHANGE_PENDING,NEST_HEAT_COOL_MODE,
+			NEST_RANGE_TEMP_LOW,NEST_RANGE_TEMP_HIGH,NEST_HEAT_ON,NEST_AC_ON,NEST_FAN_ON)
+	__slots__=FIELDS
+
+class NestStructureBucket(NestBucket):
+	"""The fields of a 'structure' bucket (a location) that the plugin reads."""
+	FIELDS=(NEST_STRUCTURE_NAME,NEST_AWAY)
+	__slots__=FIELDS
+
+# The record each bucket type is projected onto. Other parts of the status document are dropped.
+NEST_BUCKET_RECORDS={NEST_DEVICE_DATA:NestDeviceBucket,NEST_SHARED_DATA:NestSharedBucket,
+					NEST_STRUCTURE_DATA:NestStructureBucket}
+
+# Every field a NestBucket keeps, and the bucket version and timestamp
+NEST_BUCKET_KEPT_FIELDS=frozenset(sum([record.FIELDS for record in NEST_BUCKET_RECORDS.values()],
+									(NEST_BUCKET_VERSION,NEST_BUCKET_TIMESTAMP)))
+
+def drop_unread_fields(values):
+	"""Drops what no NestBucket keeps from a decoded bucket (used by NestStatusFilter).
+	
+			json.loads() calls its object_hook for every object, innermost first, so the fields of
+			a bucket (an object with a version) that the plugin doesn't read are freed as soon as
+			the bucket is decoded instead of once the whole document is.
+	"""
+	if (NEST_BUCKET_VERSION in values):
+		return dict((key,value) for (key,value) in values.iteritems() if key in NEST_BUCKET_KEPT_FIELDS)
+	return values
+
+class NestBucketGroup(dict):
+	"""The buckets of one type kept from a downloaded status document, with the names of every bucket (kept or not)."""
+	__slots__=("names",)
+
+class NestStatusFilter:
+
+	def __init__(self, keep, known):
+		"""Initialize an object_hook for decoding status documents that keeps only the buckets the plugin needs
+		
+				Unread fields are dropped from every bucket (see drop_unread_fields()). Then, as each
+				group of buckets is decoded, buckets whose key is in known but not in keep are
+				dropped too, after their names are noted in the group's names. A key that isn't
+				known yet (a new Nest or location) is kept so the session can decide once the names
+				in the document have been read.
+		
+				Arguments:
+					keep - Keys (serial numbers and structure ids) of the buckets to keep
+					known - Every key the session has seen on the account
+		"""
+		self._keep=keep
+		self._known=known
+
+	def __call__(self,values):
+		if (NEST_BUCKET_VERSION in values):
+			return drop_unread_fields(values)
+		if (values and all(isinstance(value,dict) and NEST_BUCKET_VERSION in value for value in values.itervalues())):
+			group=NestBucketGroup((key,bucket) for (key,bucket) in values.iteritems()
+								  if key in self._keep or key not in self._known)
+			group.names=nest_bucket_names(values)
+			return group
+		return values
+
+def nest_bucket_names(buckets):
+	"""Returns the name of each bucket in a group of buckets, by key (from NestBucketGroup.names if there)."""
+	names=getattr(buckets,"names",None)
+	if (names is None):
+		names=dict((key,bucket.get(NEST_DEVICE_NAME)) for (key,bucket) in buckets.items()
+				   if bucket.get(NEST_DEVICE_NAME) is not None)
+	return names
+
+def project_nest_status(status_data):
+	"""Returns a status document with every bucket projected onto its NestBucket record."""
+	return dict((bucket_type,dict((key,NEST_BUCKET_RECORDS[bucket_type].project(bucket))
+								for (key,bucket) in status_data.get(bucket_type,{}).items()))
+				for bucket_type in NEST_BUCKET_TYPES)
+
+class NestResolutionError(LookupError):
+	"""Raised when a Nest or location name isn't found on the Nest.com account."""
+	def __init__(self, kind, name, known):
+		LookupError.__init__(self,u"no %s named \"%s\" on the Nest.com account (found: %s)" %
+							(kind,name,u", ".join(sorted(known)) or u"none"))
+		self.kind=kind		# 'Nest' or 'location'
+		self.name=name
+
+class NestAccountIndex:
+
+	def __init__(self, serials=None, structures=None):
+		"""Initialize the name lookups of a Nest.com account
+		
+				The lookups map lowercase Nest names to serial numbers and lowercase location
+				names to structure ids, for every Nest and location on the account (including the
+				ones whose status isn't kept). They are rebuilt only when a name changes, and the
+				generation counter goes up only when a lookup actually changed, so anything
+				resolved from the index stays valid for as long as the generation is the same.
+		
+				Arguments:
+					serials - Lowercase Nest names and serial numbers to start with
+					structures - Lowercase location names and structure ids to start with
+		"""
+		# The names as entered on nest.com by bucket type and key, for the lookups and error messages
+		self._names={NEST_SHARED_DATA:dict((key,name) for (name,key) in (serials or {}).items()),
+					NEST_STRUCTURE_DATA:dict((key,name) for (name,key) in (structures or {}).items())}
+		self._serials=dict(serials or {})
+		self._structures=dict(structures or {})
+		self.generation=0
+
+	def update(self,names):
+		"""Replaces the names of each bucket type in names (a dictionary of name by key, by bucket type).
+		
+				Returns True if the lookups changed.
+		"""
+		for (bucket_type,type_names) in names.items():
+			if (bucket_type in self._names):
+				self._names[bucket_type]=dict(type_names)
+		return self._rebuild()
+
+	def set_name(self,bucket_type,key,name):
+		"""Sets the name of a single bucket (e.g. one returned by a subscription). Returns True if the lookups changed."""
+		if (bucket_type not in self._names or name is None or self._names[bucket_type].get(key)==name):
+			return False
+		self._names[bucket_type][key]=name
+		return self._rebuild()
+
+	def _rebuild(self):
+		serials=dict((name.lower(),key) for (key,name) in self._names[NEST_SHARED_DATA].items())
+		structures=dict((name.lower(),key) for (key,name) in self._names[NEST_STRUCTURE_DATA].items())
+		if (serials==self._serials and structures==self._structures):
+			return False
+		self._serials=serials
+		self._structures=structures
+		self.generation+=1
+		return True
+
+	def get_keys(self):
+		"""Returns every serial number and structure id on the account, as a set."""
+		return set(self._names[NEST_SHARED_DATA])|set(self._names[NEST_STRUCTURE_DATA])
+
+	def lookup_serial(self,name):
+		"""Returns the serial number of the Nest with the given name (case insensitive)."""
+		try:
+			return self._serials[name.lower()]
+		except KeyError:
+			raise NestResolutionError(u"Nest",name,self._names[NEST_SHARED_DATA].values())
+
+	def lookup_structure(self,location):
+		"""Returns the structure id of the location with the given name (case insensitive)."""
+		try:
+			return self._structures[location.lower()]
+		except KeyError:
+			raise NestResolutionError(u"location",location,self._names[NEST_STRUCTURE_DATA].values())
+
+	def get_state(self):
+		"""Returns the lookups as (serials, structures) dictionaries, e.g. for the session cache file."""
+		return (dict(self._serials),dict(self._structures))
+
+class NestAuth:
+
+	def __init__(self, login):
+		"""Initialize a manager for the login token of one Nest.com account
+		
+				The token is fetched on first use and replaced in the background shortly before
+				it expires (NEST_AUTH_REFRESH_AHEAD), so requests only ever wait for a login when
+				there is no usable token at all. However many threads need a new token at the
+				same time, only one login is made.
+		
+				Arguments:
+					login - Logs in to the Nest website and returns NestCredentials
+		"""
+		self._login=login
+		self._condition=threading.Condition(threading.Lock())
+		self._credentials=None
+		self._refresh_at=0
+		self._refreshing=False
+
+	@staticmethod
+	def parse_expiry(value,now=None):
+		"""Returns when a token expires (in seconds since the epoch) from a login's 'expires_in'.
+		
+				The Nest website sends a date such as 'Sat, 20-Dec-2031 19:33:34 GMT'; a number
+				of seconds is also accepted. Anything else means the token is assumed to last
+				NEST_AUTH_REFRESH_TIMEOUT seconds.
+		"""
+		now=now or time.time()
+		if (isinstance(value,(int,long,float))):
+			return now+value
+		if (value):
+			try:
+				return now+float(value)
+			except ValueError:
+				parsed=email.utils.parsedate_tz(value)
+				if (parsed is not None):
+					return email.utils.mktime_tz(parsed)
+		return now+NEST_AUTH_REFRESH_TIMEOUT
+
+	def get(self):
+		"""Returns usable NestCredentials, logging in first if there are none."""
+		with self._condition:
+			while True:
+				credentials=self._credentials
+				now=time.time()
+				if (credentials is not None and now<credentials.expires_at):
+					if (now>=self._refresh_at and not self._refreshing):
+						self._refreshing=True
+						refresher=threading.Thread(target=self._refresh_in_background,name="NestAuth")
+						refresher.daemon=True
+						refresher.start()
+					return credentials
+				if (not self._refreshing):
+					break
+				# Another thread is already logging in
+				self._condition.wait()
+			self._refreshing=True
+		return self._refresh()
+
+	def refresh(self):
+		"""Logs in again now and returns the new NestCredentials.
+		
+				If another thread is already logging in, its result is returned instead.
+		"""
+		with self._condition:
+			if (self._refreshing):
+				while (self._refreshing):
+					self._condition.wait()
+				if (self._credentials is not None):
+					return self._credentials
+			self._refreshing=True
+		return self._refresh()
+
+	def rejected(self,credentials):
+		"""Returns new NestCredentials after the Nest website has refused the given ones.
+		
+				Only the first thread to report a refused token logs in again; the others get
+				the token it fetched.
+		"""
+		with self._condition:
+			if (self._credentials is credentials):
+				self._credentials=None
+		return self.get()
+
+	def reset(self):
+		"""Forgets the current token, e.g. after the password has changed."""
+		with self._condition:
+			self._credentials=None
+			self._refresh_at=0
+
+	def get_expiry(self):
+		"""Returns when the current token expires (in seconds since the epoch), or None."""
+		credentials=self._credentials
+		return credentials.expires_at if credentials is not None else None
+
+	def get_credentials(self):
+		"""Returns the current NestCredentials without logging in, or None if there are none."""
+		return self._credentials
+
+	def set_credentials(self,credentials):
+		"""Uses NestCredentials from an earlier login, e.g. restored from the session cache file."""
+		with self._condition:
+			lifetime=max(credentials.expires_at-time.time(),0)
+			self._credentials=credentials
+			self._refresh_at=credentials.expires_at-min(NEST_AUTH_REFRESH_AHEAD,lifetime/2)
+
+	def _refresh(self):
+		# Called with _refreshing set by this thread, which must clear it
+		try:
+			credentials=self._login()
+		except Exception:
+			with self._condition:
+				self._refreshing=False
+				self._refresh_at=time.time()+NEST_AUTH_RETRY_WAIT
+				self._condition.notifyAll()
+			raise
+		with self._condition:
+			lifetime=max(credentials.expires_at-time.time(),0)
+			self._credentials=credentials
+			self._refresh_at=credentials.expires_at-min(NEST_AUTH_REFRESH_AHEAD,lifetime/2)
+			self._refreshing=False
+			self._condition.notifyAll()
+		return credentials
+
+	def _refresh_in_background(self):
+		NEST_METRICS.count("auth_background_refreshes")
+		try:
+			self._refresh()
+		except Exception:
+			# The current token is still good; try again after NEST_AUTH_RETRY_WAIT
+			NEST_METRICS.count("auth_failures")
+
+class NestSession:
+
+	def __init__(self, username, password, pool=None):
+		"""Initialize a new Nest.com account session
+		
+				A session owns everything that is shared by the thermostats on a single Nest.com
+				account: the login token, the transport URL and the cached status document. Use
+				get_nest_session() rather than creating sessions directly so that every thermostat
+				on an account shares the same one.
+		
+				Arguments:
+					username - username for Nest website
+					password - password for Nest website
+					pool - The NestConnectionPool (or other transport) to send requests through
+							(NEST_TRANSPORT by default)
+		"""
+		self._username=username
+		self._password=password
+		self._pool=pool or NEST_TRANSPORT
+		self._writes=NestWriteQueue(self._post_values)
+		self._lock=threading.RLock()
+		self._auth=NestAuth(self._login)
+		self._last_update=0
+		self._cached=False
+		# Status downloads are made without holding _lock; callers that need one while another
+		# is in flight wait for it on _fetched. _invalidations counts calls to _mark_stale(), so a
+		# download that started before one doesn't mark the cache current.
+		self._fetching=False
+		self._fetched=threading.Condition(self._lock)
+		self._invalidations=0
+		self._status_data=None
+		self._status_etag=None
+		self._bucket_revisions=dict()
+		self._subscribed=False
+		self._restored=False
+		self._login_rejected=False
+		self._index=NestAccountIndex()
+		# (Nest name, location name) of each thermostat whose status is kept, in lowercase
+		self._watched=set()
+		self._breaker=NestCircuitBreaker()
+		self._limiter=NestRateLimiter()
+
+	def check_password(self,password):
+		"""Returns True if password is the session's password.
+		
+				A session restored from the session cache file doesn't know its password; the first
+				password it is given becomes the session's password. If the Nest website then turns
+				down a login with it, the restored state is dropped (see _login).
+		"""
+		with self._lock:
+			if (self._password is None):
+				self._password=password
+			return self._password==password
+
+	def export_state(self):
+		"""Returns what the session needs to start without the Nest website, for the session cache file.
+		
+				That is the login token, the last status document and the name lookups. No password
+				is kept: the state is kept for the username until the Nest website turns down a
+				login. Returns None if there is nothing worth saving.
+		"""
+		with self._lock:
+			credentials=self._auth.get_credentials()
+			if (self._status_data is None or self._password is None or self._login_rejected):
+				return None
+			return {"credentials":credentials and {"access_token":credentials.access_token,
+						"transport_url":credentials.transport_url,"user_id":credentials.user_id,
+						"expires_at":credentials.expires_at},
+					"status":dict((bucket_type,dict((key,bucket.to_dict()) for (key,bucket) in buckets.items()))
+								for (bucket_type,buckets) in self._status_data.items()),
+					"etag":self._status_etag,"last_update":self._last_update,
+					"serials":self._index.get_state()[0],"structures":self._index.get_state()[1]}
+
+	@classmethod
+	def from_state(cls,username,state,pool=None):
+		"""Returns a session restored from export_state(), or None if the state can't be used.
+		
+				The restored status document is only handed out by refresh_status(allow_stale=True)
+				until it has been refreshed from the Nest website. Expired tokens are dropped and
+				status documents older than NEST_DISK_CACHE_MAX_AGE are ignored.
+		"""
+		try:
+			session=cls(username,None,pool)
+			credentials=state.get("credentials")
+			if (credentials and credentials["expires_at"]>time.time()):
+				session._auth.set_credentials(NestCredentials(access_token=credentials["access_token"],
+							transport_url=credentials["transport_url"],user_id=credentials["user_id"],
+							header={"Authorization":"Basic "+credentials["access_token"],"X-nl-protocol-version": "1"},
+							expires_at=credentials["expires_at"]))
+			if (time.time()-state["last_update"]<NEST_DISK_CACHE_MAX_AGE):
+				session._status_data=project_nest_status(state["status"])
+				session._status_etag=state.get("etag")
+				session._last_update=state["last_update"]
+				session._index=NestAccountIndex(state["serials"],state["structures"])
+				session._restored=True
+		except (KeyError,TypeError,ValueError,AttributeError):
+			return None
+		return session
+
+	def is_restored(self):
+		"""Returns True while the status document is the one restored from the session cache file."""
+		return self._restored
+
+	def watch(self,name,location):
+		"""Keeps the status of the Nest with the given name and location in the cache.
+		
+				Only the device, shared and structure buckets of watched Nests are kept from the
+				status document; the rest of the account only adds its names to the lookups, so
+				the cache doesn't grow with the number of Nests on the account. If the Nest's
+				buckets aren't cached yet, the next refresh downloads the whole document again.
+		"""
+		with self._lock:
+			watched=(name.lower(),location.lower())
+			if (watched in self._watched):
+				return
+			self._watched.add(watched)
+			if (not self._has_buckets(watched)):
+				self._mark_stale()
+				self._restored=False
+				self._status_etag=None
+
+	def _has_buckets(self,watched):
+		try:
+			serial=self._index.lookup_serial(watched[0])
+			structure=self._index.lookup_structure(watched[1])
+		except NestResolutionError:
+			return False
+		status_data=self._status_data or {}
+		return (serial in status_data.get(NEST_DEVICE_DATA,{}) and serial in status_data.get(NEST_SHARED_DATA,{}) and
+				structure in status_data.get(NEST_STRUCTURE_DATA,{}))
+
+	def _watched_keys(self):
+		keys=set()
+		for (name,location) in self._watched:
+			for lookup in ((self._index.lookup_serial,name),(self._index.lookup_structure,location)):
+				try:
+					keys.add(lookup[0](lookup[1]))
+				except NestResolutionError:
+					pass
+		return keys
+
+	def change_password(self,password):
+		"""Logs in with another password and, once the Nest website accepts it, uses it from then on.
+		
+				The login goes through the account's circuit breaker and request budget, and the
+				current token and cached status are kept until it succeeds, so a wrong password
+				never logs out the thermostats already using the session. Raises NestPasswordError
+				if the password is turned down, or the login's exception if it couldn't be made.
+		"""
+		candidate=NestSession(self._username,password,self._pool)
+		candidate._breaker=self._breaker
+		candidate._limiter=self._limiter
+		try:
+			credentials=candidate._auth.get()
+		except NestHTTPError as e:
+			if (e.status in NEST_LOGIN_REJECTED):
+				raise NestPasswordError(self._username,e)
+			raise
+		with self._lock:
+			self._password=password
+			self._login_rejected=False
+			self._auth.set_credentials(credentials)
+
+	def refresh_auth(self):
+		"""Refreshes the Nest login token.
+		
+				The Nest site authentication token expires after a set period of time. The session
+				refreshes it in the background shortly before then, and at once if the Nest website
+				rejects it, so calling this method explicitly is unneeded. The cached status data
+				is kept.
+		"""
+		self._auth.refresh()
+
+	def _login(self):
+		"""Logs in to the Nest website and returns the NestCredentials. Called by NestAuth."""
+		send_data=urllib.urlencode({"username":self._username,"password":self._password})
+		try:
+			with NEST_METRICS.timer("auth"):
+				init_data=json.loads(self._send(self._pool.request,"POST",NEST_LOGIN_URL,send_data,
+												{"Content-Type":"application/x-www-form-urlencoded"},priority=NEST_PRIORITY_ACTION).body)
+		except NestHTTPError as e:
+			if (e.status in NEST_LOGIN_REJECTED):
+				# The restored login token and status are no longer trusted, or saved again, until
+				# a login succeeds. This may run while another thread holds the lock, so it is
+				# only attribute assignments.
+				self._login_rejected=True
+				self._restored=False
+			raise
+		self._login_rejected=False
+
+		# Setup the header that will be needed by every request for the thermostats on the account
+		access_token=init_data[NEST_ACCESS_TOKEN]
+		return NestCredentials(access_token=access_token,
+							transport_url=init_data[NEST_URLS][NEST_TRANSPORT_URL],
+							user_id=init_data[NEST_USER_ID],
+							header={"Authorization":"Basic "+access_token,"X-nl-protocol-version": "1"},
+							expires_at=NestAuth.parse_expiry(init_data.get(NEST_EXPIRES_IN)))
+
+	def _request(self,method,url,body=None,headers=None,timeout=None,priority=NEST_PRIORITY_ACTION):
+		"""Sends a request with the account's auth headers and returns the NestResponse.
+		
+				If the Nest website rejects the token (HTTP 401), the session logs in again and
+				resends the request once, moved to the new transport URL if that changed.
+		
+				Arguments:
+					method - 'GET' or 'POST'
+					url - The full URL to request
+					body - The request body (string), if any
+					headers - A dictionary of request headers to send besides the auth headers
+					timeout - Time limit (in seconds) for the response, instead of the pool's read timeout
+					priority - NEST_PRIORITY_ACTION or NEST_PRIORITY_POLL, for the account's request budget
+		"""
+		self._breaker.before_request()
+		credentials=self._auth.get()
+		retried=False
+		while True:
+			header=dict(credentials.header)
+			header.update(headers or {})
+			try:
+				return self._send(self._pool.request,method,url,body,header,timeout,priority)
+			except NestHTTPError as e:
+				if (e.status!=401 or retried):
+					raise
+			retried=True
+			NEST_METRICS.count("auth_rejected")
+			fresh=self._auth.rejected(credentials)
+			if (url.startswith(credentials.transport_url)):
+				url=fresh.transport_url+url[len(credentials.transport_url):]
+			credentials=fresh
+
+	def _send(self,request,method,url,body=None,headers=None,timeout=None,priority=NEST_PRIORITY_ACTION):
+		"""Sends a request through the account's circuit breaker and request budget and returns the NestResponse.
+		
+				Raises NestUnavailableError without sending anything while the breaker is open, and
+				NestRateLimitedError if the budget has no room for the request (see NestRateLimiter).
+				A long poll that times out (an explicit timeout) is counted as neither a failure nor
+				an answer, since Nest.com answers subscriptions before then.
+		"""
+		self._breaker.before_request()
+		try:
+			self._limiter.acquire(priority)
+		except:
+			# Never sent, so a probe this request claimed goes to the next one
+			self._breaker.release()
+			raise
+		try:
+			response=request(method,url,body,headers,timeout)
+		except socket.timeout:
+			if (timeout is None):
+				self._breaker.failed()
+			else:
+				self._breaker.release()
+			raise
+		except Exception as e:
+			if (NestCircuitBreaker.is_outage(e)):
+				self._breaker.failed()
+			elif (isinstance(e,NestHTTPError)):
+				self._breaker.succeeded()
+			else:
+				# Not an answer from Nest.com either way (e.g. the plugin is stopping)
+				self._breaker.release()
+			raise
+		self._breaker.succeeded()
+		return response
+
+	def get_breaker(self):
+		"""Returns the account's NestCircuitBreaker."""
+		return self._breaker
+
+	def get_limiter(self):
+		"""Returns the account's NestRateLimiter."""
+		return self._limiter
+
+	def refresh_status(self,allow_stale=False,priority=NEST_PRIORITY_POLL):
+		"""Refreshes the Nest account data.
+		
+				This method grabs the current data for every thermostat on the account from the
+				Nest website. If NEST_CACHE_REFRESH_TIMEOUT seconds haven't yet passed, the method
+				doesn't do anything (ie. the existing data remains cached), so any number of
+				thermostats can call it in the same poll cycle and only the first one pays for
+				the download.
+		
+				Arguments:
+					allow_stale - If True, a status document restored from the session cache file
+							is used as is rather than refreshed
+					priority - The priority of the download for the account's request budget
+		"""
+		with self._lock:
+			while True:
+				if (allow_stale and self._restored):
+					NEST_METRICS.count("status_restored_hits")
+					return
+				# Refresh the status data, if needed. While a subscription is open the Nest website
+				# reports every change, so the cached data stays current.
+				if (self._cached and (self._subscribed or time.time()-self._last_update<=NEST_CACHE_REFRESH_TIMEOUT)):
+					NEST_METRICS.count("status_cache_hits")
+					return
+				if (not self._fetching):
+					break
+				# Another thread is downloading it; use what it gets (or try again if it fails)
+				self._fetched.wait()
+			NEST_METRICS.count("status_cache_misses")
+			self._fetching=True
+			invalidations=self._invalidations
+			header=dict()
+			if (self._status_etag is not None and self._status_data is not None):
+				header["If-None-Match"]=self._status_etag
+			status_filter=NestStatusFilter(self._watched_keys(),self._index.get_keys())
+		# The login and download can take up to the read timeout, so they are made without the
+		# lock; the session cache, writes and subscriptions go on using the cached status meanwhile
+		status_data=None
+		try:
+			credentials=self._auth.get()
+			status_url=credentials.transport_url+NEST_STATUS_URL_FRAGMENT+credentials.user_id
+			with NEST_METRICS.timer("status_fetch"):
+				response=self._request("GET",status_url,headers=header,priority=priority)
+			# Nothing at all changed, so there is nothing to parse
+			if (response.status!=304):
+				with NEST_METRICS.timer("json_parse"):
+					status_data=json.loads(response.body,object_hook=status_filter)
+			else:
+				NEST_METRICS.count("status_not_modified")
+		except:
+			with self._lock:
+				self._fetching=False
+				self._fetched.notifyAll()
+			raise
+		with self._lock:
+			self._fetching=False
+			self._fetched.notifyAll()
+			if (status_data is not None):
+				self._status_etag=response.headers.get("etag")
+				self._merge_status(status_data)
+			if (self._invalidations==invalidations):
+				self._cached=True
+			self._restored=False
+			self._last_update=time.time()
+
+	def _merge_status(self,status_data):
+		"""Merges a downloaded status document into the cached one, one bucket at a time.
+		
+				The name lookups are updated from every Nest and location in the document first.
+				Then only the buckets of watched Nests (see watch()) are kept: those whose version
+				and timestamp haven't changed are kept as they are, changed ones are projected onto
+				their NestBucket record, and everything else in the document is dropped.
+		"""
+		if (self._status_data is None):
+			self._status_data=dict()
+		self._index.update(dict((bucket_type,nest_bucket_names(status_data[bucket_type]))
+								for bucket_type in (NEST_SHARED_DATA,NEST_STRUCTURE_DATA) if bucket_type in status_data))
+		watched=self._watched_keys()
+		for bucket_type in NEST_BUCKET_TYPES:
+			if (bucket_type not in status_data):
+				continue
+			buckets=status_data[bucket_type]
+			cached_buckets=self._status_data.setdefault(bucket_type,dict())
+			record=NEST_BUCKET_RECORDS[bucket_type]
+			for (key,bucket) in buckets.items():
+				if (key not in watched):
+					continue
+				old_bucket=cached_buckets.get(key)
+				# A write or subscription may have stored a newer version while this was downloaded
+				if (old_bucket is not None and NEST_BUCKET_VERSION in bucket and
+					(old_bucket.version>bucket[NEST_BUCKET_VERSION] or
+					(old_bucket.version==bucket[NEST_BUCKET_VERSION] and old_bucket.timestamp==bucket.get(NEST_BUCKET_TIMESTAMP)))):
+					continue
+				self._store_bucket(bucket_type,key,record.project(bucket))
+			for key in [key for key in cached_buckets if key not in buckets or key not in watched]:
+				del cached_buckets[key]
+				self._bucket_revisions.pop((bucket_type,key),None)
+
+	def _store_bucket(self,bucket_type,key,bucket):
+		"""Replaces one bucket (a NestBucket) of the cached status, and its name in the lookups."""
+		cached_buckets=self._status_data.setdefault(bucket_type,dict())
+		cached_buckets[key]=bucket
+		self._bucket_revisions[(bucket_type,key)]=self._bucket_revisions.get((bucket_type,key),0)+1
+		if (bucket_type==NEST_STRUCTURE_DATA or bucket_type==NEST_SHARED_DATA):
+			self._index.set_name(bucket_type,key,bucket.get(NEST_DEVICE_NAME))
+
+	def _apply_subscription(self,response):
+		"""Stores the bucket returned by a subscription. Returns True if it held a change."""
+		key=response.headers.get(NEST_SKV_KEY_HEADER)
+		if (not key or not response.body):
+			return False
+		(bucket_type,dot,bucket_id)=key.partition(".")
+		bucket=json.loads(response.body)
+		bucket[NEST_BUCKET_VERSION]=int(response.headers.get(NEST_SKV_VERSION_HEADER,0))
+		bucket[NEST_BUCKET_TIMESTAMP]=int(response.headers.get(NEST_SKV_TIMESTAMP_HEADER,0))
+		with self._lock:
+			if (self._status_data is None or bucket_type not in NEST_BUCKET_TYPES or
+				bucket_id not in self._status_data.get(bucket_type,{})):
+				# Something new was added to the account; read everything again
+				self._mark_stale()
+				return True
+			self._store_bucket(bucket_type,bucket_id,NEST_BUCKET_RECORDS[bucket_type].project(bucket))
+			self._status_etag=None
+		return True
+
+	def get_bucket_revision(self,bucket_type,key):
+		"""Returns a number that changes whenever the given bucket of the status document changes."""
+		return self._bucket_revisions.get((bucket_type,key),0)
+
+	def subscribe(self,timeout=None):
+		"""Waits for the Nest website to report a change to any thermostat or location on the account.
+		
+				The versions of every bucket in the cached status document are sent to the Nest
+				website, which holds the request open until one of them changes and then returns
+				the changed bucket. Returns True (after storing the bucket in the cache) when
+				something changed, or False if the Nest website answered that nothing did. The
+				website always answers before timeout seconds, so a subscription still open then
+				raises socket.timeout like any other failure.
+				
+				After a successful subscription the cached data is treated as current until the
+				next subscription fails or end_subscription() is called.
+		
+				Arguments:
+					timeout - The longest time (in seconds) to wait for an answer
+							(NEST_SUBSCRIBE_TIMEOUT by default)
+		"""
+		if (timeout is None):
+			timeout=NEST_SUBSCRIBE_TIMEOUT
+		if (self._status_data is None):
+			self.refresh_status()
+		# Logging in (if needed) is done before taking the lock
+		(url,header)=self._subscribe_request()
+		with self._lock:
+			keys=[]
+			for bucket_type in NEST_BUCKET_TYPES:
+				for (key,bucket) in self._status_data.get(bucket_type,{}).items():
+					keys.append({"key":bucket_type+"."+key,
+								"version":bucket.get(NEST_BUCKET_VERSION,0),
+								"timestamp":bucket.get(NEST_BUCKET_TIMESTAMP,0)})
+
+		# The server holds this request open, so it must not be made while holding the lock
+		try:
+			response=self._request("POST",url,json.dumps({"keys":keys}),header,timeout=timeout,priority=NEST_PRIORITY_POLL)
+		except:
+			# Including a timeout: Nest.com didn't answer, and changes may have been missed since
+			# the last answer, so the next refresh downloads the status (conditionally)
+			self._subscribed=False
+			self._mark_stale()
+			raise
+		# The changed bucket comes back with the response, so the cache can be patched in place
+		changed=self._apply_subscription(response)
+		with self._lock:
+			self._subscribed=True
+			self._last_update=time.time()
+		return changed
+
+	def _subscribe_request(self):
+		credentials=self._auth.get()
+		return (credentials.transport_url+NEST_SUBSCRIBE_URL_FRAGMENT,{"X-nl-user-id":credentials.user_id})
+
+	def read_bucket(self,bucket_key):
+		"""Reads a single bucket of the status document from the Nest website into the cache.
+		
+				A subscription that claims to have a version of the bucket that can't exist is
+				answered at once with the current bucket, which is far smaller than the whole
+				status document.
+		
+				Arguments:
+					bucket_key - The bucket to read, e.g. 'shared.' followed by a serial number
+		"""
+		if (self._status_data is None):
+			self.refresh_status()
+			return
+		(url,header)=self._subscribe_request()
+		response=self._request("POST",url,json.dumps({"keys":[{"key":bucket_key,"version":-1,"timestamp":0}]}),header)
+		self._apply_subscription(response)
+
+	def _apply_write(self,bucket_key,values,response):
+		"""Stores a write in the cached bucket if the response shows the Nest accepted it.
+		
+				The Nest website either echoes the bucket's new values in the response body or
+				reports the bucket's new version in a header. Returns False if the response shows
+				neither, in which case the cache is left alone.
+		"""
+		version=response.headers.get(NEST_SKV_VERSION_HEADER)
+		echoed=None
+		if (response.body):
+			try:
+				echoed=json.loads(response.body)
+			except ValueError:
+				pass
+		if (isinstance(echoed,dict) and all(key in echoed for key in values)):
+			accepted=echoed
+		elif (version is not None):
+			accepted=values
+		else:
+			return False
+		(bucket_type,dot,bucket_id)=bucket_key.partition(".")
+		with self._lock:
+			bucket=(self._status_data or {}).get(bucket_type,{}).get(bucket_id)
+			if (bucket is None):
+				return False
+			bucket=bucket.updated(accepted)
+			if (version is not None):
+				bucket.version=int(version)
+			self._store_bucket(bucket_type,bucket_id,bucket)
+			self._status_etag=None
+		return True
+
+	def end_subscription(self):
+		"""Goes back to refreshing the cache by polling once subscriptions stop."""
+		self._subscribed=False
+
+	def post(self,url,data):
+		"""Posts data (a JSON string) to a Nest URL with the session's auth headers and returns the NestResponse."""
+		try:
+			with NEST_METRICS.timer("put"):
+				return self._request("POST",url,data)
+		except Exception:
+			NEST_METRICS.count("put_failures")
+			raise
+
+	def _post_values(self,url,values):
+		response=self.post(url,json.dumps(values))
+		# Keep the cache current without downloading the whole status document: use what the
+		# response says about the change, or failing that read back just the changed bucket
+		bucket_key=url.rsplit("/",1)[-1]
+		if (not self._apply_write(bucket_key,values,response)):
+			try:
+				self.read_bucket(bucket_key)
+			except Exception:
+				self.invalidate()
+		return response
+
+	def queue_write(self,url,values):
+		"""Queues a change to a Nest bucket and returns a NestFuture for the request that sends it.
+		
+				Changes to the same bucket made within NEST_WRITE_COALESCE_WINDOW seconds of each
+				other are merged into a single request, keeping the last value for each key. The
+				future's result is the NestResponse of that request; by the time it completes the
+				cached status document shows the bucket as the Nest website stored it.
+		
+				Arguments:
+					url - The URL of the bucket to change
+					values - A dictionary of the keys to change and their new values
+		"""
+		return self._writes.put(url,values)
+
+	def get_write_stats(self):
+		"""Returns the number of changes queued and the number of write requests actually sent."""
+		return self._writes.get_stats()
+
+	def invalidate(self):
+		"""Marks the cached status document as stale so the next refresh_status() downloads it."""
+		self._mark_stale()
+
+	def _mark_stale(self):
+		self._cached=False
+		self._invalidations+=1
+
+	def get_transport_url(self):
+		"""Returns the base URL that status requests and commands are sent to."""
+		return self._auth.get().transport_url
+
+	def get_header(self):
+		"""Returns the HTTP headers (including the auth token) needed for Nest requests."""
+		return self._auth.get().header
+
+	def get_auth_expiry(self):
+		"""Returns when the login token expires (in seconds since the epoch), or None before login."""
+		return self._auth.get_expiry()
+
+	def get_last_update(self):
+		"""Returns the time (seconds since the epoch) the cached status document was downloaded."""
+		return self._last_update
+
+	def get_status_data(self):
+		"""Returns the cached status of the account: bucket type, then key, to a NestBucket record."""
+		return self._status_data
+
+	def lookup_serial(self,name):
+		"""Returns the serial number of the Nest with the given name (case insensitive).
+		
+				Raises NestResolutionError if there is no Nest with that name on the account.
+		"""
+		return self._index.lookup_serial(name)
+
+	def lookup_structure(self,location):
+		"""Returns the structure id of the location with the given name (case insensitive).
+		
+				Raises NestResolutionError if there is no location with that name on the account.
+		"""
+		return self._index.lookup_structure(location)
+
+	def get_index_generation(self):
+		"""Returns a number that changes whenever a Nest or location on the account is added, removed or renamed."""
+		return self._index.generation
+
+# Shared sessions, keyed by lowercase username
+NEST_SESSIONS=dict()
+NEST_SESSIONS_LOCK=threading.Lock()
+
+def save_nest_sessions(path):
+	"""Writes the shared sessions to a session cache file, so they can be restored on the next start.
+	
+			The file holds login tokens, so it is only readable by its owner. It is written to a
+			temporary file first and then moved into place, so a crash never leaves half a file.
+	
+			Arguments:
+				path - The session cache file
+	"""
+	with NEST_SESSIONS_LOCK:
+		sessions=list(NEST_SESSIONS.items())
+	accounts=dict()
+	for (username,session) in sessions:
+		state=session.export_state()
+		if (state is not None):
+			accounts[username]=state
+	temp_path=path+".tmp"
+	cache_file=os.fdopen(os.open(temp_path,os.O_WRONLY|os.O_CREAT|os.O_TRUNC,0600),"w")
+	try:
+		json.dump({"version":NEST_DISK_CACHE_VERSION,"saved_at":time.time(),"accounts":accounts},cache_file)
+	finally:
+		cache_file.close()
+	os.rename(temp_path,path)
+
+def load_nest_sessions(path):
+	"""Restores shared sessions from a session cache file written by save_nest_sessions().
+	
+			Sessions that already exist are left alone, and a missing, unreadable or outdated file
+			is ignored. Sessions are saved by username alone, and a restored session takes the
+			password of the first device that uses it (see NestSession.check_password). Returns the
+			number of sessions restored.
+	
+			Arguments:
+				path - The session cache file
+	"""
+	try:
+		with open(path) as cache_file:
+			cache=json.load(cache_file)
+	except (IOError,OSError,ValueError):
+		return 0
+	if (not isinstance(cache,dict) or cache.get("version")!=NEST_DISK_CACHE_VERSION):
+		return 0
+	restored=0
+	for (username,state) in (cache.get("accounts") or {}).items():
+		session=NestSession.from_state(username,state)
+		if (session is None):
+			continue
+		with NEST_SESSIONS_LOCK:
+			if (username.lower() not in NEST_SESSIONS):
+				NEST_SESSIONS[username.lower()]=session
+				restored+=1
+	return restored
+
+def get_nest_session(username,password,register=True):
+	"""Returns the NestSession for a Nest.com account, creating one if needed.
+	
+			Arguments:
+				username - username for Nest website
+				password - password for Nest website
+				register - If True (default), a new session is shared with every later caller and
+						another password replaces the existing session's once it logs in (see
+						NestSession.change_password). If False, a session is only shared when the
+						credentials match; otherwise a private session is returned (useful for
+						validating credentials without disturbing devices).
+	"""
+	with NEST_SESSIONS_LOCK:
+		session=NEST_SESSIONS.get(username.lower())
+		# Checking credentials mustn't give a restored session its password
+		if (session is not None and (register or session._password is not None) and session.check_password(password)):
+			return session
+		if (not register):
+			return NestSession(username,password)
+		if (session is None):
+			session=NestSession(username,password)
+			NEST_SESSIONS[username.lower()]=session
+			return session
+	# The login is made without holding the lock, so other accounts aren't held up
+	session.change_password(password)
+	return session
+
+class NestSubscriber(threading.Thread):
+
+	def __init__(self, session, on_change, on_error=None):
+		"""Initialize a background thread that keeps a subscription open for a NestSession
+		
+				Arguments:
+					session - The NestSession to watch
+					on_change - Called with the session whenever the Nest website reports a change
+					on_error - Called with the session and the exception when a subscription fails,
+							including one Nest.com doesn't answer in time (optional)
+		"""
+		threading.Thread.__init__(self)
+		self.daemon=True
+		self._session=session
+		self._on_change=on_change
+		self._on_error=on_error
+		self._stopped=threading.Event()
+		# Devices are only polled less often once Nest.com has answered a subscription
+		self._healthy=False
+
+	def is_healthy(self):
+		"""Returns True once a subscription has succeeded, unless the most recent one failed."""
+		return self._healthy
+
+	def stop(self):
+		"""Asks the thread to exit once the open subscription (if any) returns."""
+		self._stopped.set()
+
+	def run(self):
+		while (not self._stopped.is_set()):
+			started=time.time()
+			try:
+				changed=self._session.subscribe()
+				self._healthy=True
+			except NestRateLimitedError as e:
+				# Nothing is wrong with the subscription; the account's request budget is used up
+				self._stopped.wait(e.retry_in)
+				continue
+			except Exception as e:
+				self._healthy=False
+				if (self._on_error is not None):
+					self._on_error(self._session,e)
+				self._stopped.wait(NEST_SUBSCRIBE_RETRY_WAIT)
+				continue
+			if (changed and not self._stopped.is_set()):
+				self._on_change(self._session)
+			wait=NEST_SUBSCRIBE_MIN_INTERVAL-(time.time()-started)
+			if (wait>0):
+				self._stopped.wait(wait)
+		self._session.end_subscription()
+
+class NestFuture:
+
+	def __init__(self):
+		"""Initialize the pending result of work done on another thread
+		
+				The thread doing the work calls set_result() or set_error() exactly once; any
+				number of other threads can wait for it.
+		"""
+		self._lock=threading.Lock()
+		self._done=threading.Event()
+		self._result=None
+		self._error=None
+		self._callbacks=[]
+
+	def set_result(self,result):
+		"""Completes the future with a result."""
+		self._complete(result,None)
+
+	def set_error(self,error):
+		"""Completes the future with an exception, which result() will raise."""
+		self._complete(None,error)
+
+	def _complete(self,result,error):
+		with self._lock:
+			self._result=result
+			self._error=error
+			self._done.set()
+			callbacks=self._callbacks
+			self._callbacks=[]
+		for callback in callbacks:
+			callback(self)
+
+	def add_done_callback(self,callback):
+		"""Calls callback with the future once it completes (immediately if it already has)."""
+		with self._lock:
+			if (not self._done.is_set()):
+				self._callbacks.append(callback)
+				return
+		callback(self)
+
+	def done(self):
+		"""Returns True once the future has completed."""
+		return self._done.is_set()
+
+	def wait(self,timeout=None):
+		"""Waits up to timeout seconds (forever if None) and returns True if the future completed."""
+		self._done.wait(timeout)
+		return self._done.is_set()
+
+	def result(self,timeout=None):
+		"""Waits for the future and returns its result, or raises its exception.
+		
+				Arguments:
+					timeout - The longest time (in seconds) to wait. NestTimeoutError is raised
+							if the future hasn't completed by then.
+		"""
+		if (not self.wait(timeout)):
+			raise NestTimeoutError("Timed out after %.1f seconds" % timeout)
+		if (self._error is not None):
+			raise self._error
+		return self._result
+
+class NestTimeoutError(Exception):
+	"""Raised when waiting for a NestFuture takes longer than allowed."""
+	pass
+
+class NestWorkerPool:
+
+	def __init__(self, size, name="NestWorker"):
+		"""Initialize a fixed number of daemon threads that run submitted work
+		
+				Arguments:
+					size - The number of threads; at most this many calls run at once
+					name - Prefix for the thread names
+		"""
+		self._queue=Queue.Queue()
+		self._threads=[]
+		for index in range(size):
+			thread=threading.Thread(target=self._work,name="%s-%d" % (name,index))
+			thread.daemon=True
+			thread.start()
+			self._threads.append(thread)
+
+	def _work(self):
+		while True:
+			item=self._queue.get()
+			if (item is None):
+				return
+			(future,function,args,kwargs)=item
+			try:
+				future.set_result(function(*args,**kwargs))
+			except Exception as e:
+				future.set_error(e)
+
+	def submit(self,function,*args,**kwargs):
+		"""Queues function(*args,**kwargs) to run on a pool thread and returns its NestFuture."""
+		future=NestFuture()
+		self._queue.put((future,function,args,kwargs))
+		return future
+
+	def shutdown(self,timeout=None):
+		"""Lets the threads exit once the work already queued is done.
+		
+				Arguments:
+					timeout - If given, the longest time (in seconds) to wait for the threads to exit
+		"""
+		for thread in self._threads:
+			self._queue.put(None)
+		if (timeout is not None):
+			deadline=time.time()+timeout
+			for thread in self._threads:
+				thread.join(max(deadline-time.time(),0))
+
+class NestHistoryRollup:
+
+	def __init__(self, interval, retention):
+		"""Initialize totals of a thermostat's samples over fixed intervals
+		
+				Each interval has one entry in a set of parallel arrays: the time it starts, the
+				seconds of it that were covered by samples, the time weighted sums of temperature and
+				humidity, the lowest and highest temperature and the seconds the heat, AC and fan
+				were on.
+		
+				Arguments:
+					interval - Length of each interval (in seconds)
+					retention - Time (in seconds) entries are kept for
+		"""
+		self.interval=interval
+		self.retention=retention
+		self.start=array.array("d")
+		self.seconds=array.array("f")
+		self.temp_sum=array.array("d")
+		self.temp_min=array.array("f")
+		self.temp_max=array.array("f")
+		self.humidity_sum=array.array("d")
+		self.heat=array.array("f")
+		self.cool=array.array("f")
+		self.fan=array.array("f")
+
+	ARRAYS=("start","seconds","temp_sum","temp_min","temp_max","humidity_sum","heat","cool","fan")
+
+	def add(self,start,seconds,temp,humidity,heat_on,ac_on,fan_on):
+		"""Adds a stretch of time (which must not cross an interval boundary) in a single state."""
+		slot=start-start%self.interval
+		if (not self.start or self.start[-1]!=slot):
+			for name in self.ARRAYS:
+				getattr(self,name).append(0)
+			self.start[-1]=slot
+			self.temp_min[-1]=temp
+			self.temp_max[-1]=temp
+		self.seconds[-1]+=seconds
+		self.temp_sum[-1]+=temp*seconds
+		self.humidity_sum[-1]+=humidity*seconds
+		if (temp<self.temp_min[-1]):
+			self.temp_min[-1]=temp
+		elif (temp>self.temp_max[-1]):
+			self.temp_max[-1]=temp
+		if (heat_on):
+			self.heat[-1]+=seconds
+		if (ac_on):
+			self.cool[-1]+=seconds
+		if (fan_on):
+			self.fan[-1]+=seconds
+
+	def trim(self,now):
+		"""Drops the entries that are older than the retention."""
+		count=bisect.bisect_left(self.start,now-self.retention)
+		if (count):
+			for name in self.ARRAYS:
+				del getattr(self,name)[:count]
+
+	def add_totals(self,totals,start,end):
+		"""Adds the entries of the intervals starting in [start, end) to a totals dictionary."""
+		first=bisect.bisect_left(self.start,start)
+		last=bisect.bisect_left(self.start,end)
+		if (first>=last):
+			return
+		for name in ("seconds","temp_sum","humidity_sum","heat","cool","fan"):
+			totals[name]+=sum(getattr(self,name)[first:last])
+		totals["temp_min"]=min([totals["temp_min"]]+[temp for temp in self.temp_min[first:last]])
+		totals["temp_max"]=max([totals["temp_max"]]+[temp for temp in self.temp_max[first:last]])
+
+class NestHistory:
+
+	def __init__(self):
+		"""Initialize an append-only history of one thermostat's snapshots
+		
+				Samples are kept in parallel arrays for NEST_HISTORY_RAW_RETENTION seconds. The
+				time between one sample and the next counts as the thermostat staying as the first
+				sample showed (for at most NEST_HISTORY_MAX_GAP seconds), and is added to the
+				rollups in NEST_HISTORY_ROLLUPS as soon as the next sample arrives. Queries add up
+				the coarsest totals that fit in the window and use finer ones (down to the samples)
+				at its edges, so they take about the same time however long the window is. An edge
+				older than the finer data's retention is left out.
+		"""
+		self._lock=threading.Lock()
+		self.time=array.array("d")
+		self.temp=array.array("f")
+		self.humidity=array.array("f")
+		self.setpoint_cool=array.array("f")
+		self.setpoint_heat=array.array("f")
+		# Bit 0 heat on, bit 1 AC on, bit 2 fan on, bit 3 away
+		self.flags=array.array("B")
+		self._rollups=[NestHistoryRollup(interval,retention) for (interval,retention) in NEST_HISTORY_ROLLUPS]
+
+	SAMPLE_ARRAYS=("time","temp","humidity","setpoint_cool","setpoint_heat","flags")
+
+	def append(self,timestamp,temp,humidity,setpoint_cool,setpoint_heat,heat_on,ac_on,fan_on,away):
+		"""Adds a sample, unless it isn't newer than the last one. Returns True if it was added.
+		
+				Arguments:
+					timestamp - When the Nest was in this state (seconds since the epoch)
+					temp - The temperature, in the Nest's scale
+					humidity - The humidity (in percent)
+					setpoint_cool - The cool setpoint (0 if not in cool or range mode)
+					setpoint_heat - The heat setpoint (0 if not in heat or range mode)
+					heat_on, ac_on, fan_on, away - Whether the heat, AC and fan were running and away was set
+		"""
+		with self._lock:
+			if (self.time and timestamp<=self.time[-1]):
+				return False
+			if (self.time):
+				self._roll_up(len(self.time)-1,min(timestamp-self.time[-1],NEST_HISTORY_MAX_GAP))
+			self.time.append(timestamp)
+			self.temp.append(temp)
+			self.humidity.append(humidity)
+			self.setpoint_cool.append(setpoint_cool)
+			self.setpoint_heat.append(setpoint_heat)
+			self.flags.append((1 if heat_on else 0)|(2 if ac_on else 0)|(4 if fan_on else 0)|(8 if away else 0))
+			# Trimming moves every entry, so only do it once the oldest is well past its retention
+			if (timestamp-self.time[0]>NEST_HISTORY_RAW_RETENTION*1.1):
+				count=bisect.bisect_left(self.time,timestamp-NEST_HISTORY_RAW_RETENTION)
+				for name in self.SAMPLE_ARRAYS:
+					del getattr(self,name)[:count]
+				for rollup in self._rollups:
+					rollup.trim(timestamp)
+			return True
+
+	def _roll_up(self,index,seconds):
+		# Split the stretch at the boundaries of the finest interval; the coarser ones are multiples
+		(start,temp,humidity,flags)=(self.time[index],self.temp[index],self.humidity[index],self.flags[index])
+		end=start+seconds
+		finest=self._rollups[0].interval
+		if (start%finest+seconds<=finest):
+			# Usually the whole stretch is inside one interval
+			for rollup in self._rollups:
+				rollup.add(start,seconds,temp,humidity,flags&1,flags&2,flags&4)
+			return
+		while (start<end):
+			piece=min(end,start-start%finest+finest)-start
+			for rollup in self._rollups:
+				rollup.add(start,piece,temp,humidity,flags&1,flags&2,flags&4)
+			start+=piece
+
+	def summary(self,start,end):
+		"""Returns totals for the window [start, end) (in seconds since the epoch) as a dictionary.
+		
+				hours is the time covered by samples; heatHours, coolHours and fanHours the time each
+				was running; averageTemp and averageHumidity are time weighted. The averages, minTemp
+				and maxTemp are None if no samples cover the window.
+		"""
+		totals={"seconds":0.0,"temp_sum":0.0,"humidity_sum":0.0,"heat":0.0,"cool":0.0,"fan":0.0,
+				"temp_min":float("inf"),"temp_max":float("-inf")}
+		with self._lock:
+			self._add_totals(len(self._rollups)-1,start,end,totals)
+		seconds=totals["seconds"]
+		return {"start":start,"end":end,"hours":seconds/3600.0,
+				"heatHours":totals["heat"]/3600.0,"coolHours":totals["cool"]/3600.0,"fanHours":totals["fan"]/3600.0,
+				"averageTemp":totals["temp_sum"]/seconds if seconds else None,
+				"averageHumidity":totals["humidity_sum"]/seconds if seconds else None,
+				"minTemp":round(totals["temp_min"],2) if seconds else None,
+				"maxTemp":round(totals["temp_max"],2) if seconds else None}
+
+	def _add_totals(self,level,start,end,totals):
+		if (start>=end):
+			return
+		if (level<0):
+			self._add_samples(start,end,totals)
+			return
+		rollup=self._rollups[level]
+		first=start-start%rollup.interval
+		if (first<start):
+			first+=rollup.interval
+		last=end-end%rollup.interval
+		if (first>=last):
+			self._add_totals(level-1,start,end,totals)
+			return
+		self._add_totals(level-1,start,first,totals)
+		rollup.add_totals(totals,first,last)
+		self._add_totals(level-1,last,end,totals)
+
+	def _add_samples(self,start,end,totals):
+		# Only stretches that have ended (a later sample arrived) are counted, as in the rollups
+		index=max(bisect.bisect_right(self.time,start)-1,0)
+		while (index<len(self.time)-1 and self.time[index]<end):
+			stretch_end=self.time[index]+min(self.time[index+1]-self.time[index],NEST_HISTORY_MAX_GAP)
+			seconds=min(stretch_end,end)-max(self.time[index],start)
+			if (seconds>0):
+				(temp,flags)=(self.temp[index],self.flags[index])
+				totals["seconds"]+=seconds
+				totals["temp_sum"]+=temp*seconds
+				totals["humidity_sum"]+=self.humidity[index]*seconds
+				totals["temp_min"]=min(totals["temp_min"],temp)
+				totals["temp_max"]=max(totals["temp_max"],temp)
+				if (flags&1):
+					totals["heat"]+=seconds
+				if (flags&2):
+					totals["cool"]+=seconds
+				if (flags&4):
+					totals["fan"]+=seconds
+			index+=1
+
+	def samples(self,start,end):
+		"""Returns the samples taken in [start, end) as a list of dictionaries, oldest first.
+		
+				Values are stored in single precision, so they are rounded to two decimal places.
+		"""
+		with self._lock:
+			first=bisect.bisect_left(self.time,start)
+			last=bisect.bisect_left(self.time,end)
+			return [{"time":self.time[index],"temp":round(self.temp[index],2),"humidity":round(self.humidity[index],2),
+					"setpointCool":round(self.setpoint_cool[index],2),"setpointHeat":round(self.setpoint_heat[index],2),
+					"heatOn":bool(self.flags[index]&1),"acOn":bool(self.flags[index]&2),
+					"fanOn":bool(self.flags[index]&4),"away":bool(self.flags[index]&8)}
+					for index in range(first,last)]
+
+	def last_time(self):
+		"""Returns the time of the newest sample, or 0 if there are none."""
+		with self._lock:
+			return self.time[-1] if self.time else 0
+
+	def export_samples(self,after):
+		"""Returns the samples newer than after as [time, temp, humidity, setpoint_cool, setpoint_heat, flags] lists, for the history journal."""
+		with self._lock:
+			first=bisect.bisect_right(self.time,after)
+			return [[self.time[index],round(self.temp[index],2),round(self.humidity[index],2),round(self.setpoint_cool[index],2),
+					round(self.setpoint_heat[index],2),self.flags[index]] for index in range(first,len(self.time))]
+
+	def import_sample(self,sample):
+		"""Adds a sample from export_samples(), unless it isn't newer than the last one."""
+		(timestamp,temp,humidity,setpoint_cool,setpoint_heat,flags)=sample
+		return self.append(timestamp,temp,humidity,setpoint_cool,setpoint_heat,flags&1,flags&2,flags&4,flags&8)
+
+	def export_state(self):
+		"""Returns the history as a dictionary of base64 encoded arrays, for the history file.
+		
+				'until' is the time of the newest sample it holds.
+		"""
+		with self._lock:
+			return {"samples":dict((name,base64.b64encode(getattr(self,name).tostring())) for name in self.SAMPLE_ARRAYS),
+					"rollups":[dict([(name,base64.b64encode(getattr(rollup,name).tostring())) for name in rollup.ARRAYS]+
+									[("interval",rollup.interval)]) for rollup in self._rollups],
+					"until":self.time[-1] if self.time else 0}
+
+	@classmethod
+	def from_state(cls,state):
+		"""Returns a history restored from export_state(), or None if the state can't be used."""
+		history=cls()
+		try:
+			for name in cls.SAMPLE_ARRAYS:
+				getattr(history,name).fromstring(base64.b64decode(state["samples"][name]))
+			for (rollup,rollup_state) in zip(history._rollups,state["rollups"]):
+				# Rollups of an interval that has since changed are started afresh
+				if (rollup_state["interval"]==rollup.interval):
+					for name in rollup.ARRAYS:
+						getattr(rollup,name).fromstring(base64.b64decode(rollup_state[name]))
+		except (KeyError,TypeError,ValueError):
+			return None
+		if (len(set(len(getattr(history,name)) for name in cls.SAMPLE_ARRAYS))!=1 or
+			any(len(set(len(getattr(rollup,name)) for name in rollup.ARRAYS))!=1 for rollup in history._rollups)):
+			return None
+		return history
+
+def save_nest_history(path,histories):
+	"""Writes thermostat histories (a dictionary of NestHistory by device id) to a history file.
+	
+			Like the session cache file, it is written to a temporary file and moved into place.
+			The journal (see append_nest_history) is removed once the file holds everything in it.
+			Returns the time of the newest sample saved for each device, as a dictionary.
+	"""
+	states=dict((key,history.export_state()) for (key,history) in histories.items())
+	temp_path=path+".tmp"
+	with open(temp_path,"w") as history_file:
+		json.dump({"version":NEST_HISTORY_VERSION,"saved_at":time.time(),
+					"devices":dict((str(key),state) for (key,state) in states.items())},history_file)
+	os.rename(temp_path,path)
+	try:
+		os.remove(path+".log")
+	except OSError:
+		pass
+	return dict((key,state["until"]) for (key,state) in states.items())
+
+def append_nest_history(path,histories,saved):
+	"""Appends the samples not saved yet to the history file's journal, the file name followed by '.log'.
+	
+			Each line of the journal holds one device's new samples, so a save costs only what
+			has arrived since the last one however long the history is.
+	
+			Arguments:
+				path - The history file
+				histories - (device id, NestHistory) pairs
+				saved - The time of the newest sample saved for each device id, which is updated
+	"""
+	lines=[]
+	for (key,history) in histories:
+		samples=history.export_samples(saved.get(key,0))
+		if (samples):
+			lines.append(json.dumps({"device":key,"samples":samples})+"\n")
+			saved[key]=samples[-1][0]
+	if (lines):
+		with open(path+".log","a") as journal:
+			journal.writelines(lines)
+
+def load_nest_history(path):
+	"""Returns the histories in a history file and its journal as a dictionary of NestHistory by device id.
+	
+			A missing, unreadable or outdated file gives an empty dictionary, and journal lines
+			that can't be read (e.g. cut short by a crash) are skipped.
+	"""
+	histories=dict()
+	try:
+		with open(path) as history_file:
+			saved=json.load(history_file)
+	except (IOError,OSError,ValueError):
+		saved=None
+	if (isinstance(saved,dict) and saved.get("version")==NEST_HISTORY_VERSION):
+		for (key,state) in (saved.get("devices") or {}).items():
+			history=NestHistory.from_state(state)
+			if (history is not None):
+				histories[int(key)]=history
+	try:
+		with open(path+".log") as journal:
+			for line in journal:
+				try:
+					entry=json.loads(line)
+					(key,samples)=(int(entry["device"]),entry["samples"])
+					history=histories.get(key) or NestHistory()
+					for sample in samples:
+						history.import_sample(sample)
+				except (ValueError,KeyError,TypeError):
+					continue
+				histories[key]=history
+	except (IOError,OSError):
+		pass
+	return histories
+
+class NestRuntimeCounter:
+
+	def __init__(self):
+		"""Initialize running totals of one thermostat's heat, AC and fan use
+		
+				Each sample is compared with the one before it: as in NestHistory, the time between
+				them counts as the thermostat staying as the first sample showed (for at most
+				NEST_HISTORY_MAX_GAP seconds). Run times are for the current local day, cycles are the
+				times the heat or AC started in the last NEST_RUNTIME_CYCLE_WINDOW seconds, and the
+				state is what the thermostat has been doing since the sample that first showed it.
+				An update takes the same time however long the thermostat has been running.
+		"""
+		self.heat_seconds=0.0
+		self.cool_seconds=0.0
+		self.fan_seconds=0.0
+		self.state=None
+		self.state_since=None
+		self._heat_starts=collections.deque()
+		self._cool_starts=collections.deque()
+		self._last_time=None
+		self._last_flags=(False,False,False)
+		self._day_start=None
+		self._day_end=None
+
+	def update(self,timestamp,heat_on,ac_on,fan_on):
+		"""Adds a sample, unless it isn't newer than the last one. Returns True if it was added.
+		
+				Arguments:
+					timestamp - When the Nest was in this state (seconds since the epoch)
+					heat_on, ac_on, fan_on - Whether the heat, AC and fan were running
+		"""
+		if (self._last_time is not None and timestamp<=self._last_time):
+			return False
+		if (self._day_end is None or timestamp>=self._day_end):
+			self._start_day(timestamp)
+		if (self._last_time is not None):
+			# Only the part of the stretch since midnight counts towards today
+			seconds=min(timestamp,self._last_time+NEST_HISTORY_MAX_GAP)-max(self._last_time,self._day_start)
+			if (seconds>0):
+				(last_heat,last_ac,last_fan)=self._last_flags
+				if (last_heat):
+					self.heat_seconds+=seconds
+				if (last_ac):
+					self.cool_seconds+=seconds
+				if (last_fan):
+					self.fan_seconds+=seconds
+		self._observe(timestamp,heat_on,ac_on,fan_on)
+		return True
+
+	def _observe(self,timestamp,heat_on,ac_on,fan_on):
+		# Starts are only counted once the thermostat was seen off before them
+		if (self._last_time is not None):
+			(last_heat,last_ac,last_fan)=self._last_flags
+			if (heat_on and not last_heat):
+				self._heat_starts.append(timestamp)
+			if (ac_on and not last_ac):
+				self._cool_starts.append(timestamp)
+		state=nest_hvac_state(heat_on,ac_on,fan_on)
+		if (state!=self.state):
+			(self.state,self.state_since)=(state,timestamp)
+		self._last_time=timestamp
+		self._last_flags=(bool(heat_on),bool(ac_on),bool(fan_on))
+
+	def _start_day(self,timestamp):
+		# Run times start again at local midnight
+		day=time.localtime(timestamp)
+		self._day_start=time.mktime((day.tm_year,day.tm_mon,day.tm_mday,0,0,0,0,0,-1))
+		self._day_end=time.mktime((day.tm_year,day.tm_mon,day.tm_mday+1,0,0,0,0,0,-1))
+		self.heat_seconds=self.cool_seconds=self.fan_seconds=0.0
+
+	def cycles(self,now):
+		"""Returns the number of times the heat and the AC started in the last NEST_RUNTIME_CYCLE_WINDOW seconds."""
+		for starts in (self._heat_starts,self._cool_starts):
+			while (starts and starts[0]<=now-NEST_RUNTIME_CYCLE_WINDOW):
+				starts.popleft()
+		return (len(self._heat_starts),len(self._cool_starts))
+
+	def restore(self,history,timestamp):
+		"""Starts the totals from a NestHistory (e.g. after the plugin restarts), up to its last sample before timestamp.
+		
+				Today's run times come from the history's totals and the cycles and current state
+				from its samples of the last NEST_RUNTIME_CYCLE_WINDOW seconds, so this is done once
+				rather than for every update.
+		"""
+		self._start_day(timestamp)
+		for sample in history.samples(timestamp-NEST_RUNTIME_CYCLE_WINDOW,timestamp):
+			self._observe(sample["time"],sample["heatOn"],sample["acOn"],sample["fanOn"])
+		if (self._last_time is not None):
+			totals=history.summary(self._day_start,timestamp)
+			self.heat_seconds=totals["heatHours"]*3600
+			self.cool_seconds=totals["coolHours"]*3600
+			self.fan_seconds=totals["fanHours"]*3600
+
+def nest_hvac_state(heat_on,ac_on,fan_on):
+	"""Returns what a thermostat is doing (one of the NEST_HVAC_* states) from its heat, AC and fan flags."""
+	if (heat_on):
+		return NEST_HVAC_HEATING
+	if (ac_on):
+		return NEST_HVAC_COOLING
+	if (fan_on):
+		return NEST_HVAC_FAN
+	return NEST_HVAC_IDLE
+
 class NestThermostat:
 	
-	def __init__(self, username, password, name, location):
+	def __init__(self, username, password, name, location, session=None, allow_stale=False):
 		"""Initialize a new Nest thermostat object
 		
 				Arguments:
@@ -78,81 +2699,82 @@ class NestThermostat:
 					password - password for Nest website
 					name - The name of the Nest you want to control (as entered on nest.com)
 					location - The location of the Nest you want to control (as entered on nest.com)
+					session - The NestSession to use. By default the session shared by every
+							thermostat on the account is used.
+					allow_stale - If True and the session was restored from the session cache file,
+							the Nest is found in the restored status rather than a fresh one
 		"""
-		self._username=username
-		self._password=password
+		if (session is None):
+			session=get_nest_session(username,password)
+		self._session=session
 		self._nest_name=name
 		self._structure_name=location
-		self._refresh_auth()
-		self._refresh_status()
+		self._snapshot=None
+		self._snapshot_revisions=None
+		self._resolution=None
+		self._session.watch(name,location)
+		try:
+			self._refresh_status(allow_stale)
+		except NestResolutionError:
+			if (not allow_stale or not self._session.is_restored()):
+				raise
+			# The Nest wasn't in the restored status (renamed or new); look for it in a fresh one
+			self._refresh_status()
 	
 	def _refresh_auth(self):
-		"""Refreshes the Nest login token.
+		"""Refreshes the Nest login token of the account session.
 		
-				The Nest site authentication token expires after a set period of time. This
-				method refreshes it. All methods in this class automatically call this method
-				after NEST_AUTH_REFRESH_TIMEOUT seconds have passed, so calling it explicitly
-				is unneeded.
+				The session automatically refreshes the token before it expires and whenever the
+				Nest website rejects it, so calling this explicitly is unneeded.
 		"""
-		send_data=urllib.urlencode({"username":self._username,"password":self._password})
-		init_data=json.loads((urllib2.urlopen(urllib2.Request(NEST_LOGIN_URL,send_data))).read())
-
-		# Store time of refresh of the auth token
-		self._last_auth_refresh=time.time()
-
-		# Pieces needed for status and control
-		self._transport_url=init_data[NEST_URLS][NEST_TRANSPORT_URL]
-		access_token=init_data[NEST_ACCESS_TOKEN]
-		user_id=init_data[NEST_USER_ID]
-
-		# Setup the header and status URL that will be needed elsewhere in the class
-		self._header={"Authorization":"Basic "+access_token,"X-nl-protocol-version": "1"}
-		self._status_url=self._transport_url+NEST_STATUS_URL_FRAGMENT+user_id
-		
-		# Invalidate the cache
-		self._cached=False
+		self._session.refresh_auth()
 
-	def _refresh_status(self):
+	def _refresh_status(self,allow_stale=False,priority=NEST_PRIORITY_POLL):
 		"""Refreshes the Nest thermostat data.
 		
-				This method grabs the current data from the Nest website for use with the
-				rest of the class methods. If NEST_AUTH_REFRESH_TIMEOUT seconds haven't yet
-				passed, the method doesn't do anything (ie. the existing data remains cached).
+				This method asks the account session for the current data from the Nest website.
+				The session only downloads the data when its cache has expired, so calling this
+				for every thermostat on the account costs a single request.
 				
 				This method is called automatically by other methods that return information from
 				the Nest, so calling it explicitly is unneeded.
+		
+				Arguments:
+					allow_stale - If True, a status restored from the session cache file is used as is
+					priority - NEST_PRIORITY_ACTION when refreshing for a change, so the download isn't
+							turned away to keep the request budget for actions
 		"""
-		# Before doing anything, check to see if the auth token should be refreshed
-		if ((time.time()-self._last_auth_refresh)>NEST_AUTH_REFRESH_TIMEOUT):
-			self._refresh_auth()
-		# Refresh the status data, if needed
-		if (not self._cached or (time.time()-self._last_update>NEST_CACHE_REFRESH_TIMEOUT)):
-			self._cached=True
-			self._last_update=time.time()
-			self._status_data=json.loads((urllib2.urlopen(urllib2.Request(self._status_url,headers=self._header))).read())
-			# Loop through structures to find the named structure and build a lookup table
-			structures=self._status_data[NEST_STRUCTURE_DATA]
-			self._nest_structures=dict()
-			for key in structures.keys():
-				self._nest_structures[structures[key][NEST_STRUCTURE_NAME].lower()]=key
-			# Look through serial numbers to find Nest names and build a lookup table
-			serials=self._status_data[NEST_SHARED_DATA]
-			self._nest_serials=dict()
-			for key in serials.keys():
-				self._nest_serials[serials[key][NEST_DEVICE_NAME].lower()]=key
-	
-			# Use this to set the serial and structure (location) instance variables and construct the URLs.  
-			# I'd rather do this earlier, but letting the user refer to the Nest (and its location) by name
-			# is worth it.
-			
-			self._serial=self._nest_serials[self._nest_name.lower()]
-			self._structure=self._nest_structures[self._structure_name.lower()]
-	
-			# Setup the remaining URLs for the class
-			self._shared_url=self._transport_url+NEST_SHARED_URL_FRAGMENT+self._serial
-			self._device_url=self._transport_url+NEST_DEVICE_URL_FRAGMENT+self._serial
-			self._structure_url=self._transport_url+NEST_STRUCTURE_URL_FRAGMENT+self._structure
+		self._session.refresh_status(allow_stale,priority)
+		self._status_data=self._session.get_status_data()
+		
+		# Use this to set the serial and structure (location) instance variables and construct the URLs.  
+		# I'd rather do this earlier, but letting the user refer to the Nest (and its location) by name
+		# is worth it. They only need resolving again when a name on the account or the transport
+		# URL changes.
+		transport_url=self._session.get_transport_url()
+		resolution=(self._session.get_index_generation(),transport_url)
+		if (resolution==self._resolution):
+			return
+		self._serial=self._session.lookup_serial(self._nest_name)
+		self._structure=self._session.lookup_structure(self._structure_name)
+
+		# Setup the remaining URLs for the class
+		self._shared_url=transport_url+NEST_SHARED_URL_FRAGMENT+self._serial
+		self._device_url=transport_url+NEST_DEVICE_URL_FRAGMENT+self._serial
+		self._structure_url=transport_url+NEST_STRUCTURE_URL_FRAGMENT+self._structure
+		self._resolution=resolution
 	
+	def get_session(self):
+		"""Returns the NestSession shared by the thermostats on this Nest's account."""
+		return self._session
+
+	def get_structure(self):
+		"""Returns the id of the Nest structure (location) this Nest is in.
+		
+				Thermostats with the same session and structure share one away state.
+		"""
+		return self._structure
+
 	def	_get_attribute(self,attribute):
 		"""Returns the value of a Nest thermostat attribute, such as the current temperature.
 		
@@ -167,11 +2789,15 @@ class NestThermostat:
 			except:
 				return self._status_data[NEST_STRUCTURE_DATA][self._structure][attribute]
 			
+	def _get_converter(self):
+		"""Returns the NestTemperatureConverter for the Nest's temperature scale in the current status."""
+		return NestTemperatureConverter.for_scale(self._get_attribute(NEST_TEMP_SCALE))
+
 	def _apply_temp_scale(self,temp):
 		"""Given a temperature, returns the temperature in F or C depending on the Nest's settings.
 		
 				This method is used for getting the appropriate temperature reading when retrieving settings
-				from the Nest. 
+				from the Nest. The temperature keeps its full precision.
 				
 				For sending temperatures values, use _apply_temp_scale_c() to convert them (if
 				needed) to C.
@@ -179,25 +2805,35 @@ class NestThermostat:
 				Arguments:
 					temp - The temperature (float) to convert (if needed)
 		"""
-		if (self.temp_scale_is_f()):
-			return round(temp*1.8+32)
-		else:
-			return round(temp)
+		return self._get_converter().from_nest(temp)
 			
+	def _queue_command(self,command,url):
+		"""Queues a command for the Nest thermostat and returns the NestFuture of its request.
+		
+				Commands to the same URL made at about the same time (by any thermostat on the
+				account) are merged and sent to the Nest site as a single request.
+		
+				Arguments:
+					command - A dictionary of the Nest attributes to change and their new values
+					url - The URL where the data should be posted
+		"""
+		return self._session.queue_write(url,command)
+
 	def _send_command(self,command,url):
 		"""Attempts to send a command to the Nest thermostat via the Nest website.
 		
-				This method accepts a command string (JSON data) and attempts to send it to the Nest
-				site. If the transmission fails, it fails silently since error checking must be handled
-				by validating that a change has been made in the Nest attributes.
+				This method accepts a command (a dictionary of Nest attributes) and attempts to send
+				it to the Nest site, waiting until it has been sent. If the transmission fails, it
+				fails silently since error checking must be handled by validating that a change has
+				been made in the Nest attributes.
 		
 				Arguments:
-					command - JSON formatted data to send to the Nest site
+					command - A dictionary of the Nest attributes to change and their new values
 					url - The URL where the data should be posted
 		"""
 		discard_me=""
 		try:
-			discard_me=urllib2.urlopen(urllib2.Request(url,command,headers=self._header)).read()
+			discard_me=self._queue_command(command,url).result(NEST_READ_TIMEOUT+NEST_CONNECT_TIMEOUT).body
 		except:
 			# Do nothing
 			pass
@@ -215,10 +2851,7 @@ class NestThermostat:
 				Arguments:
 					temp - The temperature (float) to convert (if needed)
 		"""
-		if (self.temp_scale_is_f()):
-			return (temp-32)/1.8
-		else:
-			return temp
+		return self._get_converter().to_nest(temp)
 	
 	def get_temp(self):
 		"""Returns the current temperature (float) reported by the Nest."""
@@ -247,7 +2880,7 @@ class NestThermostat:
 	def target_temp_change_is_pending(self):
 		"""Returns True if the Nest is trying to set a new target temperature."""
 		# Update the current status, this is time sensitive so invalidate the cache
-		self._cached=False
+		self._session.invalidate()
 		self._refresh_status()
 		return self._get_attribute(NEST_TARGET_CHANGE_PENDING)
 		
@@ -266,8 +2899,9 @@ class NestThermostat:
 		"""
 		# Update the current status
 		self._refresh_status()
-		return {'low':self._apply_temp_scale(self._get_attribute(NEST_RANGE_TEMP_LOW)),
-				'high':self._apply_temp_scale(self._get_attribute(NEST_RANGE_TEMP_HIGH))}
+		converter=self._get_converter()
+		return {'low':converter.from_nest(self._get_attribute(NEST_RANGE_TEMP_LOW)),
+				'high':converter.from_nest(self._get_attribute(NEST_RANGE_TEMP_HIGH))}
 		
 	def get_heat_cool_mode(self):
 		"""Returns 'cool' when Nest in AC mode, 'heat' in heating mode, and 'auto' in heat/cool mode.
@@ -315,6 +2949,142 @@ class NestThermostat:
 		self._refresh_status()
 		return self._get_attribute(NEST_AWAY)
 		
+	def snapshot(self,allow_stale=False):
+		"""Returns a NestSnapshot holding every attribute of the Nest that Indigo uses.
+		
+				The status is refreshed (if needed) once and the temperature scale is resolved once,
+				so this is much cheaper than calling the individual get_*() methods one after another.
+				Temperatures are converted to the Nest's temperature scale just like get_temp(), at
+				full precision.
+				If none of the buckets the Nest reads have changed since the last call, the last
+				snapshot is returned with a new timestamp.
+		
+				Arguments:
+					allow_stale - If True, a status restored from the session cache file is used as is
+		"""
+		# Update the current status
+		self._refresh_status(allow_stale)
+		# How old the cached status is when it gets used
+		NEST_METRICS.observe("status_age",time.time()-self._session.get_last_update())
+		# Nothing this Nest reads has changed, so the last snapshot still holds
+		revisions=(self._session.get_bucket_revision(NEST_DEVICE_DATA,self._serial),
+					self._session.get_bucket_revision(NEST_SHARED_DATA,self._serial),
+					self._session.get_bucket_revision(NEST_STRUCTURE_DATA,self._structure))
+		if (self._snapshot is not None and revisions==self._snapshot_revisions):
+			return self._snapshot._replace(timestamp=self._session.get_last_update())
+		# Each field lives in one of the Nest's three bucket records, and is read straight from its slot
+		device=self._status_data[NEST_DEVICE_DATA][self._serial]
+		shared=self._status_data[NEST_SHARED_DATA][self._serial]
+		structure=self._status_data[NEST_STRUCTURE_DATA][self._structure]
+		temp_scale=getattr(device,NEST_TEMP_SCALE)
+		temps=NestTemperatureConverter.for_scale(temp_scale).convert_record(shared)
+		self._snapshot_revisions=revisions
+		self._snapshot=NestSnapshot(temp=temps[NEST_CURRENT_TEMP],
+							humidity=round(getattr(device,NEST_CURRENT_HUMIDITY)),
+							fan_mode=NEST_FAN_MAP[getattr(device,NEST_CURRENT_FAN_MODE)],
+							heat_cool_mode=NEST_HEAT_COOL_MAP[getattr(shared,NEST_HEAT_COOL_MODE)],
+							target_temp=temps[NEST_TARGET_TEMP],
+							target_change_pending=getattr(shared,NEST_TARGET_CHANGE_PENDING),
+							range_low=temps[NEST_RANGE_TEMP_LOW],
+							range_high=temps[NEST_RANGE_TEMP_HIGH],
+							heat_on=getattr(shared,NEST_HEAT_ON),
+							ac_on=getattr(shared,NEST_AC_ON),
+							fan_on=getattr(shared,NEST_FAN_ON),
+							away=getattr(structure,NEST_AWAY),
+							temp_scale=temp_scale,
+							timestamp=self._session.get_last_update())
+		return self._snapshot
+
+	def last_snapshot(self):
+		"""Returns the NestSnapshot most recently returned by snapshot(), or None, without refreshing."""
+		return self._snapshot
+
+	def _target_change_still_pending(self):
+		# Read back just this thermostat's shared bucket rather than the whole status document
+		self._session.read_bucket(NEST_SHARED_DATA+"."+self._serial)
+		return self._get_attribute(NEST_TARGET_CHANGE_PENDING)
+
+	def _send_and_verify(self,command,url,verify,keep_trying=None):
+		"""Sends a command and retries until verify() shows the Nest has taken it.
+		
+				Sending a command leaves the cached status showing the bucket as the Nest website
+				stored it, so verify() can check the change without downloading the status
+				document. Retries back off exponentially (with jitter) and stop after
+				NEST_MAX_RETRIES attempts, unless keep_trying() returns True, and never continue
+				past NEST_VERIFY_DEADLINE seconds. Returns True if the command was verified.
+		
+				Arguments:
+					command - A dictionary of the Nest attributes to change and their new values
+					url - The URL where the data should be posted
+					verify - Returns True once the change shows up in the cached status
+					keep_trying - Returns True while retries should continue past NEST_MAX_RETRIES
+		"""
+		with NEST_METRICS.timer("verify"):
+			deadline=time.time()+NEST_VERIFY_DEADLINE
+			wait=NEST_RETRY_WAIT
+			retry_count=0
+			while True:
+				if (retry_count):
+					NEST_METRICS.count("verify_retries")
+				self._send_command(command,url)
+				retry_count=retry_count+1
+				if (verify()):
+					return True
+				remaining=deadline-time.time()
+				if (remaining<=0 or (retry_count>=NEST_MAX_RETRIES and not (keep_trying and keep_trying()))):
+					NEST_METRICS.count("verify_failures")
+					return False
+				time.sleep(min(wait*random.uniform(0.5,1.5),remaining))
+				wait=wait*2
+
+	def queue_fan_mode(self,command='auto'):
+		"""Queues a change of the Nest fan mode without waiting for it to take effect.
+		
+				Returns the NestFuture of the request that sends the change. Use snapshot() to see
+				when the Nest reports the new fan mode. See set_fan_mode() for the arguments.
+		"""
+		self._refresh_status(priority=NEST_PRIORITY_ACTION)
+		return self._queue_command({NEST_CURRENT_FAN_MODE:NEST_FAN_MAP[command]},self._device_url)
+
+	def queue_away_state(self,command='off'):
+		"""Queues a change of the Nest away state without waiting for it to take effect.
+		
+				Returns the NestFuture of the request that sends the change. Use snapshot() to see
+				when the Nest reports the new away state. See set_away_state() for the arguments.
+		"""
+		self._refresh_status(priority=NEST_PRIORITY_ACTION)
+		return self._queue_command({NEST_AWAY:NEST_AWAY_MAP[command]},self._structure_url)
+
+	def queue_heat_cool_mode(self,command='cool'):
+		"""Queues a change of the Nest heat/cool mode without waiting for it to take effect.
+		
+				Returns the NestFuture of the request that sends the change. Use snapshot() to see
+				when the Nest reports the new mode. See set_heat_cool_mode() for the arguments.
+		"""
+		self._refresh_status(priority=NEST_PRIORITY_ACTION)
+		return self._queue_command({NEST_HEAT_COOL_MODE:NEST_HEAT_COOL_MAP[command]},self._shared_url)
+
+	def queue_range_temps(self,low_temp,high_temp):
+		"""Queues a change of the Nest range temperatures without waiting for it to take effect.
+		
+				Returns the NestFuture of the request that sends the change. Use snapshot() to see
+				when the Nest reports the new temperatures. See set_range_temps() for the arguments.
+		"""
+		self._refresh_status(priority=NEST_PRIORITY_ACTION)
+		converter=self._get_converter()
+		return self._queue_command({NEST_RANGE_TEMP_LOW:converter.to_nest(low_temp),
+									NEST_RANGE_TEMP_HIGH:converter.to_nest(high_temp)},self._shared_url)
+
+	def queue_target_temp(self,new_temp):
+		"""Queues a new Nest target temperature without waiting for it to take effect.
+		
+				Returns the NestFuture of the request that sends the change. Use snapshot() to see
+				when the Nest reports the new target. See set_target_temp() for the arguments.
+		"""
+		self._refresh_status(priority=NEST_PRIORITY_ACTION)
+		return self._queue_command({NEST_TARGET_TEMP:self._apply_temp_scale_c(new_temp),
+									NEST_TARGET_CHANGE_PENDING:True},self._shared_url)
+
 	def set_fan_mode(self,command='auto'):
 		"""Sets the Nest fan mode to 'on' (always on) or 'auto' based on the provided command string.
 	
@@ -325,17 +3095,10 @@ class NestThermostat:
 				alternative strings. This was included for ease of integration with Indigo and can just
 				be ignored for general use.
 		"""
-		self._refresh_status()
-		send_data=json.dumps({NEST_CURRENT_FAN_MODE:NEST_FAN_MAP[command]})
-		retry_count=0
-		while (retry_count<NEST_MAX_RETRIES):
-			self._cached=False
-			self._send_command(send_data,self._device_url)
-			retry_count=retry_count+1
-			if (NEST_FAN_MAP[command]==self.get_fan_mode()):
-				return True
-			time.sleep(NEST_RETRY_WAIT)
-		return False
+		self._refresh_status(priority=NEST_PRIORITY_ACTION)
+		send_data={NEST_CURRENT_FAN_MODE:NEST_FAN_MAP[command]}
+		return self._send_and_verify(send_data,self._device_url,
+									lambda: NEST_FAN_MAP[command]==self.get_fan_mode())
 		
 	def set_away_state(self,command='off'):
 		"""Sets the Nest away state 'on' (away) or 'off' (home) based on the provided command string.
@@ -346,18 +3109,10 @@ class NestThermostat:
 				Note that the value sent to the Nest is passed through a dictionary so it can be mapped to 
 				alternative strings. In this case, I liked 'on' and 'off' better than true or false.
 		"""
-		self._refresh_status()
-		send_data=json.dumps({NEST_AWAY:NEST_AWAY_MAP[command]})
-		retry_count=0
-		while (retry_count<NEST_MAX_RETRIES):
-			self._cached=False
-			self._send_command(send_data,self._structure_url)
-			retry_count=retry_count+1
-			if ((NEST_AWAY_MAP[command]==True and self.away_is_active()) or
-				(NEST_AWAY_MAP[command]==False and not self.away_is_active())):
-				return True
-			time.sleep(NEST_RETRY_WAIT)
-		return False
+		self._refresh_status(priority=NEST_PRIORITY_ACTION)
+		send_data={NEST_AWAY:NEST_AWAY_MAP[command]}
+		return self._send_and_verify(send_data,self._structure_url,
+									lambda: NEST_AWAY_MAP[command]==bool(self.away_is_active()))
 			
 	def set_heat_cool_mode(self,command='cool'):
 		"""Sets the Nest thermostat mode to 'cool' (AC), 'heat' (heating), 'range' (auto heat/cool), or 'off'.
@@ -371,17 +3126,10 @@ class NestThermostat:
 				alternative strings. This was included for ease of integration with Indigo and can just
 				be ignored for general use.
 		"""
-		self._refresh_status()
-		send_data=json.dumps({NEST_HEAT_COOL_MODE:NEST_HEAT_COOL_MAP[command]})
-		retry_count=0
-		while (retry_count<NEST_MAX_RETRIES):
-			self._cached=False
-			self._send_command(send_data,self._shared_url)
-			retry_count=retry_count+1
-			if (NEST_HEAT_COOL_MAP[command]==self.get_heat_cool_mode()):
-				return True
-			time.sleep(NEST_RETRY_WAIT)
-		return False
+		self._refresh_status(priority=NEST_PRIORITY_ACTION)
+		send_data={NEST_HEAT_COOL_MODE:NEST_HEAT_COOL_MAP[command]}
+		return self._send_and_verify(send_data,self._shared_url,
+									lambda: NEST_HEAT_COOL_MAP[command]==self.get_heat_cool_mode())
 
 			
 	def set_range_temps(self,low_temp,high_temp):
@@ -391,19 +3139,14 @@ class NestThermostat:
 					low_temp - The lowest (coldest) temperature to allow before heating kicks in.
 					high_temp - The highest (hottest) temperature allowed before cooling kicks in.
 		"""
-		self._refresh_status()
-		send_data=json.dumps({NEST_RANGE_TEMP_LOW:self._apply_temp_scale_c(low_temp),
-							NEST_RANGE_TEMP_HIGH:self._apply_temp_scale_c(high_temp)})
-		retry_count=0
-		while (retry_count<NEST_MAX_RETRIES):
-			self._cached=False
-			self._send_command(send_data,self._shared_url)
-			retry_count=retry_count+1
+		self._refresh_status(priority=NEST_PRIORITY_ACTION)
+		converter=self._get_converter()
+		send_data={NEST_RANGE_TEMP_LOW:converter.to_nest(low_temp),
+					NEST_RANGE_TEMP_HIGH:converter.to_nest(high_temp)}
+		def verify():
 			range_temps=self.get_range_temps()
-			if (round(range_temps['low'])==round(low_temp) and round(range_temps['high'])==round(high_temp)):
-				return True
-			time.sleep(NEST_RETRY_WAIT)
-		return False
+			return (converter.matches(range_temps['low'],low_temp) and converter.matches(range_temps['high'],high_temp))
+		return self._send_and_verify(send_data,self._shared_url,verify)
 	
 	def set_target_temp(self,new_temp):
 		"""Sets a new target temperature on the Nest. This is the same as turning physical Nest dial.
@@ -411,17 +3154,13 @@ class NestThermostat:
 				Arguments:
 					new_temp - The temperature the Nest will try to reach and maintain.
 		"""
-		self._refresh_status()
-		send_data=json.dumps({NEST_TARGET_TEMP:self._apply_temp_scale_c(new_temp),NEST_TARGET_CHANGE_PENDING:True})
-		retry_count=0
-		while (retry_count<NEST_MAX_RETRIES or self.target_temp_change_is_pending()):
-			self._cached=False
-			self._send_command(send_data,self._shared_url)
-			retry_count=retry_count+1
-			if (round(new_temp)==round(self.get_target_temp())):
-				return True
-			time.sleep(NEST_RETRY_WAIT)
-		return False
+		self._refresh_status(priority=NEST_PRIORITY_ACTION)
+		send_data={NEST_TARGET_TEMP:self._apply_temp_scale_c(new_temp),NEST_TARGET_CHANGE_PENDING:True}
+		# Keep trying past NEST_MAX_RETRIES while the Nest is still working on a change, but
+		# never past NEST_VERIFY_DEADLINE
+		return self._send_and_verify(send_data,self._shared_url,
+									lambda: self._get_converter().matches(new_temp,self.get_target_temp()),
+									self._target_change_still_pending)
 		
 # Note the "indigo" module is automatically imported and made available inside
 # our global name space by the host process.
@@ -457,12 +3196,187 @@ def _lookupActionStrFromHvacMode(hvacMode):
 def _lookupActionStrFromFanMode(fanMode):
 	return kFanModeEnumToStrMap.get(fanMode, u"unknown")
 
+################################################################################
+class PollScheduler:
+	"""Keeps a priority queue of the times at which each device should next be polled.
+	
+			Devices are polled again after an interval chosen from their last snapshot, or after
+			an exponentially growing delay (capped at NEST_POLL_BACKOFF_MAX) while their polls
+			keep failing. Safe to use from the action callback threads.
+	"""
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._queue = []
+		self._deadlines = dict()
+		self._failures = dict()
+
+	def _schedule(self, devId, deadline):
+		# Superseded queue entries are left in place and skipped when they surface
+		self._deadlines[devId] = deadline
+		heapq.heappush(self._queue, (deadline, devId))
+
+	def remove(self, devId):
+		"""Stops polling a device."""
+		with self._lock:
+			self._deadlines.pop(devId, None)
+			self._failures.pop(devId, None)
+
+	def pollNow(self, devId):
+		"""Moves the next poll of a device forward to now."""
+		with self._lock:
+			if devId in self._deadlines and self._deadlines[devId] > time.time():
+				self._schedule(devId, time.time())
+
+	def requeue(self, devId):
+		"""Schedules a device returned by popDue() to be polled now, unless it has been rescheduled since."""
+		with self._lock:
+			if devId not in self._deadlines:
+				self._schedule(devId, time.time())
+
+	def popDue(self, now):
+		"""Returns the ids of the devices due to be polled, removing them from the queue.
+		
+				Every device returned must be rescheduled with succeeded() or failed().
+		"""
+		due = []
+		with self._lock:
+			while self._queue and self._queue[0][0] <= now:
+				(deadline, devId) = heapq.heappop(self._queue)
+				if self._deadlines.get(devId) == deadline:
+					del self._deadlines[devId]
+					due.append(devId)
+		return due
+
+	def succeeded(self, devId, interval):
+		"""Schedules the next poll of a device interval seconds after a successful poll."""
+		with self._lock:
+			self._failures.pop(devId, None)
+			self._schedule(devId, time.time() + interval)
+
+	def failed(self, devId):
+		"""Schedules the next poll of a device after a failed poll, backing off exponentially."""
+		with self._lock:
+			failures = self._failures.get(devId, 0) + 1
+			self._failures[devId] = failures
+			self._schedule(devId, time.time() + min(NEST_POLL_INTERVAL * (2 ** failures), NEST_POLL_BACKOFF_MAX))
+
+	def secondsUntilNext(self, now):
+		"""Returns the time until the next device is due, or None if nothing is scheduled."""
+		with self._lock:
+			while self._queue and self._deadlines.get(self._queue[0][1]) != self._queue[0][0]:
+				heapq.heappop(self._queue)
+			if not self._queue:
+				return None
+			return max(self._queue[0][0] - now, 0)
+
+################################################################################
+class PollTask:
+	"""A poll of one account running on the worker pool."""
+	def __init__(self, future, nests):
+		self.future = future
+		self.nests = nests			# (device id, NestThermostat) pairs being polled
+		self.started = time.time()
+		self.deadline = self.started + NEST_POLL_DEADLINE
+		self.timedOut = False
+		self.deferred = set()		# devices that came due while the poll was running
+
+################################################################################
+class PendingCommand:
+	"""An action sent to the Nest that hasn't yet shown up in a snapshot."""
+	def __init__(self, stateKey, expected, description, send, timeout, target=None, tolerance=0):
+		self.stateKey = stateKey
+		self.expected = expected		# the state value the action should produce
+		self.target = expected if target is None else target	# the value sent, at full precision
+		self.tolerance = tolerance		# how far a temperature may be from expected and still match
+		self.description = description	# e.g. u"mode change to cool", for the log
+		self.send = send				# queues the change and returns the NestFuture of its request
+		self.startedAt = time.time()
+		self.deadline = self.startedAt + timeout
+		self.sentAt = None				# when the request carrying the change last finished
+		self.attempts = 0
+		self.error = None
+		self.devIds = []				# devices showing the change (several for a structure's away state)
+
+	def matches(self, value):
+		if isinstance(self.expected, float):
+			return value is not None and abs(value - self.expected) <= self.tolerance
+		return value == self.expected
+
+################################################################################
+class BulkAction:
+	"""A change sent to several devices at once, whose summary is logged once every request has finished."""
+	def __init__(self, description, devCommands, results, requests):
+		self.description = description	# e.g. u"mode change to cool", for the log
+		self.devCommands = devCommands	# (device, PendingCommand) pairs sent
+		self.results = results			# device name to result, for devices that couldn't be started
+		self.started = time.time()
+		self.outstanding = requests		# requests (and accounts still queuing theirs) not yet finished
+		self.lock = threading.Lock()
+
+	# Adds count outstanding requests, or removes one if count is negative. Returns True once none are left.
+	def add(self, count):
+		with self.lock:
+			self.outstanding += count
+			return self.outstanding == 0
+
 ################################################################################
 class Plugin(indigo.PluginBase):
 	########################################
 	def __init__(self, pluginId, pluginDisplayName, pluginVersion, pluginPrefs):
 		indigo.PluginBase.__init__(self, pluginId, pluginDisplayName, pluginVersion, pluginPrefs)
 		self.debug = False
+		self._myNest = dict()
+		# Last state values pushed to the Indigo Server, keyed by device id. The poll loop,
+		# poll workers and Indigo's callback threads all push states, so it has its own lock.
+		self._lastStates = dict()
+		self._lastStatesLock = threading.Lock()
+		# Subscription threads (subscribe mode only), keyed by session, and the event they set
+		self._subscribers = dict()
+		self._wakeEvent = threading.Event()
+		self._changedSessions = set()
+		self._changedSessionsLock = threading.Lock()
+		# When each device should next be polled
+		self._scheduler = PollScheduler()
+		# Accounts are polled in parallel; at most one poll per account runs at a time
+		self._pollWorkers = NestWorkerPool(NEST_POLL_WORKERS, "NestPoll")
+		self._pollsInFlight = dict()
+		# Actions are sent off the Indigo callback thread and confirmed by later polls
+		self._commandWorkers = NestWorkerPool(NEST_COMMAND_WORKERS, "NestCommand")
+		self._pendingCommands = dict()
+		self._pendingCommandsLock = threading.Lock()
+		# Device ids in each Nest structure, keyed by (session, structure id), which share an away state
+		self._structureDevices = dict()
+		# The away state each structure was last seen with
+		self._structureAway = dict()
+		# Sessions whose circuit breaker has opened, so the outage is only logged once
+		self._offlineSessions = set()
+		# Devices that couldn't reach Nest.com when they started, which the poll loop starts again
+		self._startRetries = set()
+		# Their connection attempts running on the poll workers, keyed by device id
+		self._startsInFlight = dict()
+		# Step that temperatures are rounded to when shown in Indigo
+		self._tempRounding = NEST_DISPLAY_ROUNDING
+		# When the metrics file (if one is set) is next written
+		self._metricsFileDue = time.time() + NEST_METRICS_FILE_INTERVAL
+		# Sessions are saved here so devices can start with their last known states
+		self._sessionCachePath = None
+		self._sessionCacheDue = time.time() + NEST_DISK_CACHE_SAVE_INTERVAL
+		# Each thermostat's history (a NestHistory keyed by device id), saved to its own file
+		self._history = dict()
+		self._historyPath = None
+		self._historyDue = time.time() + NEST_HISTORY_SAVE_INTERVAL
+		self._historyCompactDue = time.time() + NEST_HISTORY_COMPACT_INTERVAL
+		# The file is written on its own thread, one save at a time, so runConcurrentThread never
+		# waits for the disk. _historySaved (the newest sample saved for each device) is only
+		# used on that thread once the history has been loaded.
+		self._historyWriter = NestWorkerPool(1, "NestHistory")
+		self._historySave = None
+		self._historySaved = dict()
+		# Each thermostat's run times, cycles and current HVAC state (a NestRuntimeCounter keyed by device id)
+		self._runtimes = dict()
+		# Records Nest.com requests and the actions behind them while a traffic file is set
+		self._recorder = None
+		self._recordingPath = None
 
 	def __del__(self):
 		indigo.PluginBase.__del__(self)
@@ -512,55 +3426,371 @@ class Plugin(indigo.PluginBase):
 		dev.updateStateOnServer(stateKey, value)
 		self.debugLog(u"\"%s\" called update %s %d" % (dev.name, stateKey, value))
 
+	######################
+	# Push state values to the Indigo Server, skipping any that haven't changed
+	# since they were last pushed. States are sent as one batch when the
+	# server API supports it.
+	def _updateChangedStates(self, dev, states):
+		# The values are recorded before they are pushed, so another thread pushing the
+		# same device at the same time only sends what this one doesn't
+		with self._lastStatesLock:
+			lastStates = self._lastStates.setdefault(dev.id, dict())
+			changed = [(key, value) for (key, value) in states if key not in lastStates or lastStates[key] != value]
+			for (key, value) in changed:
+				lastStates[key] = value
+		if not changed:
+			return
+		try:
+			if hasattr(dev, "updateStatesOnServer"):
+				dev.updateStatesOnServer([{"key":key, "value":value} for (key, value) in changed])
+			else:
+				for (key, value) in changed:
+					dev.updateStateOnServer(key, value)
+		except:
+			# Forget them so the next update sends them again
+			with self._lastStatesLock:
+				lastStates = self._lastStates.get(dev.id, dict())
+				for (key, value) in changed:
+					if lastStates.get(key) == value:
+						del lastStates[key]
+			raise
+		self.debugLog(u"\"%s\" updated %s" % (dev.name, u", ".join([key for (key, value) in changed])))
+
 	######################
 	# Poll all of the states from the thermostat and pass new values to
 	# Indigo Server.
-	def _refreshStatesFromHardware(self, dev, logRefresh, commJustStarted):
-		# As an example here we update the temperature and humidity
-		# sensor states to random values.
-		self._changeTempSensorValue(dev, 1, self._myNest[dev.pluginProps["address"]].get_temp())
-		self._changeHumiditySensorValue(dev, 1, self._myNest[dev.pluginProps["address"]].get_humidity())
+	def _refreshStatesFromHardware(self, dev, logRefresh, commJustStarted, snapshot=None, online=True):
+		# Read everything from the Nest at once, unless the poll workers already have
+		if snapshot is None:
+			snapshot = self._myNest[dev.pluginProps["address"]].snapshot()
+		states = [(u"temperatureInput1", self._displayTemp(snapshot.temp)),
+				  (u"humidityInput1", snapshot.humidity),
+				  (u"hvacOperationMode", map_to_indigo_hvac_mode[snapshot.heat_cool_mode]),
+				  (u"hvacFanMode", map_to_indigo_fan_mode[snapshot.fan_mode]),
+				  (u"hvacCoolerIsOn", snapshot.ac_on),
+				  (u"hvacHeaterIsOn", snapshot.heat_on),
+				  (u"hvacFanIsOn", snapshot.fan_on),
+				  (u"away", snapshot.away),
+				  # While Nest.com is unreachable the last known states stay, with how old they are
+				  (u"online", online),
+				  (u"lastUpdateAge", 0 if online else int(time.time() - snapshot.timestamp))]
+		if (snapshot.heat_cool_mode=="cool"):
+			states += [(u"setpointCool", self._displayTemp(snapshot.target_temp)), (u"setpointHeat", 0)]
+		elif (snapshot.heat_cool_mode=="heat"):
+			states += [(u"setpointHeat", self._displayTemp(snapshot.target_temp)), (u"setpointCool", 0)]
+		elif (snapshot.heat_cool_mode=="range"):
+			states += [(u"setpointCool", self._displayTemp(snapshot.range_high)), (u"setpointHeat", self._displayTemp(snapshot.range_low))]
 
-		#	Other states that should also be updated:
-				
-		dev.updateStateOnServer("hvacOperationMode", map_to_indigo_hvac_mode[self._myNest[dev.pluginProps["address"]].get_heat_cool_mode()])
-		dev.updateStateOnServer("hvacFanMode", map_to_indigo_fan_mode[self._myNest[dev.pluginProps["address"]].get_fan_mode()])
-		dev.updateStateOnServer("hvacCoolerIsOn", self._myNest[dev.pluginProps["address"]].ac_is_on())
-		dev.updateStateOnServer("hvacHeaterIsOn", self._myNest[dev.pluginProps["address"]].heat_is_on())
-		dev.updateStateOnServer("hvacFanIsOn", self._myNest[dev.pluginProps["address"]].fan_is_on())
-		dev.updateStateOnServer("away",self._myNest[dev.pluginProps["address"]].away_is_active())
-		if (self._myNest[dev.pluginProps["address"]].get_heat_cool_mode()=="cool"):
-			dev.updateStateOnServer("setpointCool", self._myNest[dev.pluginProps["address"]].get_target_temp())
-			dev.updateStateOnServer("setpointHeat", 0)
-		elif (self._myNest[dev.pluginProps["address"]].get_heat_cool_mode()=="heat"):
-			dev.updateStateOnServer("setpointHeat", self._myNest[dev.pluginProps["address"]].get_target_temp())
-			dev.updateStateOnServer("setpointCool", 0)
-		elif (self._myNest[dev.pluginProps["address"]].get_heat_cool_mode()=="range"):
-			range_temps=self._myNest[dev.pluginProps["address"]].get_range_temps()
-			dev.updateStateOnServer("setpointCool", range_temps['high'])
-			dev.updateStateOnServer("setpointHeat", range_temps['low'])
+		# While Nest.com is unreachable the run time states stay as they were last seen
+		if online:
+			states += self._runtimeStates(dev, snapshot)
+
+		# Actions still waiting to show up keep their new values until they do (or time out)
+		states = self._confirmCommands(dev, states, snapshot)
+
+		# Only changed states are sent, so an idle thermostat costs no server traffic
+		self._updateChangedStates(dev, states)
+		if online:
+			self._recordHistory(dev, snapshot)
 		if logRefresh:
-			indigo.server.log(u"received \"%s\" cool setpoint update to %.1f°" % (dev.name, dev.states["setpointCool"]))
-			indigo.server.log(u"received \"%s\" heat setpoint update to %.1f°" % (dev.name, dev.states["setpointHeat"]))
-			indigo.server.log(u"received \"%s\" main mode update to %s" % (dev.name, _lookupActionStrFromHvacMode(dev.states["hvacOperationMode"])))
-			indigo.server.log(u"received \"%s\" fan mode update to %s" % (dev.name, _lookupActionStrFromFanMode(dev.states["hvacFanMode"])))
-			indigo.server.log(u"received \"%s\" away status to %s" % (dev.name, dev.states["away"]))
+			with self._lastStatesLock:
+				lastStates = dict(self._lastStates.get(dev.id, dict()))
+			indigo.server.log(u"received \"%s\" cool setpoint update to %.1f°" % (dev.name, lastStates.get(u"setpointCool", dev.states["setpointCool"])))
+			indigo.server.log(u"received \"%s\" heat setpoint update to %.1f°" % (dev.name, lastStates.get(u"setpointHeat", dev.states["setpointHeat"])))
+			indigo.server.log(u"received \"%s\" main mode update to %s" % (dev.name, _lookupActionStrFromHvacMode(lastStates.get(u"hvacOperationMode", dev.states["hvacOperationMode"]))))
+			indigo.server.log(u"received \"%s\" fan mode update to %s" % (dev.name, _lookupActionStrFromFanMode(lastStates.get(u"hvacFanMode", dev.states["hvacFanMode"]))))
+			indigo.server.log(u"received \"%s\" away status to %s" % (dev.name, lastStates.get(u"away", dev.states["away"])))
+		return snapshot
+
+	######################
+	# Actions return right away: the new state is shown immediately (with
+	# lastCommandStatus "pending"), the change is sent from a worker thread,
+	# and later polls confirm it or, after the command timeout, report that
+	# it failed and restore the state reported by the Nest.
+	######################
+	def _commandTimeout(self):
+		try:
+			return max(float(self.pluginPrefs.get("commandTimeout", NEST_COMMAND_TIMEOUT)), 1.0)
+		except (TypeError, ValueError):
+			return NEST_COMMAND_TIMEOUT
+
+	# Returns the PendingCommand. With dispatch False the caller sends it (see _startBulkCommands).
+	def _startCommand(self, dev, stateKey, expected, description, send, target=None, tolerance=0, dispatch=True):
+		command = PendingCommand(stateKey, expected, description, send, self._commandTimeout(), target, tolerance)
+		self._showCommand(dev, command)
+		if dispatch:
+			self._dispatchCommand(dev.id, command)
+		return command
+
+	# Shows a command as pending on a device, which is then confirmed by that device's polls.
+	def _showCommand(self, dev, command):
+		with self._pendingCommandsLock:
+			self._pendingCommands.setdefault(dev.id, dict())[command.stateKey] = command
+			if dev.id not in command.devIds:
+				command.devIds.append(dev.id)
+		self._updateChangedStates(dev, [(command.stateKey, command.expected), (u"lastCommandStatus", u"pending")])
+
+	def _dispatchCommand(self, devId, command):
+		command.sentAt = None
+		command.attempts += 1
+		queued = self._commandWorkers.submit(command.send)
+		queued.add_done_callback(lambda queued: self._commandQueued(devId, command, queued))
+
+	# Called on a worker thread once the change has been queued (or failed to queue).
+	def _commandQueued(self, devId, command, queued):
+		try:
+			queued.result().add_done_callback(lambda sent: self._commandSent(devId, command, sent))
+		except Exception as e:
+			command.error = e
+			self._pollSoon(devId)
+
+	# Called on a worker thread once the request carrying the change has finished.
+	def _commandSent(self, devId, command, sent):
+		try:
+			sent.result()
+		except Exception as e:
+			command.error = e
+		command.sentAt = time.time()
+		# The write has already brought the cached status up to date, so polling now just
+		# confirms it from the cache (on every device showing it)
+		for devId in list(command.devIds) or [devId]:
+			self._pollSoon(devId)
+
+	######################
+	# Away is a setting of the Nest structure (location), not the thermostat,
+	# so every device in the structure shows it. A change is sent once and
+	# shown on all of them, and an away state seen by one device's poll is
+	# passed on to the others without waiting for their own polls.
+	######################
+	def _structureKey(self, nest):
+		return (nest.get_session(), nest.get_structure())
+
+	def _structureSiblingIds(self, devId, nest):
+		return [otherId for otherId in list(self._structureDevices.get(self._structureKey(nest), ())) if otherId != devId]
+
+	def _shareAwayState(self, dev, nest, away):
+		# Only a change needs passing on, so most polls stop here
+		key = self._structureKey(nest)
+		if self._structureAway.get(key) == away:
+			return
+		self._structureAway[key] = away
+		for otherId in self._structureSiblingIds(dev.id, nest):
+			with self._lastStatesLock:
+				if self._lastStates.get(otherId, dict()).get(u"away", away) == away:
+					continue
+			with self._pendingCommandsLock:
+				if u"away" in self._pendingCommands.get(otherId, dict()):
+					continue		# Its own polls confirm (or fail) the change
+			try:
+				otherDev = indigo.devices[otherId]
+			except KeyError:
+				continue
+			self._updateChangedStates(otherDev, [(u"away", away)])
+
+	def _nestForDeviceId(self, devId):
+		try:
+			return self._myNest.get(indigo.devices[devId].pluginProps.get("address"))
+		except KeyError:
+			return None
+
+	# Compare a fresh set of states against the device's pending actions.
+	# Returns the states to push: confirmed and failed actions take the value
+	# reported by the Nest, actions still in progress keep their new value.
+	def _confirmCommands(self, dev, states, snapshot):
+		with self._pendingCommandsLock:
+			commands = self._pendingCommands.get(dev.id)
+			if not commands:
+				return states
+			commands = list(commands.values())
+		stateValues = dict(states)
+		overrides = dict()
+		now = time.time()
+		finished = []
+		for command in commands:
+			if command.matches(stateValues.get(command.stateKey)):
+				indigo.server.log(u"sent \"%s\" %s" % (dev.name, command.description))
+				NEST_METRICS.observe("command_confirm", now - command.startedAt)
+				finished.append((command, True))
+			elif command.error is not None or now > command.deadline:
+				reason = command.error or u"no change reported after %d seconds" % self._commandTimeout()
+				indigo.server.log(u"send \"%s\" %s failed: %s" % (dev.name, command.description, reason), isError=True)
+				NEST_METRICS.count("command_failures")
+				finished.append((command, False))
+			else:
+				if (command.sentAt is not None and snapshot.timestamp > command.sentAt and
+					command.attempts < NEST_MAX_RETRIES):
+					# The Nest has been read since the change went out and didn't take it; send it again
+					NEST_METRICS.count("command_retries")
+					self._dispatchCommand(dev.id, command)
+				overrides[command.stateKey] = command.expected
+		states = [(key, overrides.pop(key, value)) for (key, value) in states] + list(overrides.items())
+		if not finished:
+			return states
+
+		failed = False
+		with self._pendingCommandsLock:
+			pending = self._pendingCommands.get(dev.id, dict())
+			for (command, succeeded) in finished:
+				failed = failed or not succeeded
+				if pending.get(command.stateKey) is command:
+					del pending[command.stateKey]
+			if not pending:
+				self._pendingCommands.pop(dev.id, None)
+		if failed:
+			status = u"failed"
+		elif pending:
+			status = u"pending"
+		else:
+			status = u"confirmed"
+		return states + [(u"lastCommandStatus", status)]
+
+	def _hasPendingCommands(self, dev):
+		with self._pendingCommandsLock:
+			return bool(self._pendingCommands.get(dev.id))
+
+	# The Nest heat/cool mode currently shown for a device, including any pending change.
+	def _currentHeatCoolMode(self, dev):
+		return NEST_HEAT_COOL_MAP.get(_lookupActionStrFromHvacMode(dev.states["hvacOperationMode"]))
+
+	# The full precision range setpoint for a device, including any pending change, so
+	# the setpoint that isn't being changed goes back to the Nest exactly as it was.
+	def _currentRangeSetpoint(self, dev, nest, stateKey):
+		with self._pendingCommandsLock:
+			command = self._pendingCommands.get(dev.id, dict()).get(stateKey)
+		if command is not None:
+			return command.target
+		snapshot = nest.last_snapshot()
+		if snapshot is None:
+			return dev.states[stateKey]
+		return snapshot.range_low if stateKey == u"setpointHeat" else snapshot.range_high
+
+	######################
+	# Temperatures are kept at full precision and only rounded (to the step
+	# chosen in the plugin's Configure... dialog) when they are shown in Indigo.
+	######################
+	def _applyDisplayPrefs(self, prefs):
+		try:
+			self._tempRounding = max(float(prefs.get("temperatureRounding", NEST_DISPLAY_ROUNDING)), 0.01)
+		except (TypeError, ValueError):
+			self._tempRounding = NEST_DISPLAY_ROUNDING
+
+	def _displayTemp(self, temp):
+		return round(round(temp / self._tempRounding) * self._tempRounding, 2)
+
+	# How far a temperature shown in Indigo may be from an action's setpoint and still confirm it
+	def _tempTolerance(self):
+		return max(self._tempRounding / 2.0, NEST_TEMP_TOLERANCE)
+
+	######################
+	# Bulk actions change several thermostats at once. Every device's change
+	# is started as usual (shown as pending, confirmed by later polls), but the
+	# changes are queued together by one worker job per Nest.com account, so
+	# changes to the same bucket (e.g. the away state of a structure) go out as
+	# one request and different buckets are written in parallel. The action
+	# waits for those requests, about one round trip, and returns a summary.
+	######################
+	def _bulkDevices(self, props):
+		devs = []
+		for devId in props.get(u"devices", []):
+			try:
+				devs.append(indigo.devices[int(devId)])
+			except (KeyError, ValueError):
+				pass
+		return devs
+
+	# Runs on a command worker: queues the changes for one account's devices.
+	def _queueBulkCommands(self, commands):
+		sent = []
+		for (dev, command) in commands:
+			command.sentAt = None
+			command.attempts += 1
+			try:
+				future = command.send()
+			except Exception as e:
+				command.error = e
+				self._pollSoon(dev.id)
+				continue
+			future.add_done_callback(lambda future, devId=dev.id, command=command: self._commandSent(devId, command, future))
+			sent.append(future)
+		return sent
+
+	# Starts the change made by start(dev) (which returns the PendingCommand, or None if it
+	# can't be made) on every device and returns a dictionary of device name to result right
+	# away, without waiting for Nest.com. The summary is logged once every request has finished.
+	def _startBulkCommands(self, description, devs, start):
+		results = dict()
+		accounts = dict()
+		devCommands = []
+		queuedCommands = set()
+		for dev in devs:
+			nest = self._nestForDeviceId(dev.id)
+			command = start(dev) if nest is not None else None
+			if command is None:
+				results[dev.name] = u"failed: not started" if nest is None else u"failed"
+				continue
+			devCommands.append((dev, command))
+			if command.attempts == 0 and command not in queuedCommands:
+				# Changes shared by several devices (a structure's away state) are sent once
+				queuedCommands.add(command)
+				accounts.setdefault(nest.get_session(), []).append((dev, command))
+
+		bulk = BulkAction(description, devCommands, dict(results), len(accounts))
+		for commands in accounts.values():
+			queued = self._commandWorkers.submit(self._queueBulkCommands, commands)
+			queued.add_done_callback(lambda queued: self._bulkQueued(bulk, queued))
+		if not accounts:
+			self._logBulkResults(bulk)
+		for (dev, command) in devCommands:
+			results[dev.name] = u"pending"
+		return results
+
+	# Called on a worker thread once an account's changes have been queued.
+	def _bulkQueued(self, bulk, queued):
+		try:
+			sent = queued.result()
+		except Exception:
+			# Each command's own error is reported in the summary
+			sent = []
+		bulk.add(len(sent))
+		for future in sent:
+			future.add_done_callback(lambda future: self._bulkSent(bulk))
+		self._bulkSent(bulk)
+
+	# Called on a worker thread as each request finishes; the last one logs the summary.
+	def _bulkSent(self, bulk):
+		if bulk.add(-1):
+			self._logBulkResults(bulk)
+
+	def _logBulkResults(self, bulk):
+		NEST_METRICS.observe("bulk_action", time.time() - bulk.started)
+		results = bulk.results
+		for (dev, command) in bulk.devCommands:
+			if command.error is not None:
+				results[dev.name] = u"failed: %s" % command.error
+			elif command.sentAt is not None:
+				results[dev.name] = u"sent"
+			else:
+				results[dev.name] = u"pending"
+		counts = dict()
+		for result in results.values():
+			status = result.split(u":")[0]
+			counts[status] = counts.get(status, 0) + 1
+		indigo.server.log(u"bulk %s: %s" % (bulk.description, u", ".join([u"%d %s" % (count, kind) for (kind, count) in sorted(counts.items())]) or u"no thermostats"),
+						  isError=u"failed" in counts)
+		for (name, result) in sorted(results.items()):
+			if result.startswith(u"failed"):
+				indigo.server.log(u"  \"%s\" %s" % (name, result), isError=True)
 
 	######################
 	# Process action request from Indigo Server to change main thermostat's main mode.
-	def _handleChangeHvacModeAction(self, dev, newHvacMode):
+	def _handleChangeHvacModeAction(self, dev, newHvacMode, dispatch=True):
 		# Command hardware module (dev) to change the thermostat mode here:
-		
-		sendSuccess=self._myNest[dev.pluginProps["address"]].set_heat_cool_mode(_lookupActionStrFromHvacMode(newHvacMode))
-
+		nest = self._myNest[dev.pluginProps["address"]]
 		actionStr = _lookupActionStrFromHvacMode(newHvacMode)
 
-		if sendSuccess:
-			# If success then log that the command was successfully sent.
-			indigo.server.log(u"sent \"%s\" mode change to %s" % (dev.name, actionStr))
-
-			# And then tell the Indigo Server to update the state.
-			dev.updateStateOnServer("hvacOperationMode", newHvacMode)
+		if actionStr in NEST_HEAT_COOL_MAP:
+			return self._startCommand(dev, u"hvacOperationMode", newHvacMode, u"mode change to %s" % actionStr,
+									  lambda: nest.queue_heat_cool_mode(actionStr), dispatch=dispatch)
 		else:
 			# Else log failure but do NOT update state on Indigo Server.
 			indigo.server.log(u"send \"%s\" mode change to %s failed" % (dev.name, actionStr), isError=True)
@@ -569,80 +3799,599 @@ class Plugin(indigo.PluginBase):
 	# Process action request from Indigo Server to change thermostat's fan mode.
 	def _handleChangeFanModeAction(self, dev, newFanMode):
 		# Command hardware module (dev) to change the fan mode here:
-		sendSuccess = self._myNest[dev.pluginProps["address"]].set_fan_mode(_lookupActionStrFromFanMode(newFanMode))		# Set to False if it failed.
+		nest = self._myNest[dev.pluginProps["address"]]
 		actionStr = _lookupActionStrFromFanMode(newFanMode)
-		if sendSuccess:
-			# If success then log that the command was successfully sent.
-			indigo.server.log(u"sent \"%s\" fan mode change to %s" % (dev.name, actionStr))
 
-			# And then tell the Indigo Server to update the state.
-			dev.updateStateOnServer("hvacFanMode", newFanMode)
+		if actionStr in NEST_FAN_MAP:
+			self._startCommand(dev, u"hvacFanMode", newFanMode, u"fan mode change to %s" % actionStr,
+							   lambda: nest.queue_fan_mode(actionStr))
 		else:
 			# Else log failure but do NOT update state on Indigo Server.
 			indigo.server.log(u"send \"%s\" fan mode change to %s failed" % (dev.name, actionStr), isError=True)
 
 	######################
 	# Process action request from Indigo Server to change a cool/heat setpoint.
-	def _handleChangeSetpointAction(self, dev, newSetpoint, logActionName, stateKey):
+	def _handleChangeSetpointAction(self, dev, newSetpoint, logActionName, stateKey, dispatch=True):
 		if newSetpoint < 40.0:
 			newSetpoint = 40.0		# Arbitrary -- set to whatever hardware minimum setpoint value is.
 		elif newSetpoint > 95.0:
 			newSetpoint = 95.0		# Arbitrary -- set to whatever hardware maximum setpoint value is.
+		newSetpoint = float(newSetpoint)
 
-		sendSuccess = False
+		nest = self._myNest[dev.pluginProps["address"]]
+		# Use the mode and setpoints shown in Indigo, which include any changes still pending
+		heatCoolMode = self._currentHeatCoolMode(dev)
+		send = None
 		
 		if stateKey == u"setpointCool":
 			# Command hardware module (dev) to change the cool setpoint to newSetpoint here:
-			if (self._myNest[dev.pluginProps["address"]].get_heat_cool_mode()=="cool"):
-				sendSuccess=self._myNest[dev.pluginProps["address"]].set_target_temp(newSetpoint)
-			elif (self._myNest[dev.pluginProps["address"]].get_heat_cool_mode()=="heat"):
-				sendSuccess=False
-			elif (self._myNest[dev.pluginProps["address"]].get_heat_cool_mode()=="range"):
-				range_temps=self._myNest[dev.pluginProps["address"]].get_range_temps()
-				sendSuccess=self._myNest[dev.pluginProps["address"]].set_range_temps(range_temps['low'],newSetpoint)
+			if (heatCoolMode=="cool"):
+				send = lambda: nest.queue_target_temp(newSetpoint)
+			elif (heatCoolMode=="range"):
+				lowTemp = self._currentRangeSetpoint(dev, nest, u"setpointHeat")
+				send = lambda: nest.queue_range_temps(lowTemp, newSetpoint)
 		elif stateKey == u"setpointHeat":
 			# Command hardware module (dev) to change the heat setpoint to newSetpoint here:
-			if (self._myNest[dev.pluginProps["address"]].get_heat_cool_mode()=="cool"):
-				sendSuccess=False
-			elif (self._myNest[dev.pluginProps["address"]].get_heat_cool_mode()=="heat"):
-				sendSuccess=self._myNest[dev.pluginProps["address"]].set_target_temp(newSetpoint)
-			elif (self._myNest[dev.pluginProps["address"]].get_heat_cool_mode()=="range"):
-				range_temps=self._myNest[dev.pluginProps["address"]].get_range_temps()
-				sendSuccess=self._myNest[dev.pluginProps["address"]].set_range_temps(newSetpoint,range_temps['high'])
-
-		if sendSuccess:
-			# If success then log that the command was successfully sent.
-			indigo.server.log(u"sent \"%s\" %s to %.1f°" % (dev.name, logActionName, newSetpoint))
-
-			# And then tell the Indigo Server to update the state.
-			dev.updateStateOnServer(stateKey, newSetpoint)
+			if (heatCoolMode=="heat"):
+				send = lambda: nest.queue_target_temp(newSetpoint)
+			elif (heatCoolMode=="range"):
+				highTemp = self._currentRangeSetpoint(dev, nest, u"setpointCool")
+				send = lambda: nest.queue_range_temps(newSetpoint, highTemp)
+
+		if send is not None:
+			return self._startCommand(dev, stateKey, self._displayTemp(newSetpoint), u"%s to %.1f°" % (logActionName, newSetpoint),
+									  send, newSetpoint, self._tempTolerance(), dispatch)
 		else:
 			# Else log failure but do NOT update state on Indigo Server.
 			indigo.server.log(u"send \"%s\" %s to %.1f° failed" % (dev.name, logActionName, newSetpoint), isError=True)
 
 	########################################
+	######################
+	# History: every snapshot the polls already fetch is added to the device's
+	# NestHistory, which answers runtime and temperature questions without
+	# asking Nest.com.
+	######################
+	def _recordHistory(self, dev, snapshot):
+		history = self._history.get(dev.id)
+		if history is None:
+			history = self._history[dev.id] = NestHistory()
+		if snapshot.heat_cool_mode == "range":
+			(setpointCool, setpointHeat) = (snapshot.range_high, snapshot.range_low)
+		else:
+			setpointCool = snapshot.target_temp if snapshot.heat_cool_mode == "cool" else 0
+			setpointHeat = snapshot.target_temp if snapshot.heat_cool_mode == "heat" else 0
+		history.append(snapshot.timestamp, snapshot.temp, snapshot.humidity, setpointCool, setpointHeat,
+					   snapshot.heat_on, snapshot.ac_on, snapshot.fan_on, snapshot.away)
+
+	def _runtimeStates(self, dev, snapshot):
+		counter = self._runtimes.get(dev.id)
+		if counter is None:
+			counter = self._runtimes[dev.id] = NestRuntimeCounter()
+			# Carry on from the history after a restart (it doesn't hold this snapshot yet)
+			history = self._history.get(dev.id)
+			if history is not None:
+				counter.restore(history, snapshot.timestamp)
+		counter.update(snapshot.timestamp, snapshot.heat_on, snapshot.ac_on, snapshot.fan_on)
+		(heatCycles, coolCycles) = counter.cycles(snapshot.timestamp)
+		# Whole minutes, so a running thermostat updates these at most once a minute
+		return [(u"heatRuntimeToday", int(counter.heat_seconds // 60)),
+				(u"coolRuntimeToday", int(counter.cool_seconds // 60)),
+				(u"fanRuntimeToday", int(counter.fan_seconds // 60)),
+				(u"heatCyclesLastHour", heatCycles),
+				(u"coolCyclesLastHour", coolCycles),
+				(u"hvacState", counter.state),
+				(u"hvacStateMinutes", int(max(snapshot.timestamp - counter.state_since, 0) // 60))]
+
+	# Queues a save of the history file: the new samples are appended to its journal, or with
+	# compact (daily, or force) the whole file is rewritten. Returns the NestFuture of the save,
+	# or None if it isn't due or the last one is still being written.
+	def _saveHistory(self, now, force=False):
+		if self._historyPath is None or (not force and now < self._historyDue):
+			return None
+		if not force and self._historySave is not None and not self._historySave.done():
+			return None
+		self._historyDue = now + NEST_HISTORY_SAVE_INTERVAL
+		compact = force or now >= self._historyCompactDue
+		if compact:
+			self._historyCompactDue = now + NEST_HISTORY_COMPACT_INTERVAL
+		self._historySave = self._historyWriter.submit(self._writeHistory, list(self._history.items()), compact)
+		return self._historySave
+
+	# Runs on the history writer thread.
+	def _writeHistory(self, histories, compact):
+		try:
+			if compact:
+				self._historySaved = save_nest_history(self._historyPath, dict(histories))
+			else:
+				append_nest_history(self._historyPath, histories, self._historySaved)
+		except (IOError, OSError) as e:
+			self.errorLog(u"unable to save thermostat history to %s: %s" % (self._historyPath, e))
+
+	def _historyWindow(self, props):
+		# The last "hours" hours, or from "start" to "end" (seconds since the epoch) if given
+		end = float(props.get("end") or time.time())
+		start = props.get("start")
+		if start:
+			return (float(start), end)
+		return (end - float(props.get("hours") or 24) * 3600, end)
+
+	def _historySummary(self, devId, start, end):
+		history = self._history.get(devId)
+		if history is None:
+			return NestHistory().summary(start, end)
+		return history.summary(start, end)
+
+	def _applyConnectionPrefs(self, prefs):
+		try:
+			connectTimeout = float(prefs.get("connectTimeout", NEST_CONNECT_TIMEOUT))
+			readTimeout = float(prefs.get("readTimeout", NEST_READ_TIMEOUT))
+		except (TypeError, ValueError):
+			(connectTimeout, readTimeout) = (NEST_CONNECT_TIMEOUT, NEST_READ_TIMEOUT)
+		NEST_CONNECTION_POOL.set_timeouts(connectTimeout, readTimeout)
+
+	######################
+	# Traffic recording: while a traffic file is set, every request to Nest.com
+	# and the device starts and actions behind them are appended to it, to be
+	# played back offline by benchmarks/replay_traffic.py.
+	######################
+	def _applyRecordingPrefs(self, prefs):
+		path = prefs.get("trafficFile") or None
+		if path is not None:
+			path = os.path.expanduser(path)
+		if path == self._recordingPath:
+			return
+		self._stopRecording()
+		if path is None:
+			return
+		try:
+			self._recorder = NestRecordingTransport(path, NEST_TRANSPORT)
+		except (IOError, OSError) as e:
+			self.errorLog(u"unable to record Nest.com traffic to %s: %s" % (path, e))
+			return
+		self._recordingPath = path
+		set_nest_transport(self._recorder)
+		self._recordEvent("prefs", {"prefs":dict((key, value) for (key, value) in prefs.items()
+												  if key not in ("trafficFile", "metricsFile"))})
+		for dev in indigo.devices.iter("self"):
+			if dev.pluginProps.get("address") in self._myNest:
+				self._recordDevice(dev)
+		indigo.server.log(u"recording Nest.com traffic to %s" % path)
+
+	def _stopRecording(self):
+		if self._recorder is None:
+			return
+		if NEST_TRANSPORT is self._recorder:
+			set_nest_transport(NEST_CONNECTION_POOL)
+		self._recorder.close()
+		self._recorder = None
+		self._recordingPath = None
+
+	def _recordEvent(self, kind, values):
+		if self._recorder is not None:
+			self._recorder.note(kind, values)
+
+	def _recordDevice(self, dev):
+		self._recordEvent("device", {"device":dev.id, "name":dev.name,
+									 "props":dict((key, dev.pluginProps.get(key)) for key in ("username", "devicename", "devicelocation"))})
+
+	@staticmethod
+	def _enumName(enum, value):
+		# Indigo's enum values are only meaningful inside Indigo, so recordings keep their names
+		for name in dir(enum):
+			if not name.startswith("_") and getattr(enum, name) == value:
+				return name
+		return None
+
 	def startup(self):
 		self.debugLog(u"startup called")
+		self._applyConnectionPrefs(self.pluginPrefs)
+		self._applyDisplayPrefs(self.pluginPrefs)
+		self._applyRecordingPrefs(self.pluginPrefs)
+		self._sessionCachePath = os.path.join(indigo.server.getInstallFolderPath(), "Preferences", "Plugins",
+											self.pluginId + ".sessions.json")
+		restored = load_nest_sessions(self._sessionCachePath)
+		self.debugLog(u"restored %d Nest.com account(s) from %s" % (restored, self._sessionCachePath))
+		# Sessions only keep the status of the Nests they are told about, so tell them about
+		# every thermostat before the first download rather than one download per device
+		for dev in indigo.devices.iter("self"):
+			props = dev.pluginProps
+			if props.get("username") and props.get("devicename") and props.get("devicelocation"):
+				try:
+					get_nest_session(props["username"], props.get("password", "")).watch(props["devicename"], props["devicelocation"])
+				except Exception:
+					pass	# A password the account's session doesn't use; deviceStartComm reports it
+		self._historyPath = os.path.join(indigo.server.getInstallFolderPath(), "Preferences", "Plugins",
+										 self.pluginId + ".history.json")
+		self._history = load_nest_history(self._historyPath)
+		self._historySaved = dict((devId, history.last_time()) for (devId, history) in self._history.items())
+		self.debugLog(u"restored the history of %d thermostat(s) from %s" % (len(self._history), self._historyPath))
+
+	def closedPrefsConfigUi(self, valuesDict, userCancelled):
+		if not userCancelled:
+			self._applyConnectionPrefs(valuesDict)
+			self._applyDisplayPrefs(valuesDict)
+			self._applyRecordingPrefs(valuesDict)
 
 	def shutdown(self):
 		self.debugLog(u"shutdown called")
+		self._stopSubscribers()
+		self._pollWorkers.shutdown()
+		self._commandWorkers.shutdown()
+		self._saveSessionCache(time.time(), True)
+		saving = self._saveHistory(time.time(), True)
+		self._historyWriter.shutdown(NEST_HISTORY_SHUTDOWN_TIMEOUT)
+		if saving is not None and not saving.done():
+			self.errorLog(u"gave up waiting for the thermostat history to be saved to %s" % self._historyPath)
+		self._stopRecording()
+		NEST_CONNECTION_POOL.close()
+
+	def _saveSessionCache(self, now, force=False):
+		if self._sessionCachePath is None or (not force and now < self._sessionCacheDue):
+			return
+		self._sessionCacheDue = now + NEST_DISK_CACHE_SAVE_INTERVAL
+		try:
+			save_nest_sessions(self._sessionCachePath)
+		except (IOError, OSError) as e:
+			self.errorLog(u"unable to save Nest.com sessions to %s: %s" % (self._sessionCachePath, e))
+
+	########################################
+	# Subscribe mode: one thread per account holds a long-poll open against the
+	# Nest website and wakes runConcurrentThread when something changes.
+	######################
+	def _subscribeModeEnabled(self):
+		return bool(self.pluginPrefs.get("subscribeMode", False))
+
+	def _syncSubscribers(self):
+		sessions = dict()
+		if self._subscribeModeEnabled():
+			for nest in self._myNest.values():
+				sessions[nest.get_session()] = True
+		for session in list(self._subscribers.keys()):
+			if session not in sessions:
+				self._subscribers.pop(session).stop()
+		for session in sessions:
+			if session not in self._subscribers:
+				subscriber = NestSubscriber(session, self._subscriptionChanged, self._subscriptionFailed)
+				self._subscribers[session] = subscriber
+				subscriber.start()
+
+	def _stopSubscribers(self):
+		for subscriber in self._subscribers.values():
+			subscriber.stop()
+		self._subscribers = dict()
+
+	def _subscriptionChanged(self, session):
+		with self._changedSessionsLock:
+			self._changedSessions.add(session)
+		self._wakeEvent.set()
+
+	# Poll every device on an account whose subscription reported a change.
+	def _pollChangedSessions(self):
+		with self._changedSessionsLock:
+			changedSessions = self._changedSessions
+			self._changedSessions = set()
+		if not changedSessions:
+			return
+		for dev in indigo.devices.iter("self"):
+			nest = self._myNest.get(dev.pluginProps.get("address"))
+			if nest is not None and nest.get_session() in changedSessions:
+				self._scheduler.pollNow(dev.id)
+
+	# The account's cache is no longer current, so its devices are polled (downloading the status)
+	# now rather than at the next safety poll.
+	def _subscriptionFailed(self, session, error):
+		self.debugLog(u"subscription failed, polling until it recovers: %s" % (error,))
+		self._subscriptionChanged(session)
+
+	def _subscribersHealthy(self):
+		if not self._subscribers:
+			return False
+		for subscriber in self._subscribers.values():
+			if not subscriber.is_healthy():
+				return False
+		return True
+
+	# Poll a device on the next pass of runConcurrentThread, e.g. after an action.
+	def _pollSoon(self, devId):
+		self._scheduler.pollNow(devId)
+		self._wakeEvent.set()
+
+	# Sleep until a subscriber reports a change, a poll finishes, Indigo stops the
+	# thread (see stopConcurrentThread) or the timeout passes.
+	def _waitForWake(self, timeout):
+		if self.stopThread:
+			raise self.StopThread()
+		self._wakeEvent.wait(timeout)
+		self._wakeEvent.clear()
+		if self.stopThread:
+			raise self.StopThread()
+
+	def stopConcurrentThread(self):
+		indigo.PluginBase.stopConcurrentThread(self)
+		self._wakeEvent.set()
+
+	########################################
+	def _prefInterval(self, key, default):
+		try:
+			return max(float(self.pluginPrefs.get(key, default)), 1.0)
+		except (TypeError, ValueError):
+			return default
+
+	# Choose how long to wait before polling a device again based on what it's doing.
+	def _pollInterval(self, dev, snapshot, nest):
+		# Polls slow down as the account's request budget runs low, leaving it to actions
+		factor = nest.get_session().get_limiter().poll_interval_factor()
+		if (snapshot.target_change_pending or snapshot.heat_on or snapshot.ac_on or snapshot.fan_on or
+			self._hasPendingCommands(dev)):
+			return self._prefInterval("pollIntervalActive", NEST_POLL_INTERVAL) * factor
+		if self._subscribersHealthy():
+			# Nest.com reports changes to us, so this is just a safety poll
+			return NEST_SUBSCRIBE_POLL_INTERVAL
+		if snapshot.away:
+			return self._prefInterval("pollIntervalAway", NEST_POLL_INTERVAL_AWAY) * factor
+		return self._prefInterval("pollIntervalIdle", NEST_POLL_INTERVAL_IDLE) * factor
+
+	########################################
+	# Poll cycle: due devices are grouped by account and each account is read
+	# on the worker pool, so a slow or dead account never holds up the others.
+	# Results are pushed to the Indigo Server from runConcurrentThread.
+	######################
+	@staticmethod
+	def _readSnapshots(nests):
+		results = []
+		for (devId, nest) in nests:
+			try:
+				results.append((devId, nest, nest.snapshot(), None))
+			except Exception as e:
+				results.append((devId, nest, None, e))
+		return results
+
+	def _startPolls(self, now):
+		accounts = dict()
+		for devId in self._scheduler.popDue(now):
+			try:
+				dev = indigo.devices[devId]
+			except KeyError:
+				continue
+			nest = self._myNest.get(dev.pluginProps.get("address"))
+			if dev.enabled and nest is None and devId in self._startRetries:
+				if devId not in self._startsInFlight:
+					props = dev.pluginProps
+					future = self._pollWorkers.submit(self._connect, props)
+					future.add_done_callback(lambda future: self._wakeEvent.set())
+					self._startsInFlight[devId] = (self._connectKey(props), future)
+				continue
+			if not dev.enabled or nest is None:
+				continue
+			session = nest.get_session()
+			if session in self._pollsInFlight:
+				self._pollsInFlight[session].deferred.add(devId)
+			else:
+				accounts.setdefault(session, []).append((devId, nest))
+		for (session, nests) in accounts.items():
+			future = self._pollWorkers.submit(self._readSnapshots, nests)
+			future.add_done_callback(lambda future: self._wakeEvent.set())
+			self._pollsInFlight[session] = PollTask(future, nests)
+
+	def _finishPolls(self, now):
+		for (session, task) in list(self._pollsInFlight.items()):
+			if task.future.done():
+				del self._pollsInFlight[session]
+				# Devices that came due while the poll ran were taken off the schedule, so they are
+				# put back first, whatever happens to the results
+				for devId in task.deferred:
+					self._scheduler.requeue(devId)
+				try:
+					results = task.future.result()
+				except Exception as e:
+					results = [(devId, nest, None, e) for (devId, nest) in task.nests]
+				for (devId, nest, snapshot, error) in results:
+					try:
+						self._finishPoll(devId, nest, snapshot, error, task.started)
+					except self.StopThread:
+						raise
+					except Exception as e:
+						# Every polled device must be rescheduled, or it is never polled again
+						NEST_METRICS.count("poll_failures")
+						self._scheduler.failed(devId)
+						self.errorLog(u"status update of device %d failed: %s" % (devId, e))
+				# Their own results may have put them back at a later time
+				for devId in task.deferred:
+					self._scheduler.pollNow(devId)
+			elif not task.timedOut and now > task.deadline:
+				# Leave the straggler running (its data is still used if it ever
+				# finishes) but back off its devices instead of waiting for it
+				task.timedOut = True
+				for (devId, nest) in task.nests:
+					self._scheduler.failed(devId)
+				self.errorLog(u"status update for %d thermostat(s) took longer than %d seconds" % (len(task.nests), NEST_POLL_DEADLINE))
+
+	def _finishPoll(self, devId, nest, snapshot, error, started):
+		try:
+			dev = indigo.devices[devId]
+		except KeyError:
+			return
+		if self._myNest.get(dev.pluginProps.get("address")) is not nest:
+			return		# Communication was stopped (or restarted) while polling
+		breaker = nest.get_session().get_breaker()
+		if isinstance(error, NestRateLimitedError):
+			# Not a failure: the account's request budget is being kept for actions
+			self._scheduler.succeeded(devId, max(error.retry_in, self._prefInterval("pollIntervalActive", NEST_POLL_INTERVAL)))
+			self.debugLog(u"\"%s\" status update postponed: %s" % (dev.name, error))
+			return
+		if error is not None:
+			NEST_METRICS.count("poll_failures")
+			if breaker.get_state() != NEST_BREAKER_CLOSED:
+				self._showOffline(dev, nest, error)
+				return
+			self._scheduler.failed(devId)
+			self.errorLog(u"\"%s\" status update failed: %s" % (dev.name, error))
+			return
+		self._showOnline(dev, nest)
+		try:
+			self._refreshStatesFromHardware(dev, False, False, snapshot)
+			self._shareAwayState(dev, nest, snapshot.away)
+		except Exception as e:
+			NEST_METRICS.count("poll_failures")
+			self._scheduler.failed(devId)
+			self.errorLog(u"\"%s\" status update failed: %s" % (dev.name, e))
+		else:
+			# From the start of the account's poll until this device's states were pushed
+			NEST_METRICS.observe("poll_cycle", time.time() - started, dev.name)
+			self._scheduler.succeeded(devId, self._pollInterval(dev, snapshot, nest))
+
+	######################
+	# While an account's circuit breaker is open its devices keep their last
+	# known states, marked offline with their age, and are polled again when
+	# the breaker lets a probe through. The outage is logged once per account.
+	######################
+	def _showOffline(self, dev, nest, error):
+		session = nest.get_session()
+		if session not in self._offlineSessions:
+			self._offlineSessions.add(session)
+			self.errorLog(u"Nest.com isn't answering for %s (%s); showing the last known states until it does" %
+						  (dev.pluginProps.get("username"), error))
+		snapshot = nest.last_snapshot()
+		if snapshot is not None:
+			# Also lets pending actions time out
+			self._refreshStatesFromHardware(dev, False, False, snapshot, online=False)
+		else:
+			self._updateChangedStates(dev, [(u"online", False)])
+		self._scheduler.succeeded(dev.id, max(session.get_breaker().seconds_until_probe(),
+											  self._prefInterval("pollIntervalActive", NEST_POLL_INTERVAL)))
+
+	def _showOnline(self, dev, nest):
+		session = nest.get_session()
+		if session in self._offlineSessions:
+			self._offlineSessions.discard(session)
+			indigo.server.log(u"Nest.com is answering again for %s" % dev.pluginProps.get("username"))
+
+	# Time until the next device is due or the next running poll passes its deadline.
+	def _secondsUntilNextEvent(self, now):
+		timeout = self._scheduler.secondsUntilNext(now)
+		for task in self._pollsInFlight.values():
+			if not task.timedOut:
+				untilDeadline = max(task.deadline - now, 0)
+				if timeout is None or untilDeadline < timeout:
+					timeout = untilDeadline
+		if timeout is None:
+			timeout = NEST_POLL_INTERVAL
+		if self.pluginPrefs.get("metricsFile"):
+			timeout = min(timeout, max(self._metricsFileDue - now, 0))
+		return timeout
 
 	########################################
+	# One pass of runConcurrentThread, without the wait for the next event
+	def _runOnce(self):
+		try:
+			self._syncSubscribers()
+			self._pollChangedSessions()
+			self._finishPolls(time.time())
+			self._finishStarts()
+			self._startPolls(time.time())
+			self._writeMetricsFile(time.time())
+			self._saveSessionCache(time.time())
+			self._saveHistory(time.time())
+		except self.StopThread:
+			raise
+		except Exception as e:
+			# Keep going: one bad device or account mustn't stop updates for the others
+			self.errorLog(u"error while updating thermostats: %s" % e)
+
 	def runConcurrentThread(self):
 		try:
 			while True:
-				for dev in indigo.devices.iter("self"):
-					if not dev.enabled:
-						continue
+				self._runOnce()
 
-					# Plugins that need to poll out the status from the thermostat
-					# could do so here, then broadcast back the new values to the
-					# Indigo Server.
-					self._refreshStatesFromHardware(dev, False, False)
-
-				self.sleep(3)
+				# Sleep until a device is due, a poll finishes or a subscription reports a change
+				timeout = self._secondsUntilNextEvent(time.time())
+				if timeout > 0:
+					self._waitForWake(timeout)
 		except self.StopThread:
 			pass	# Optionally catch the StopThread exception and do any needed cleanup.
+		self._stopSubscribers()
+
+	########################################
+	# Metrics: timings and counters from NEST_METRICS plus the connection pool
+	# and write queue counters, shown by the Dump Metrics menu item and, if a
+	# metrics file is set, appended to it as one JSON line every minute.
+	######################
+	def _collectMetrics(self):
+		stats = NEST_METRICS.get_stats()
+		stats["time"] = time.time()
+		stats["connections"] = NEST_CONNECTION_POOL.get_stats()
+		writes = {"queued": 0, "sent": 0}
+		# Requests sent in the last minute against the limit, over every account
+		budget = {"used": 0, "limit": 0, "available": 0}
+		with NEST_SESSIONS_LOCK:
+			sessions = list(NEST_SESSIONS.values())
+		for session in sessions:
+			for (key, value) in session.get_write_stats().items():
+				writes[key] = writes.get(key, 0) + value
+			for (key, value) in session.get_limiter().get_stats().items():
+				budget[key] += value
+		stats["writes"] = writes
+		stats["budget"] = budget
+		stats["devices"] = len(self._myNest)
+		stats["accountsOffline"] = len(self._offlineSessions)
+		return stats
+
+	def _writeMetricsFile(self, now):
+		path = self.pluginPrefs.get("metricsFile")
+		if not path or now < self._metricsFileDue:
+			return
+		self._metricsFileDue = now + NEST_METRICS_FILE_INTERVAL
+		path = os.path.expanduser(path)
+		try:
+			if os.path.exists(path) and os.path.getsize(path) > NEST_METRICS_FILE_MAX_BYTES:
+				os.rename(path, path + ".1")
+			with open(path, "a") as metricsFile:
+				metricsFile.write(json.dumps(self._collectMetrics(), sort_keys=True) + "\n")
+		except (IOError, OSError) as e:
+			self.errorLog(u"unable to write metrics to %s: %s" % (path, e))
+
+	def dumpMetrics(self):
+		stats = self._collectMetrics()
+		indigo.server.log(u"metrics for %d thermostat(s) over the last %.1f minutes" % (stats["devices"], (stats["time"] - stats["since"]) / 60.0))
+		if stats["accountsOffline"]:
+			indigo.server.log(u"  %d Nest.com account(s) not answering" % stats["accountsOffline"])
+		for (name, timing) in sorted(stats["timings"].items()):
+			indigo.server.log(u"  %s: %d, mean %.1f ms, p50 %.1f ms, p90 %.1f ms, p99 %.1f ms, max %.1f ms" %
+					(name, timing["count"], timing["mean"] * 1000, timing["p50"] * 1000,
+					 timing["p90"] * 1000, timing["p99"] * 1000, timing["max"] * 1000))
+		for (name, value) in sorted(stats["counters"].items()):
+			indigo.server.log(u"  %s: %d" % (name, value))
+		for group in ("connections", "writes", "budget"):
+			indigo.server.log(u"  %s: %s" % (group, u", ".join([u"%s %d" % item for item in sorted(stats[group].items())])))
+
+	def showHistory(self, valuesDict, typeId):
+		try:
+			(start, end) = self._historyWindow(valuesDict)
+		except (TypeError, ValueError):
+			indigo.server.log(u"history: enter the number of hours to show", isError=True)
+			return (False, valuesDict)
+		hours = (end - start) / 3600.0
+		for dev in sorted(indigo.devices.iter("self"), key=lambda dev: dev.name):
+			summary = self._historySummary(dev.id, start, end)
+			if summary["averageTemp"] is None:
+				indigo.server.log(u"\"%s\" has no history for the last %g hours" % (dev.name, hours))
+				continue
+			indigo.server.log(u"\"%s\" over the last %g hours (%.1f recorded): heat %.2f h, cool %.2f h, fan %.2f h, "
+							  u"temperature %.1f° (%.1f° to %.1f°), humidity %.0f%%" %
+							  (dev.name, hours, summary["hours"], summary["heatHours"], summary["coolHours"], summary["fanHours"],
+							   summary["averageTemp"], summary["minTemp"], summary["maxTemp"], summary["averageHumidity"]))
+		return (True, valuesDict)
+
+	def validateMenuConfigUi(self, valuesDict, typeId, menuId):
+		errorDict = indigo.Dict()
+		try:
+			if float(valuesDict.get("hours")) <= 0:
+				errorDict["hours"] = u"Enter a number of hours greater than 0"
+		except (TypeError, ValueError):
+			errorDict["hours"] = u"Enter a number of hours"
+		if errorDict:
+			return (False, valuesDict, errorDict)
+		return (True, valuesDict)
 
 	########################################
 	def validateDeviceConfigUi(self, valuesDict, typeId, devId):
@@ -653,7 +4402,14 @@ class Plugin(indigo.PluginBase):
 		errorDict=indigo.Dict()
 
 		try:
-			testNest=NestThermostat(username,password,devicename,devicelocation)
+			# Reuse the account session if the credentials match; never disturb it otherwise
+			testNest=NestThermostat(username,password,devicename,devicelocation,
+									get_nest_session(username,password,register=False))
+		except NestResolutionError as e:
+			# Logged in fine, but the name or location isn't on the account
+			field="devicename" if e.kind==u"Nest" else "devicelocation"
+			errorDict[field]=u"%s" % e
+			return (False,valuesDict,errorDict)
 		except:
 			errorDict["username"]="Couldn't connect. Is your username correct?"
 			errorDict["password"]="Couldn't connect. Is your password correct?"
@@ -685,23 +4441,112 @@ class Plugin(indigo.PluginBase):
 		devicename=dev.pluginProps["devicename"]
 		devicelocation=dev.pluginProps["devicelocation"]
 
+		# Thermostats on the same account share a single login and status download. If the
+		# account was restored from the session cache, start with the last known states and
+		# have the poll workers bring them up to date right away.
+		with self._lastStatesLock:
+			self._lastStates.pop(dev.id, None)
 		try:
-			self._myNest[dev.pluginProps["address"]]=NestThermostat(username,password,devicename,devicelocation)
-		except:
-			self._myNest=dict()
-			self._myNest[dev.pluginProps["address"]]=NestThermostat(username,password,devicename,devicelocation)
-		#self._myNest=NestThermostat(username,password,devicename,devicelocation)
-		self._refreshStatesFromHardware(dev, True, True)
+			(nest, snapshot) = self._connect(dev.pluginProps)
+		except (NestResolutionError, NestPasswordError) as e:
+			self.errorLog(u"\"%s\" can't be started: %s" % (dev.name, e))
+			return
+		except (NestUnavailableError, NestRateLimitedError, NestHTTPError, socket.error, httplib.HTTPException) as e:
+			self._startFailed(dev, e)
+			return
+		self._startComm(dev, nest, snapshot)
+
+	# The network part of starting a device: log in (or reuse the account's session) and read its states.
+	@staticmethod
+	def _connect(props):
+		nest = NestThermostat(props["username"],props["password"],props["devicename"],props["devicelocation"],allow_stale=True)
+		return (nest, nest.snapshot(allow_stale=True))
+
+	@staticmethod
+	def _connectKey(props):
+		return (props.get("username"), props.get("password"), props.get("devicename"), props.get("devicelocation"))
+
+	# Registers a connected device and pushes its first states.
+	def _startComm(self, dev, nest, snapshot):
+		self._startRetries.discard(dev.id)
+		self._myNest[dev.pluginProps["address"]]=nest
+		self._recordDevice(dev)
+		self._structureDevices.setdefault(self._structureKey(nest), set()).add(dev.id)
+		snapshot = self._refreshStatesFromHardware(dev, True, True, snapshot)
+		if nest.get_session().is_restored():
+			self._scheduler.succeeded(dev.id, 0)
+			self._wakeEvent.set()
+		else:
+			self._scheduler.succeeded(dev.id, self._pollInterval(dev, snapshot, nest))
+
+	######################
+	# A device whose account can't be reached when it starts is shown offline
+	# and started again from the poll loop, like a poll that failed: the poll
+	# workers connect and runConcurrentThread registers the device.
+	######################
+	def _startFailed(self, dev, error):
+		self._startRetries.add(dev.id)
+		self._updateChangedStates(dev, [(u"online", False)])
+		if isinstance(error, (NestUnavailableError, NestRateLimitedError)):
+			self._scheduler.succeeded(dev.id, max(error.retry_in, self._prefInterval("pollIntervalActive", NEST_POLL_INTERVAL)))
+			self.debugLog(u"\"%s\" start postponed: %s" % (dev.name, error))
+		else:
+			self._scheduler.failed(dev.id)
+			self.errorLog(u"\"%s\" can't be started yet: %s" % (dev.name, error))
+
+	# Finishes the connection attempts that are done, on runConcurrentThread like poll results.
+	def _finishStarts(self):
+		for (devId, (key, future)) in list(self._startsInFlight.items()):
+			if not future.done():
+				continue
+			del self._startsInFlight[devId]
+			if devId not in self._startRetries:
+				continue	# Communication was stopped (or started again) in the meantime
+			try:
+				dev = indigo.devices[devId]
+			except KeyError:
+				self._startRetries.discard(devId)
+				continue
+			if self._connectKey(dev.pluginProps) != key:
+				self._scheduler.requeue(devId)
+				continue	# Its settings changed while connecting; try again with the new ones
+			try:
+				(nest, snapshot) = future.result()
+				self._startComm(dev, nest, snapshot)
+			except self.StopThread:
+				raise
+			except Exception as e:
+				# Whatever went wrong, the device stays in line to be started again
+				self._startFailed(dev, e)
+
+	def deviceDeleted(self, dev):
+		indigo.PluginBase.deviceDeleted(self, dev)
+		self._history.pop(dev.id, None)
+		self._runtimes.pop(dev.id, None)
 
 	def deviceStopComm(self, dev):
 		# Called when communication with the hardware should be shutdown.
-		pass
+		self._scheduler.remove(dev.id)
+		self._startRetries.discard(dev.id)
+		with self._pendingCommandsLock:
+			self._pendingCommands.pop(dev.id, None)
+		nest = self._myNest.pop(dev.pluginProps.get("address"),None)
+		if nest is not None:
+			self._structureDevices.get(self._structureKey(nest), set()).discard(dev.id)
+		with self._lastStatesLock:
+			self._lastStates.pop(dev.id, None)
 
 	########################################
 	# Thermostat Action callback
 	######################
 	# Main thermostat action bottleneck called by Indigo Server.
 	def actionControlThermostat(self, action, dev):
+		if self._recorder is not None:
+			modeEnum = indigo.kFanMode if action.thermostatAction == indigo.kThermostatAction.SetFanMode else indigo.kHvacMode
+			self._recordEvent("thermostatAction", {"device":dev.id,
+								"thermostatAction":self._enumName(indigo.kThermostatAction, action.thermostatAction),
+								"actionMode":self._enumName(modeEnum, getattr(action, "actionMode", None)),
+								"actionValue":getattr(action, "actionValue", None)})
 		###### SET HVAC MODE ######
 		if action.thermostatAction == indigo.kThermostatAction.SetHvacMode:
 			self._handleChangeHvacModeAction(dev, action.actionMode)
@@ -747,17 +4592,94 @@ class Plugin(indigo.PluginBase):
 	########################################
 	# Custom Plugin Action callbacks (defined in Actions.xml)
 	######################
-	def setAwayStatus(self, pluginAction, dev):
-		awayStatus = pluginAction.props.get(u"away")
-		sendSuccess=self._myNest[dev.pluginProps["address"]].set_away_state(awayStatus)
+	def setAwayStatus(self, pluginAction, dev, dispatch=True):
+		if dispatch:
+			self._recordPluginAction(u"setAwayStatus", pluginAction, dev)
+		awayStatus = bool(pluginAction.props.get(u"away"))
+		nest = self._myNest[dev.pluginProps["address"]]
+		siblingIds = self._structureSiblingIds(dev.id, nest)
+		# The same change already on its way for the structure (e.g. from a scene setting
+		# away on every thermostat) is joined instead of sent again
+		with self._pendingCommandsLock:
+			commands = [self._pendingCommands.get(devId, dict()).get(u"away") for devId in [dev.id] + siblingIds]
+		for command in commands:
+			if command is not None and command.expected == awayStatus and command.error is None:
+				NEST_METRICS.count("away_writes_joined")
+				self._showCommand(dev, command)
+				return command
+		command = self._startCommand(dev, u"away", awayStatus, u"%s to %d" % ("set away status", awayStatus),
+									 lambda: nest.queue_away_state(awayStatus), dispatch=dispatch)
+		for devId in siblingIds:
+			try:
+				self._showCommand(indigo.devices[devId], command)
+			except KeyError:
+				pass
+		return command
 
-		if sendSuccess:
-			# If success then log that the command was successfully sent.
-			indigo.server.log(u"sent \"%s\" %s to %d" % (dev.name, "set away status", awayStatus))
+	def _recordPluginAction(self, callback, pluginAction, dev=None):
+		if self._recorder is not None:
+			props = dict((key, list(value) if isinstance(value, (list, indigo.List)) else value)
+						 for (key, value) in pluginAction.props.items())
+			self._recordEvent("pluginAction", {"callback":callback, "device":dev.id if dev is not None else None, "props":props})
 
-			# And then tell the Indigo Server to update the state:
-			dev.updateStateOnServer("away", awayStatus)
-		else:
-			# Else log failure but do NOT update state on Indigo Server.
-			indigo.server.log(u"send \"%s\" %s to %d failed" % (dev.name, "set away status", awayStatus), isError=True)
+	######################
+	# Bulk actions: each returns a dictionary of device name to "pending"
+	# (being sent) or "failed: <reason>" without waiting for Nest.com, and
+	# logs whether each was sent once every request has finished
+	######################
+	def bulkSetSetpoint(self, pluginAction):
+		self._recordPluginAction(u"bulkSetSetpoint", pluginAction)
+		newSetpoint = float(pluginAction.props.get(u"setpoint"))
+		setpointType = pluginAction.props.get(u"setpointType", u"target")
+		def start(dev):
+			if setpointType == u"target":
+				# Whichever setpoint the thermostat's mode uses
+				stateKey = {"cool":u"setpointCool", "heat":u"setpointHeat"}.get(self._currentHeatCoolMode(dev))
+				if stateKey is None:
+					indigo.server.log(u"send \"%s\" setpoint change failed: choose the heat or cool setpoint for a thermostat in %s mode" %
+									  (dev.name, _lookupActionStrFromHvacMode(dev.states["hvacOperationMode"])), isError=True)
+					return None
+			else:
+				stateKey = u"setpointCool" if setpointType == u"cool" else u"setpointHeat"
+			return self._handleChangeSetpointAction(dev, newSetpoint, u"change %s setpoint" % stateKey[len(u"setpoint"):].lower(),
+													stateKey, dispatch=False)
+		return self._startBulkCommands(u"setpoint change to %.1f°" % newSetpoint, self._bulkDevices(pluginAction.props), start)
+
+	def bulkSetHvacMode(self, pluginAction):
+		self._recordPluginAction(u"bulkSetHvacMode", pluginAction)
+		newHvacMode = map_to_indigo_hvac_mode[pluginAction.props.get(u"mode", u"off")]
+		return self._startBulkCommands(u"mode change to %s" % _lookupActionStrFromHvacMode(newHvacMode), self._bulkDevices(pluginAction.props),
+									   lambda dev: self._handleChangeHvacModeAction(dev, newHvacMode, dispatch=False))
+
+	def bulkSetAwayStatus(self, pluginAction):
+		self._recordPluginAction(u"bulkSetAwayStatus", pluginAction)
+		awayStatus = bool(pluginAction.props.get(u"away"))
+		return self._startBulkCommands(u"set away status to %d" % awayStatus, self._bulkDevices(pluginAction.props),
+									   lambda dev: self.setAwayStatus(pluginAction, dev, dispatch=False))
+
+	######################
+	# History actions for scripts (hidden from the action list): each returns
+	# a dictionary, for the last "hours" hours or from "start" to "end"
+	######################
+	def getHistorySummary(self, pluginAction, dev):
+		(start, end) = self._historyWindow(pluginAction.props)
+		return self._historySummary(dev.id, start, end)
+
+	def getHistorySamples(self, pluginAction, dev):
+		(start, end) = self._historyWindow(pluginAction.props)
+		history = self._history.get(dev.id)
+		return {"start":start, "end":end, "samples":history.samples(start, end) if history is not None else []}
+
+	def validateActionConfigUi(self, valuesDict, typeId, devId):
+		errorDict = indigo.Dict()
+		if typeId.startswith("bulk") and not valuesDict.get("devices"):
+			errorDict["devices"] = u"Choose at least one thermostat"
+		if typeId == "bulkSetSetpoint":
+			try:
+				float(valuesDict.get("setpoint"))
+			except (TypeError, ValueError):
+				errorDict["setpoint"] = u"Enter a temperature"
+		if errorDict:
+			return (False, valuesDict, errorDict)
+		return (True, valuesDict)
 
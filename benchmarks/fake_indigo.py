@@ -0,0 +1,171 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Just enough of the Indigo plugin API to load plugin.py outside of Indigo and
+# count what it sends to the Indigo Server.
+#
+# install() makes this module available as the 'indigo' built-in that Indigo
+# gives every plugin. Calls to updateStateOnServer() and updateStatesOnServer()
+# are counted per device and in total.
+
+import os
+import sys
+import time
+import tempfile
+import threading
+import __builtin__
+
+class _Enum:
+	def __init__(self, *names):
+		for (index, name) in enumerate(names):
+			setattr(self, name, index)
+
+kHvacMode = _Enum("Off", "Heat", "Cool", "HeatCool", "ProgramHeat", "ProgramCool", "ProgramHeatCool")
+kFanMode = _Enum("Auto", "AlwaysOn")
+kThermostatAction = _Enum("SetHvacMode", "SetFanMode", "SetCoolSetpoint", "SetHeatSetpoint",
+						"DecreaseCoolSetpoint", "IncreaseCoolSetpoint", "DecreaseHeatSetpoint",
+						"IncreaseHeatSetpoint", "RequestStatusAll", "RequestMode", "RequestEquipmentState",
+						"RequestTemperatures", "RequestHumidities", "RequestDeadbands", "RequestSetpoints")
+
+class Dict(dict):
+	pass
+
+class List(list):
+	pass
+
+class _Server:
+	def __init__(self):
+		self.log_lines = []
+		self.quiet = True
+		self.install_folder = None
+
+	def log(self, message, isError=False, type=None):
+		self.log_lines.append((message, isError))
+		if isError or not self.quiet:
+			sys.stderr.write((u"%s\n" % message).encode("utf8"))
+
+	def getInstallFolderPath(self):
+		# A private folder laid out like Indigo's, so files the plugin saves don't leak between runs
+		if self.install_folder is None:
+			self.install_folder = tempfile.mkdtemp(prefix="indigo")
+			os.makedirs(os.path.join(self.install_folder, "Preferences", "Plugins"))
+		return self.install_folder
+
+server = _Server()
+
+# Totals over every device, for the benchmark report
+_counterLock = threading.Lock()
+counters = {"update_calls": 0, "states_updated": 0}
+
+def _count(calls, states):
+	with _counterLock:
+		counters["update_calls"] += calls
+		counters["states_updated"] += states
+
+class Device:
+	def __init__(self, id, name, pluginProps, deviceTypeId="NestThermostat"):
+		self.id = id
+		self.name = name
+		self.deviceTypeId = deviceTypeId
+		self.enabled = True
+		self.pluginProps = Dict(pluginProps)
+		self.states = {u"temperatureInput1": 0, u"humidityInput1": 0, u"setpointCool": 0,
+					u"setpointHeat": 0, u"hvacOperationMode": kHvacMode.Off, u"hvacFanMode": kFanMode.Auto,
+					u"hvacCoolerIsOn": False, u"hvacHeaterIsOn": False, u"hvacFanIsOn": False,
+					u"away": False, u"lastCommandStatus": u""}
+		self.update_calls = 0
+		self.states_updated = 0
+
+	@property
+	def coolSetpoint(self):
+		return self.states[u"setpointCool"]
+
+	@property
+	def heatSetpoint(self):
+		return self.states[u"setpointHeat"]
+
+	def updateStateOnServer(self, key, value, **kwargs):
+		self.update_calls += 1
+		self.states_updated += 1
+		self.states[key] = value
+		_count(1, 1)
+
+	def updateStatesOnServer(self, states):
+		self.update_calls += 1
+		for state in states:
+			self.states_updated += 1
+			self.states[state["key"]] = state["value"]
+		_count(1, len(states))
+
+	def replacePluginPropsOnServer(self, pluginProps):
+		self.pluginProps = Dict(pluginProps)
+
+	def refreshFromServer(self):
+		pass
+
+	def stateListOrDisplayStateIdChanged(self):
+		pass
+
+class ThermostatAction:
+	"""What Indigo passes to actionControlThermostat()."""
+	def __init__(self, thermostatAction, actionMode=None, actionValue=None):
+		self.thermostatAction = thermostatAction
+		self.actionMode = actionMode
+		self.actionValue = actionValue
+
+class PluginAction:
+	"""What Indigo passes to the callbacks of the actions in Actions.xml."""
+	def __init__(self, props, deviceId=None):
+		self.props = Dict(props)
+		self.deviceId = deviceId
+
+class _Devices(dict):
+	def iter(self, filter=None):
+		return list(self.values())
+
+devices = _Devices()
+
+class PluginBase:
+	class StopThread(Exception):
+		pass
+
+	def __init__(self, pluginId, pluginDisplayName, pluginVersion, pluginPrefs):
+		self.pluginId = pluginId
+		self.pluginDisplayName = pluginDisplayName
+		self.pluginVersion = pluginVersion
+		self.pluginPrefs = pluginPrefs
+		self.stopThread = False
+
+	def __del__(self):
+		pass
+
+	def debugLog(self, message):
+		pass
+
+	def errorLog(self, message):
+		server.log(message, isError=True)
+
+	def stopConcurrentThread(self):
+		self.stopThread = True
+
+	def sleep(self, seconds):
+		if self.stopThread:
+			raise self.StopThread()
+		time.sleep(seconds)
+		if self.stopThread:
+			raise self.StopThread()
+
+def reset():
+	"""Forgets every device and zeroes the counters."""
+	devices.clear()
+	del server.log_lines[:]
+	with _counterLock:
+		for key in counters:
+			counters[key] = 0
+
+def install():
+	"""Makes this module the 'indigo' module seen by plugin.py."""
+	module = sys.modules[__name__]
+	sys.modules["indigo"] = module
+	__builtin__.indigo = module
+	return module
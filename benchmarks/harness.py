@@ -0,0 +1,176 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Runs the plugin outside of Indigo against the Nest stand-in, one poll cycle
+# at a time, and measures what each cycle costs.
+
+import os
+import sys
+import ssl
+import imp
+import json
+import time
+import random
+import shutil
+import resource
+import urllib2
+import tempfile
+import subprocess
+
+import fake_indigo
+import nest_standin
+
+BENCHMARK_DIR=os.path.dirname(os.path.abspath(__file__))
+PLUGIN_PATH=os.path.join(BENCHMARK_DIR,os.pardir,"Nest Thermostat.indigoPlugin","Contents","Server Plugin","plugin.py")
+
+def cpu_seconds():
+	"""Returns the user and system CPU time used by this process so far."""
+	usage=resource.getrusage(resource.RUSAGE_SELF)
+	return usage.ru_utime+usage.ru_stime
+
+def peak_rss_mb():
+	"""Returns the largest resident set size of this process so far, in megabytes."""
+	peak=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# Linux reports kilobytes, OS X bytes
+	if (sys.platform=="darwin"):
+		return peak/(1024.0*1024.0)
+	return peak/1024.0
+
+def current_rss_mb():
+	"""Returns the resident set size of this process now, in megabytes (the peak where unavailable)."""
+	try:
+		with open("/proc/self/statm") as statm:
+			return int(statm.read().split()[1])*resource.getpagesize()/(1024.0*1024.0)
+	except (IOError,OSError):
+		return peak_rss_mb()
+
+class StandIn:
+
+	def __init__(self, devices, accounts=1, latency=0.0, padding=0, token_lifetime=None, port=0, tls=False, hold=None):
+		"""Starts nest_standin.py in its own process, so its CPU time isn't counted as the plugin's.
+
+				Arguments:
+					devices - Number of thermostats
+					accounts - Number of Nest.com accounts the thermostats are spread over
+					latency - Time the stand-in waits before answering each request (in seconds)
+					padding - Extra bytes added to every shared bucket
+					token_lifetime - Time a login token is accepted for (in seconds), if limited
+					port - Port to listen on (0 picks a free one)
+					tls - If True, serve HTTPS with a throwaway self-signed certificate, which
+							context (an ssl.SSLContext) trusts
+					hold - Longest time a subscription is held open (in seconds), if not 20
+		"""
+		self.devices=devices
+		self.accounts=accounts
+		self.context=None
+		self._certdir=None
+		arguments=[]
+		if (tls):
+			self._certdir=tempfile.mkdtemp(prefix="nest_standin")
+			(certfile,keyfile)=nest_standin.make_certificate(self._certdir)
+			self.context=ssl.create_default_context(cafile=certfile)
+			arguments=["--cert",certfile,"--key",keyfile]
+		self._process=subprocess.Popen([sys.executable,os.path.join(BENCHMARK_DIR,"nest_standin.py"),
+				"--port",str(port),"--devices",str(devices),"--accounts",str(accounts),
+				"--latency",str(latency),"--padding",str(padding)]+arguments+
+				(["--token-lifetime",str(token_lifetime)] if token_lifetime else [])+
+				(["--hold",str(hold)] if hold is not None else []),stdout=subprocess.PIPE)
+		banner=self._process.stdout.readline()
+		self.base_url=banner.split()[3].rsplit("/user/login",1)[0]
+		self.login_url=self.base_url+"/user/login"
+
+	def _open(self,path,data=None):
+		if (self.context is not None):
+			return urllib2.urlopen(self.base_url+path,data,context=self.context).read()
+		return urllib2.urlopen(self.base_url+path,data).read()
+
+	def counts(self):
+		"""Returns the number of requests the stand-in has answered, by kind."""
+		return json.loads(self._open("/_bench/counts"))
+
+	def document_sizes(self):
+		"""Returns the size of each account's status document (in bytes), by user id."""
+		return json.loads(self._open("/_bench/sizes"))
+
+	def change_temperatures(self,temps):
+		"""Changes thermostat temperatures: temps maps thermostat index to a temperature in C."""
+		self._open("/_bench/temperature",json.dumps(temps))
+
+	def expire_tokens(self):
+		"""Makes the stand-in reject every token it has handed out."""
+		self._open("/_bench/expire","")
+
+	def stall_subscriptions(self,seconds):
+		"""Makes later subscriptions hang for seconds without an answer (0 ends it)."""
+		self._open("/_bench/stall",json.dumps({"seconds":seconds}))
+
+	def stop(self):
+		self._process.terminate()
+		self._process.wait()
+		if (self._certdir is not None):
+			shutil.rmtree(self._certdir,True)
+
+def load_plugin(login_url,context=None):
+	"""Loads a fresh copy of plugin.py (with its own sessions and connection pool) using fake_indigo.
+
+			Given an ssl.SSLContext (e.g. StandIn.context), its connections trust that instead
+			of the system's certificates.
+	"""
+	fake_indigo.install()
+	module=imp.load_source("nest_plugin_%d" % random.randint(0,1<<30),PLUGIN_PATH)
+	module.NEST_LOGIN_URL=login_url
+	if (context is not None):
+		module.NEST_CONNECTION_POOL=module.NestConnectionPool(context=context)
+		module.set_nest_transport(module.NEST_CONNECTION_POOL)
+	return module
+
+class PluginHarness:
+
+	def __init__(self, standin, prefs=None, managed=None):
+		"""Loads the plugin, creates a device for every thermostat of the stand-in and starts them.
+
+				Arguments:
+					standin - The StandIn to talk to
+					prefs - Plugin preferences (see PluginConfig.xml)
+					managed - Number of thermostats to create devices for, if not all of them
+		"""
+		fake_indigo.reset()
+		self.standin=standin
+		self.module=load_plugin(standin.login_url,standin.context)
+		self.plugin=self.module.Plugin("com.perceptiveautomation.indigoplugin.nest-thermostat",
+									"Nest Thermostat","1.1.0",fake_indigo.Dict(prefs or {}))
+		for index in range(standin.devices if managed is None else managed):
+			dev=fake_indigo.Device(1000+index,"Thermostat %d" % index,
+					{"username":"bench%d@example.com" % (index%standin.accounts),
+					"password":"secret","devicename":"Nest %d" % index,"devicelocation":"Home","address":""})
+			fake_indigo.devices[dev.id]=dev
+		self.plugin.startup()
+		for dev in fake_indigo.devices.values():
+			self.plugin.deviceStartComm(dev)
+		# Cycles run back to back, far faster than each account's request budget allows
+		for session in self.module.NEST_SESSIONS.values():
+			session._limiter=self.module.NestRateLimiter(rate=1e9,burst=1e9,reserve=0)
+
+	def poll_all(self):
+		"""Runs one poll cycle: every device is polled once, after the status cache expires.
+
+				Returns the time the cycle took (in seconds).
+		"""
+		plugin=self.plugin
+		for session in self.module.NEST_SESSIONS.values():
+			session.invalidate()
+		start=time.time()
+		for devId in fake_indigo.devices:
+			plugin._scheduler.pollNow(devId)
+		plugin._startPolls(time.time())
+		while plugin._pollsInFlight:
+			for task in list(plugin._pollsInFlight.values()):
+				task.future.wait()
+			plugin._finishPolls(time.time())
+			plugin._startPolls(time.time())
+		return time.time()-start
+
+	def stop(self):
+		for dev in fake_indigo.devices.values():
+			self.plugin.deviceStopComm(dev)
+		self.plugin.shutdown()
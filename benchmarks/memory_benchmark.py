@@ -0,0 +1,139 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Measures how the plugin's memory grows with the size of the Nest.com account,
+# while the number of thermostats it manages stays the same, e.g.
+#
+#	python benchmarks/memory_benchmark.py --account-sizes 10,100,500,1000 --managed 10
+#
+# Each account size runs in its own process. For every size the report shows
+# the size of the status document Nest.com sends, the memory the plugin keeps
+# for the account's status afterwards and the plugin process' resident memory
+# once the poll cycles are done. With --check it exits with status 1 unless the
+# kept status stays the same size and the resident memory stays within a bound
+# as the account grows (see bound_failures()).
+#
+# On Linux, glibc raises its mmap threshold after a large block is freed and
+# keeps the memory of each thread's arena, so the resident memory would measure
+# the allocator's high-water mark rather than what the plugin keeps. Each size
+# therefore runs with MALLOC_MMAP_THRESHOLD_ fixed, unless --native-malloc is
+# given (OS X, where Indigo runs, doesn't do this).
+
+import os
+import gc
+import sys
+import json
+import optparse
+import subprocess
+
+import harness
+
+def deep_size(obj,seen=None):
+	"""Returns the memory used by obj and everything it refers to, counting shared objects once."""
+	if (seen is None):
+		seen=set()
+	if (id(obj) in seen):
+		return 0
+	seen.add(id(obj))
+	size=sys.getsizeof(obj)
+	if (isinstance(obj,dict)):
+		size+=sum(deep_size(key,seen)+deep_size(value,seen) for (key,value) in obj.items())
+	elif (isinstance(obj,(list,tuple,set,frozenset))):
+		size+=sum(deep_size(item,seen) for item in obj)
+	elif (hasattr(obj,"__slots__")):
+		for cls in type(obj).__mro__:
+			for slot in getattr(cls,"__slots__",()):
+				if (hasattr(obj,slot)):
+					size+=deep_size(getattr(obj,slot),seen)
+	elif (hasattr(obj,"__dict__")):
+		size+=deep_size(obj.__dict__,seen)
+	return size
+
+def run_size(options):
+	"""Runs the benchmark for an account of options.account_size thermostats and returns its results."""
+	standin=harness.StandIn(options.account_size,1,0.0,options.padding)
+	try:
+		document=sum(standin.document_sizes().values())
+		bench=harness.PluginHarness(standin,{"subscribeMode":False},options.managed)
+		for cycle in range(options.cycles):
+			# Every thermostat reports a new temperature, so every shared bucket is downloaded again
+			standin.change_temperatures(dict((index,20.0+cycle*0.1) for index in range(options.account_size)))
+			bench.poll_all()
+		gc.collect()
+		cache=sum(deep_size(session.get_status_data()) for session in bench.module.NEST_SESSIONS.values())
+		rss=harness.current_rss_mb()
+		bench.stop()
+	finally:
+		standin.stop()
+	return {"account_size":options.account_size,"managed":min(options.managed,options.account_size),
+			"document_kb":document/1024.0,"cache_kb":cache/1024.0,
+			"cache_bytes_per_thermostat":float(cache)/options.account_size,
+			"rss_mb":rss,"peak_rss_mb":harness.peak_rss_mb()}
+
+def bound_failures(results,tolerance,rss_slack):
+	"""Returns a description of each account size whose memory grew past its bound.
+	
+			Compared with the smallest account, the kept status may be at most tolerance (a
+			fraction) larger, and the resident memory may grow by at most twice the status
+			document (which is held while it is read and parsed) plus rss_slack megabytes.
+	"""
+	smallest=min(results,key=lambda result: result["account_size"])
+	failures=[]
+	for result in results:
+		if (result["cache_kb"]>smallest["cache_kb"]*(1+tolerance)):
+			failures.append("%d thermostats: %.1f KB of status kept, %.1f KB for %d" % (result["account_size"],
+					result["cache_kb"],smallest["cache_kb"],smallest["account_size"]))
+		bound=2*result["document_kb"]/1024.0+rss_slack
+		if (result["rss_mb"]-smallest["rss_mb"]>bound):
+			failures.append("%d thermostats: resident memory grew %.1f MB (bound %.1f MB)" % (result["account_size"],
+					result["rss_mb"]-smallest["rss_mb"],bound))
+	return failures
+
+def print_report(results):
+	print "%10s %8s %12s %10s %14s %8s %10s" % ("thermostats","managed","document KB","cache KB",
+			"bytes/therm.","rss MB","peak MB")
+	for result in results:
+		print "%10d %8d %12.1f %10.1f %14.0f %8.1f %10.1f" % (result["account_size"],result["managed"],
+				result["document_kb"],result["cache_kb"],result["cache_bytes_per_thermostat"],
+				result["rss_mb"],result["peak_rss_mb"])
+
+def main():
+	parser=optparse.OptionParser(usage="%prog [options]")
+	parser.add_option("--account-sizes",default="10,100,500,1000",help="comma separated thermostat counts on the account")
+	parser.add_option("--managed",type="int",default=10,help="thermostats the plugin has devices for")
+	parser.add_option("--cycles",type="int",default=5,help="poll cycles run for each size")
+	parser.add_option("--padding",type="int",default=4096,help="extra bytes per shared bucket (the real ones are a few KB)")
+	parser.add_option("--json",dest="json_path",help="also write the results to this file")
+	parser.add_option("--check",action="store_true",help="exit with status 1 if memory grows past its bound with the account")
+	parser.add_option("--tolerance",type="float",default=0.25,help="fraction the kept status may grow by for --check")
+	parser.add_option("--rss-slack",type="float",default=2.0,help="MB resident memory may grow by for --check, on top of twice the document")
+	parser.add_option("--native-malloc",action="store_true",help="leave glibc's mmap threshold alone")
+	parser.add_option("--single",action="store_true",help=optparse.SUPPRESS_HELP)
+	(options,args)=parser.parse_args()
+
+	if options.single:
+		options.account_size=int(options.account_sizes)
+		json.dump(run_size(options),sys.stdout)
+		return
+
+	env=dict(os.environ)
+	if not options.native_malloc:
+		env.setdefault("MALLOC_MMAP_THRESHOLD_","131072")
+	results=[]
+	for size in [int(count) for count in options.account_sizes.split(",")]:
+		output=subprocess.check_output([sys.executable,os.path.abspath(__file__),"--single",
+				"--account-sizes",str(size),"--managed",str(options.managed),"--cycles",str(options.cycles),
+				"--padding",str(options.padding)],env=env)
+		results.append(json.loads(output))
+	print_report(results)
+	if options.json_path:
+		with open(options.json_path,"w") as resultsFile:
+			json.dump(results,resultsFile,indent=2,sort_keys=True)
+	if options.check:
+		failures=bound_failures(results,options.tolerance,options.rss_slack)
+		for failure in failures:
+			print "over bound: %s" % failure
+		sys.exit(1 if failures else 0)
+
+if __name__=="__main__":
+	main()
@@ -0,0 +1,332 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# A local stand-in for the parts of the Nest.com website the plugin uses, so the
+# plugin can be measured without Nest credentials or network delays.
+#
+# Serves /user/login, /v2/mobile/user.<id> (with ETags), /v2/put/<bucket> and
+# /v2/subscribe on 127.0.0.1, over plain HTTP or (with --tls) HTTPS using a
+# throwaway self-signed certificate. Every request is counted by kind, and every
+# TLS handshake as "tls_handshakes".
+# When run as a separate process (so its CPU time isn't charged to the plugin),
+# GET /_bench/counts returns the counters, GET /_bench/sizes the size of each
+# account's status document, POST /_bench/temperature changes
+# thermostat temperatures, POST /_bench/expire invalidates every token and
+# POST /_bench/stall makes subscriptions hang without an answer, like a
+# Nest.com that has stopped responding.
+
+import os
+import sys
+import ssl
+import time
+import socket
+import json
+import atexit
+import shutil
+import hashlib
+import tempfile
+import subprocess
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+class NestCloud:
+
+	def __init__(self, devices=1, accounts=1, latency=0.0, padding=0, hold=20, token_lifetime=None):
+		"""Initialize the stand-in's accounts, thermostats and request counters.
+
+				Arguments:
+					devices - Number of thermostats, spread evenly over the accounts
+					accounts - Number of Nest.com accounts (users 'bench0@example.com' and up)
+					latency - Time the server waits before answering each request (in seconds)
+					padding - Extra bytes added to every shared bucket, to match the size of the
+							status documents sent by the real website
+					hold - Longest time a subscription is held open (in seconds)
+					token_lifetime - Time a login token is accepted for (in seconds); by default
+							tokens never expire
+		"""
+		self.latency=latency
+		self.hold=hold
+		# Time subscriptions are held without any answer, when set by stall()
+		self.stall_seconds=0
+		self.token_lifetime=token_lifetime
+		# Tokens handed out by logins and when they expire
+		self._tokens=dict()
+		self.lock=threading.Lock()
+		self.changed=threading.Condition(self.lock)
+		self.counts=dict()
+		self.accounts=dict()
+		# The account holding each structure and thermostat
+		self._owners=dict()
+		for account in range(accounts):
+			self._owners["s%d" % account]="user%d" % account
+			self.accounts["user%d" % account]={
+				"structure":{"s%d" % account:{"name":"Home","away":False,"$version":1,"$timestamp":1}},
+				"shared":{},"device":{},"user":{"user%d" % account:{"name":"bench%d" % account}}}
+		for index in range(devices):
+			user_id="user%d" % (index%accounts)
+			serial="SER%05d" % index
+			status=self.accounts[user_id]
+			status["shared"][serial]={"name":"Nest %d" % index,"current_temperature":21.5,
+				"target_temperature":22.0,"target_temperature_type":"cool",
+				"target_temperature_high":24.0,"target_temperature_low":19.0,
+				"hvac_heater_state":False,"hvac_ac_state":False,"hvac_fan_state":False,
+				"target_change_pending":False,"padding":"x"*padding,"$version":1,"$timestamp":1}
+			status["device"][serial]={"current_humidity":40,"fan_mode":"auto","temperature_scale":"F",
+				"$version":1,"$timestamp":1}
+			self._owners[serial]=user_id
+
+	@staticmethod
+	def username(account):
+		"""Returns the Nest.com username of an account."""
+		return "bench%d@example.com" % account
+
+	@staticmethod
+	def device_name(index):
+		"""Returns the Nest name of a thermostat."""
+		return "Nest %d" % index
+
+	def count(self,kind):
+		with self.lock:
+			self.counts[kind]=self.counts.get(kind,0)+1
+
+	def get_counts(self):
+		"""Returns a copy of the request counters."""
+		with self.lock:
+			return dict(self.counts)
+
+	def login(self,user_id):
+		"""Returns a new token for the account and the expiry to report, as the Nest website does."""
+		with self.lock:
+			token="token-%s-%d" % (user_id,len(self._tokens))
+			expires_at=time.time()+(self.token_lifetime or 10*365*86400)
+			self._tokens[token]=(user_id,expires_at)
+		return (token,time.strftime("%a, %d-%b-%Y %H:%M:%S GMT",time.gmtime(expires_at)))
+
+	def authorized(self,header):
+		"""Returns True if the Authorization header carries a token that hasn't expired."""
+		with self.lock:
+			(user_id,expires_at)=self._tokens.get((header or "").replace("Basic ","",1),(None,0))
+		return time.time()<expires_at
+
+	def expire_tokens(self):
+		"""Makes every token handed out so far invalid, as if the Nest website had restarted."""
+		with self.lock:
+			self._tokens=dict()
+
+	def stall(self,seconds):
+		"""Makes later subscriptions wait seconds and then drop the connection without answering (0 ends it)."""
+		with self.lock:
+			self.stall_seconds=seconds
+
+	def _touch(self,bucket):
+		bucket["$version"]+=1
+		bucket["$timestamp"]=int(time.time()*1000)
+
+	def change_temperature(self,index,temp):
+		"""Changes a thermostat's current temperature, as if the room had warmed or cooled."""
+		serial="SER%05d" % index
+		with self.lock:
+			bucket=self.accounts[self._owners[serial]]["shared"][serial]
+			bucket["current_temperature"]=temp
+			self._touch(bucket)
+			self.changed.notifyAll()
+
+	def put(self,bucket_key,values):
+		(bucket_type,dot,key)=bucket_key.partition(".")
+		with self.lock:
+			bucket=self.accounts[self._owners[key]][bucket_type][key]
+			bucket.update(values)
+			self._touch(bucket)
+			self.changed.notifyAll()
+			return bucket["$version"]
+
+	def wait_for_change(self,keys,timeout):
+		"""Returns (key, bucket) for the first subscribed bucket whose version differs, or None."""
+		deadline=time.time()+timeout
+		with self.lock:
+			while True:
+				for key in keys:
+					(bucket_type,dot,bucket_id)=key["key"].partition(".")
+					bucket=self.accounts[self._owners[bucket_id]][bucket_type][bucket_id]
+					if (bucket["$version"]!=key.get("version")):
+						return (key["key"],dict(bucket))
+				remaining=deadline-time.time()
+				if (remaining<=0):
+					return None
+				self.changed.wait(remaining)
+
+class NestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	protocol_version="HTTP/1.1"
+	# Send each response in one write without waiting on Nagle's algorithm; otherwise delayed
+	# ACKs add up to 40 ms to responses and swamp what is being measured
+	wbufsize=-1
+	disable_nagle_algorithm=True
+
+	def log_message(self,*args):
+		pass
+
+	def _send(self,status,body="",headers=None):
+		self.send_response(status)
+		self.send_header("Content-Length",str(len(body)))
+		for (key,value) in (headers or {}).items():
+			self.send_header(key,value)
+		self.end_headers()
+		self.wfile.write(body)
+		self.wfile.flush()
+
+	def do_GET(self):
+		cloud=self.server.cloud
+		if (self.path=="/_bench/counts"):
+			return self._send(200,json.dumps(cloud.get_counts()))
+		if (self.path=="/_bench/sizes"):
+			with cloud.lock:
+				sizes=dict((user_id,len(json.dumps(status))) for (user_id,status) in cloud.accounts.items())
+			return self._send(200,json.dumps(sizes))
+		time.sleep(cloud.latency)
+		if (not cloud.authorized(self.headers.get("Authorization"))):
+			cloud.count("unauthorized")
+			return self._send(401)
+		if (self.path.startswith("/v2/mobile/user.")):
+			cloud.count("status")
+			user_id=self.path[len("/v2/mobile/user."):]
+			with cloud.lock:
+				body=json.dumps(cloud.accounts[user_id])
+			etag='"%s"' % hashlib.md5(body).hexdigest()
+			if (self.headers.get("If-None-Match")==etag):
+				cloud.count("status_not_modified")
+				return self._send(304,"",{"ETag":etag})
+			return self._send(200,body,{"ETag":etag,"Content-Type":"application/json"})
+		self._send(404)
+
+	def do_POST(self):
+		cloud=self.server.cloud
+		data=self.rfile.read(int(self.headers.get("Content-Length") or 0))
+		if (self.path=="/_bench/temperature"):
+			# {"<thermostat index>": <temperature in C>, ...}
+			for (index,temp) in json.loads(data).items():
+				cloud.change_temperature(int(index),temp)
+			return self._send(200)
+		if (self.path=="/_bench/expire"):
+			cloud.expire_tokens()
+			return self._send(200)
+		if (self.path=="/_bench/stall"):
+			cloud.stall(json.loads(data)["seconds"])
+			return self._send(200)
+		time.sleep(cloud.latency)
+		if (self.path!="/user/login" and not cloud.authorized(self.headers.get("Authorization"))):
+			cloud.count("unauthorized")
+			return self._send(401)
+		if (self.path=="/user/login"):
+			cloud.count("login")
+			username=urlparse.parse_qs(data).get("username",[""])[0]
+			user_id="user%s" % username[len("bench"):].split("@")[0]
+			if (user_id not in cloud.accounts):
+				return self._send(400,json.dumps({"error":"access_denied"}))
+			base="%s://%s:%d" % ((self.server.scheme,)+self.server.server_address)
+			(token,expires)=cloud.login(user_id)
+			return self._send(200,json.dumps({"urls":{"transport_url":base},"access_token":token,
+											"userid":user_id,"expires_in":expires}))
+		if (self.path.startswith("/v2/put/")):
+			cloud.count("put")
+			version=cloud.put(self.path[len("/v2/put/"):],json.loads(data))
+			return self._send(200,"",{"X-nl-skv-version":str(version)})
+		if (self.path=="/v2/subscribe"):
+			cloud.count("subscribe")
+			if (cloud.stall_seconds):
+				cloud.count("subscribe_stalled")
+				time.sleep(cloud.stall_seconds)
+				self.close_connection=1
+				return
+			change=cloud.wait_for_change(json.loads(data)["keys"],cloud.hold)
+			if (change is None):
+				return self._send(200)
+			(key,bucket)=change
+			headers={"X-nl-skv-key":key,"X-nl-skv-version":str(bucket.pop("$version")),
+					"X-nl-skv-timestamp":str(bucket.pop("$timestamp"))}
+			return self._send(200,json.dumps(bucket),headers)
+		self._send(404)
+
+class NestServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads=True
+	# The default backlog of 5 makes bursts of parallel connections (e.g. bulk actions) wait
+	# a second for the SYN to be retried
+	request_queue_size=128
+	scheme="http"
+	ssl_context=None
+
+	def finish_request(self,request,client_address):
+		# The handshake is done on the connection's own thread, so a slow one holds up nothing else
+		if (self.ssl_context is not None):
+			try:
+				request=self.ssl_context.wrap_socket(request,server_side=True)
+			except (ssl.SSLError,socket.error):
+				return
+			self.cloud.count("tls_handshakes")
+		BaseHTTPServer.HTTPServer.finish_request(self,request,client_address)
+
+def make_certificate(directory):
+	"""Writes a throwaway self-signed certificate for 127.0.0.1 to directory with the openssl tool.
+
+			Returns the paths of the certificate and its key.
+	"""
+	(certfile,keyfile,config)=[os.path.join(directory,name) for name in ("standin.crt","standin.key","openssl.cnf")]
+	with open(config,"w") as configFile:
+		configFile.write("[req]\ndistinguished_name=dn\nx509_extensions=ext\nprompt=no\n"
+						 "[dn]\nCN=127.0.0.1\n[ext]\nsubjectAltName=IP:127.0.0.1\n")
+	with open(os.devnull,"w") as devnull:
+		subprocess.check_call(["openssl","req","-x509","-newkey","rsa:2048","-nodes","-days","2",
+							   "-config",config,"-keyout",keyfile,"-out",certfile],stdout=devnull,stderr=devnull)
+	return (certfile,keyfile)
+
+def start(cloud,port=0,certfile=None,keyfile=None):
+	"""Serves a NestCloud on 127.0.0.1 from a background thread and returns the server.
+
+			The login URL to point the plugin at is '<scheme>://127.0.0.1:<port>/user/login',
+			where scheme is server.scheme and port is server.server_address[1]. Given a
+			certificate and its key, the server speaks HTTPS.
+	"""
+	server=NestServer(("127.0.0.1",port),NestHandler)
+	server.cloud=cloud
+	if (certfile is not None):
+		server.ssl_context=ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+		server.ssl_context.load_cert_chain(certfile,keyfile)
+		server.scheme="https"
+	thread=threading.Thread(target=server.serve_forever)
+	thread.daemon=True
+	thread.start()
+	return server
+
+if __name__=="__main__":
+	# Run the stand-in on its own, e.g. to point a development copy of the plugin at it
+	import optparse
+	parser=optparse.OptionParser(usage="%prog [options]")
+	parser.add_option("--port",type="int",default=8080,help="0 picks a free port")
+	parser.add_option("--devices",type="int",default=2)
+	parser.add_option("--accounts",type="int",default=1)
+	parser.add_option("--latency",type="float",default=0.0,help="seconds added to every request")
+	parser.add_option("--padding",type="int",default=0,help="extra bytes per shared bucket")
+	parser.add_option("--token-lifetime",type="float",help="seconds a login token is accepted for")
+	parser.add_option("--hold",type="float",default=20,help="longest time a subscription is held open (in seconds)")
+	parser.add_option("--tls",action="store_true",help="serve HTTPS with a throwaway self-signed certificate")
+	parser.add_option("--cert",help="certificate to serve HTTPS with (implies --tls)")
+	parser.add_option("--key",help="key of the --cert certificate")
+	(options,args)=parser.parse_args()
+	(certfile,keyfile)=(options.cert,options.key)
+	if (options.tls and certfile is None):
+		directory=tempfile.mkdtemp(prefix="nest_standin")
+		atexit.register(shutil.rmtree,directory,True)
+		(certfile,keyfile)=make_certificate(directory)
+	server=start(NestCloud(options.devices,options.accounts,options.latency,options.padding,
+						options.hold,options.token_lifetime),options.port,certfile,keyfile)
+	print "Nest stand-in on %s://127.0.0.1:%d/user/login (users bench0@example.com and up, any password)" % (
+			server.scheme,server.server_address[1])
+	if (certfile is not None):
+		print "Certificate: %s" % certfile
+	sys.stdout.flush()
+	try:
+		while True:
+			time.sleep(3600)
+	except KeyboardInterrupt:
+		sys.exit(0)
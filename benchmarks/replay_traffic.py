@@ -0,0 +1,226 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Plays a recording of the plugin's Nest.com traffic back through the plugin
+# offline and compares the requests it makes now with the recorded ones, e.g.
+#
+#	python benchmarks/replay_traffic.py traffic.jsonl --latency-scale 0.1 --check
+#
+# Recordings come from the "Record traffic to" setting in the plugin's
+# Configure... dialog, or from this script against the Nest stand-in:
+#
+#	python benchmarks/replay_traffic.py --record traffic.jsonl --devices 10 --seconds 120
+#
+# Playback creates the recorded devices, repeats the recorded actions and runs
+# the plugin's main loop (Plugin._runOnce(), what runConcurrentThread() does
+# between waits) on a clock that jumps straight to the next scheduled poll or
+# recorded action, so a day of traffic takes about as long as its requests do.
+# Requests are answered from the recording after their recorded time (times
+# --latency-scale); a request the recording has no answer left for gets the
+# last answer to the same URL again. The report shows the requests of each kind
+# in the recording and in the playback, requests that had to reuse an answer,
+# and the plugin's timings.
+#
+# Polls are timed from when the previous one finished, so a playback drifts a
+# little from the recording and can make a request more or fewer now and then;
+# --tolerance allows for that.
+
+import sys
+import json
+import time
+import random
+import optparse
+import threading
+
+import fake_indigo
+import harness
+
+PLUGIN_ID="com.johnemeryray.nestthermostat"
+
+class ReplayClock:
+	"""Stands in for the time module in plugin.py: time() runs at the real rate but can jump forward."""
+
+	def __init__(self, start):
+		self._offset=start-time.time()
+
+	def time(self):
+		return time.time()+self._offset
+
+	def advance_to(self,when):
+		"""Moves the clock forward to when (seconds since the epoch), unless it is already past it."""
+		now=self.time()
+		if (when>now):
+			self._offset+=when-now
+
+	def __getattr__(self,name):
+		return getattr(time,name)
+
+def record(options):
+	"""Runs the plugin against the Nest stand-in for options.seconds, recording its traffic."""
+	standin=harness.StandIn(options.devices,options.accounts,options.latency)
+	try:
+		bench=harness.PluginHarness(standin,{"subscribeMode":False,"trafficFile":options.record})
+		plugin=bench.plugin
+		thread=threading.Thread(target=plugin.runConcurrentThread)
+		thread.daemon=True
+		thread.start()
+		rng=random.Random(options.seed)
+		devices=sorted(fake_indigo.devices.values(),key=lambda dev: dev.id)
+		deadline=time.time()+options.seconds
+		while time.time()<deadline:
+			time.sleep(min(options.action_interval,max(deadline-time.time(),0)))
+			# Some rooms warm up or cool down, and someone changes a setpoint
+			changed=rng.sample(range(options.devices),max(int(round(options.devices*options.churn)),1))
+			standin.change_temperatures(dict((index,rng.uniform(18.0,26.0)) for index in changed))
+			dev=rng.choice(devices)
+			plugin.actionControlThermostat(fake_indigo.ThermostatAction(fake_indigo.kThermostatAction.SetCoolSetpoint,
+												actionValue=float(rng.randint(68,78))),dev)
+		plugin.stopConcurrentThread()
+		thread.join()
+		# Let the last actions finish so the recording holds their answers
+		_wait_until_idle(plugin)
+		bench.stop()
+	finally:
+		standin.stop()
+	print "recorded %d seconds of traffic for %d thermostat(s) to %s" % (options.seconds,options.devices,options.record)
+
+def _wait_until_idle(plugin,timeout=60):
+	# Polls and actions run on worker threads; let them finish before the clock moves on
+	deadline=time.time()+timeout
+	for task in list(plugin._pollsInFlight.values()):
+		task.future.wait(max(deadline-time.time(),0))
+	while time.time()<deadline:
+		with plugin._pendingCommandsLock:
+			commands=[command for commands in plugin._pendingCommands.values() for command in commands.values()]
+		if all(command.sentAt is not None or command.error is not None for command in commands):
+			return
+		time.sleep(0.005)
+
+def _fire(plugin,event):
+	kind=event["type"]
+	if (kind=="device"):
+		plugin.deviceStartComm(fake_indigo.devices[event["device"]])
+		return
+	dev=fake_indigo.devices.get(event.get("device"))
+	if (kind=="thermostatAction" and dev is not None):
+		modes=fake_indigo.kFanMode if event["thermostatAction"]=="SetFanMode" else fake_indigo.kHvacMode
+		plugin.actionControlThermostat(fake_indigo.ThermostatAction(
+				getattr(fake_indigo.kThermostatAction,event["thermostatAction"]),
+				getattr(modes,event["actionMode"]) if event.get("actionMode") else None,event.get("actionValue")),dev)
+	elif (kind=="pluginAction"):
+		callback=getattr(plugin,event["callback"])
+		action=fake_indigo.PluginAction(event["props"],dev.id if dev is not None else None)
+		if (dev is not None):
+			callback(action,dev)
+		elif (event.get("device") is None):
+			callback(action)
+
+def replay(path,options):
+	"""Plays a recording back through the plugin and returns the results as a dictionary."""
+	fake_indigo.reset()
+	module=harness.load_plugin("https://home.nest.com/user/login")
+	transport=module.NestReplayTransport(path,options.latency_scale)
+	module.set_nest_transport(transport)
+	(start,end)=transport.get_time_span()
+	if (start is None):
+		raise SystemExit("%s is empty" % path)
+	clock=ReplayClock(start)
+	module.time=clock
+	events=transport.get_events()
+	prefs=dict()
+	for event in events:
+		if (event["type"]=="prefs"):
+			prefs=event["prefs"]
+			break
+	pending=[event for event in events if event["type"] in ("device","thermostatAction","pluginAction")]
+	pending.sort(key=lambda event: event["time"])
+
+	# Indigo knows every device before the plugin starts, even though it starts them one by one
+	for event in pending:
+		if (event["type"]=="device" and event["device"] not in fake_indigo.devices):
+			props=dict(event["props"],password="replay",address="")
+			fake_indigo.devices[event["device"]]=fake_indigo.Device(event["device"],event["name"],props)
+	plugin=module.Plugin(PLUGIN_ID,"Nest Thermostat","1.1.0",fake_indigo.Dict(prefs))
+	wall=time.time()
+	cpu=harness.cpu_seconds()
+	plugin.startup()
+	while True:
+		while pending and pending[0]["time"]<=clock.time():
+			_fire(plugin,pending.pop(0))
+		plugin._runOnce()
+		_wait_until_idle(plugin)
+		plugin._runOnce()
+		now=clock.time()
+		when=now+plugin._secondsUntilNextEvent(now)
+		if pending:
+			when=min(when,pending[0]["time"])
+		if (when>end and not pending):
+			break
+		clock.advance_to(when)
+	for dev in fake_indigo.devices.values():
+		plugin.deviceStopComm(dev)
+	plugin.shutdown()
+
+	timings=dict((name,timing) for (name,timing) in module.NEST_METRICS.get_stats()["timings"].items() if "[" not in name)
+	return {"recording":path,"runs":transport.get_run_count(),"seconds_recorded":end-start,"wall_seconds":time.time()-wall,
+			"cpu_seconds":harness.cpu_seconds()-cpu,"requests":transport.get_request_counts(),
+			"missed":transport.get_stats()["missed"],"unused":transport.get_stats()["unused"],
+			"timings":timings,"errors":len([message for (message,isError) in fake_indigo.server.log_lines if isError])}
+
+def print_report(result):
+	print "%s: %.0f seconds of traffic played back in %.1f seconds (%.2f s CPU)" % (result["recording"],
+			result["seconds_recorded"],result["wall_seconds"],result["cpu_seconds"])
+	if (result["runs"]>1):
+		print "the file holds %d runs of the plugin; only the last was played back" % result["runs"]
+	print "%12s %10s %10s %10s" % ("requests","recorded","replayed","change")
+	for (kind,counts) in sorted(result["requests"].items()):
+		print "%12s %10d %10d %+10d" % (kind,counts["recorded"],counts["replayed"],counts["replayed"]-counts["recorded"])
+	print "%d request(s) reused a recorded answer, %d recorded answer(s) were not used, %d error(s) logged" % (
+			result["missed"],result["unused"],result["errors"])
+	print "%12s %8s %10s %10s %10s" % ("timing","count","p50 ms","p90 ms","max ms")
+	for (name,timing) in sorted(result["timings"].items()):
+		print "%12s %8d %10.1f %10.1f %10.1f" % (name,timing["count"],timing["p50"]*1000,timing["p90"]*1000,timing["max"]*1000)
+
+def regressions(result,tolerance):
+	"""Returns a description of each kind of request the playback made more of than the recording."""
+	found=[]
+	for (kind,counts) in sorted(result["requests"].items()):
+		# One extra request can come from timing alone (a poll just before or after a change)
+		if (counts["replayed"]>counts["recorded"]*(1+tolerance)+1):
+			found.append("%s: %d requests, %d recorded" % (kind,counts["replayed"],counts["recorded"]))
+	return found
+
+def main():
+	parser=optparse.OptionParser(usage="%prog [options] recording.jsonl | --record recording.jsonl [options]")
+	parser.add_option("--latency-scale",type="float",default=1.0,help="multiplies recorded response times (0 answers at once)")
+	parser.add_option("--check",action="store_true",help="exit with status 1 if the playback made more requests of a kind than the recording (beyond --tolerance)")
+	parser.add_option("--tolerance",type="float",default=0.1,help="fraction more requests of a kind allowed by --check, on top of one")
+	parser.add_option("--json",dest="json_path",help="also write the results to this file")
+	parser.add_option("--record",help="record the plugin's traffic against the Nest stand-in to this file instead")
+	parser.add_option("--devices",type="int",default=10,help="thermostats to record")
+	parser.add_option("--accounts",type="int",default=1,help="Nest.com accounts the thermostats are spread over")
+	parser.add_option("--seconds",type="float",default=60,help="time to record for")
+	parser.add_option("--action-interval",type="float",default=7,help="seconds between the setpoint changes made while recording")
+	parser.add_option("--latency",type="float",default=0.05,help="seconds the stand-in adds to every request while recording")
+	parser.add_option("--churn",type="float",default=0.1,help="fraction of thermostats whose temperature changes between actions")
+	parser.add_option("--seed",type="int",default=1)
+	(options,args)=parser.parse_args()
+
+	if options.record:
+		record(options)
+		return
+	if len(args)!=1:
+		parser.error("give the recording to play back")
+	result=replay(args[0],options)
+	print_report(result)
+	if options.json_path:
+		with open(options.json_path,"w") as resultsFile:
+			json.dump(result,resultsFile,indent=2,sort_keys=True)
+	if options.check:
+		found=regressions(result,options.tolerance)
+		for regression in found:
+			print "regression: %s" % regression
+		sys.exit(1 if found else 0)
+
+if __name__=="__main__":
+	main()
@@ -0,0 +1,114 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Measures the plugin's poll cycle against a local Nest stand-in for a range of
+# installation sizes, e.g.
+#
+#	python benchmarks/run_benchmarks.py --devices 1,10,50,100,200 --latency 0.05
+#
+# Each size runs in its own process so memory figures aren't carried over from
+# the size before. For every size the report shows the requests sent to the
+# Nest website per cycle, the cycle's wall and CPU time, the calls made to the
+# Indigo Server and the plugin process' peak memory.
+
+import os
+import sys
+import json
+import random
+import optparse
+import subprocess
+
+import fake_indigo
+import harness
+
+def run_size(options):
+	"""Runs the benchmark for options.devices thermostats and returns its results as a dictionary."""
+	standin=harness.StandIn(options.devices,options.accounts,options.latency,options.padding)
+	try:
+		cpu=harness.cpu_seconds()
+		before=standin.counts()
+		bench=harness.PluginHarness(standin,{"subscribeMode":False})
+		startup={"cpu":harness.cpu_seconds()-cpu,"requests":_difference(standin.counts(),before)}
+
+		rng=random.Random(options.seed)
+		walls=[]
+		cpus=[]
+		requests=dict()
+		update_calls=0
+		states_updated=0
+		for cycle in range(options.cycles):
+			# Some rooms warm up or cool down between polls
+			changed=rng.sample(range(options.devices),int(round(options.devices*options.churn)))
+			standin.change_temperatures(dict((index,rng.uniform(18.0,26.0)) for index in changed))
+
+			before=standin.counts()
+			updates=dict(fake_indigo.counters)
+			cpu=harness.cpu_seconds()
+			walls.append(bench.poll_all())
+			cpus.append(harness.cpu_seconds()-cpu)
+			for (kind,count) in _difference(standin.counts(),before).items():
+				requests[kind]=requests.get(kind,0)+count
+			update_calls+=fake_indigo.counters["update_calls"]-updates["update_calls"]
+			states_updated+=fake_indigo.counters["states_updated"]-updates["states_updated"]
+		errors=[message for (message,isError) in fake_indigo.server.log_lines if isError]
+		bench.stop()
+	finally:
+		standin.stop()
+
+	walls.sort()
+	return {"devices":options.devices,"accounts":options.accounts,"cycles":options.cycles,
+			"startup_cpu_ms":startup["cpu"]*1000,"startup_requests":startup["requests"],
+			"requests_per_cycle":dict((kind,float(count)/options.cycles) for (kind,count) in requests.items()),
+			"wall_ms":sum(walls)/len(walls)*1000,"wall_max_ms":walls[-1]*1000,
+			"cpu_ms":sum(cpus)/len(cpus)*1000,
+			"update_calls_per_cycle":float(update_calls)/options.cycles,
+			"states_per_cycle":float(states_updated)/options.cycles,
+			"peak_rss_mb":harness.peak_rss_mb(),"errors":len(errors)}
+
+def _difference(after,before):
+	return dict((kind,count-before.get(kind,0)) for (kind,count) in after.items() if count!=before.get(kind,0))
+
+def print_report(results):
+	print "%8s %8s %22s %10s %10s %10s %10s %10s %8s" % ("devices","accounts","requests/cycle","wall ms",
+			"max ms","cpu ms","updates","states","rss MB")
+	for result in results:
+		requests=result["requests_per_cycle"]
+		print "%8d %8d %22s %10.1f %10.1f %10.2f %10.1f %10.1f %8.1f%s" % (result["devices"],result["accounts"],
+				" ".join("%s=%g" % (kind,count) for (kind,count) in sorted(requests.items())) or "-",
+				result["wall_ms"],result["wall_max_ms"],result["cpu_ms"],result["update_calls_per_cycle"],
+				result["states_per_cycle"],result["peak_rss_mb"],
+				"  (%d errors)" % result["errors"] if result["errors"] else "")
+
+def main():
+	parser=optparse.OptionParser(usage="%prog [options]")
+	parser.add_option("--devices",default="1,10,50,100,200",help="comma separated thermostat counts to measure")
+	parser.add_option("--accounts",type="int",default=1,help="Nest.com accounts the thermostats are spread over")
+	parser.add_option("--cycles",type="int",default=10,help="poll cycles measured for each count")
+	parser.add_option("--latency",type="float",default=0.0,help="seconds the stand-in adds to every request")
+	parser.add_option("--padding",type="int",default=2048,help="extra bytes per shared bucket (the real ones are a few KB)")
+	parser.add_option("--churn",type="float",default=0.1,help="fraction of thermostats whose temperature changes each cycle")
+	parser.add_option("--seed",type="int",default=1)
+	parser.add_option("--json",dest="json_path",help="also write the results to this file")
+	parser.add_option("--single",action="store_true",help=optparse.SUPPRESS_HELP)
+	(options,args)=parser.parse_args()
+
+	if options.single:
+		options.devices=int(options.devices)
+		json.dump(run_size(options),sys.stdout)
+		return
+
+	results=[]
+	for devices in [int(count) for count in options.devices.split(",")]:
+		accounts=min(options.accounts,devices)
+		output=subprocess.check_output([sys.executable,os.path.abspath(__file__),"--single",
+				"--devices",str(devices),"--accounts",str(accounts),"--cycles",str(options.cycles),
+				"--latency",str(options.latency),"--padding",str(options.padding),
+				"--churn",str(options.churn),"--seed",str(options.seed)])
+		results.append(json.loads(output))
+	print_report(results)
+	if options.json_path:
+		with open(options.json_path,"w") as resultsFile:
+			json.dump(results,resultsFile,indent=2,sort_keys=True)
+
+if __name__=="__main__":
+	main()
@@ -0,0 +1,104 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Checks the plugin's subscribe (push update) mode against the Nest stand-in, e.g.
+#
+#	python benchmarks/subscribe_check.py --devices 4
+#
+# The plugin's main loop runs on its own thread with subscribe mode on, and the
+# stand-in answers subscriptions with no change after --hold seconds. Then:
+#
+#	1. A thermostat's temperature changes on the stand-in; its device state must
+#	   follow within --wake-within seconds, long before any safety poll is due.
+#	2. The stand-in stops answering subscriptions, holding them past the plugin's
+#	   subscription timeout (shortened to --client-timeout seconds). The plugin must
+#	   stop trusting the subscription: download the status again and poll the
+#	   devices at their normal intervals, or show them offline.
+#
+# The script exits with status 1 if either step fails.
+
+import sys
+import time
+import optparse
+import threading
+
+import fake_indigo
+import harness
+
+def wait_for(condition,timeout):
+	"""Returns True once condition() is true, or False after timeout seconds."""
+	deadline=time.time()+timeout
+	while time.time()<deadline:
+		if (condition()):
+			return True
+		time.sleep(0.05)
+	return condition()
+
+def run(options):
+	"""Runs both steps and returns a list of failures (empty if the plugin passed)."""
+	failures=[]
+	standin=harness.StandIn(options.devices,hold=options.hold)
+	try:
+		bench=harness.PluginHarness(standin,{"subscribeMode":True})
+		(module,plugin)=(bench.module,bench.plugin)
+		module.NEST_SUBSCRIBE_TIMEOUT=options.client_timeout
+		module.NEST_SUBSCRIBE_RETRY_WAIT=options.client_timeout
+		thread=threading.Thread(target=plugin.runConcurrentThread)
+		thread.daemon=True
+		thread.start()
+		try:
+			if (not wait_for(plugin._subscribersHealthy,options.client_timeout*3)):
+				failures.append("the subscription never succeeded")
+				return failures
+
+			# 1. A change reported by the subscription wakes the main loop
+			dev=fake_indigo.devices[min(fake_indigo.devices)]
+			before=dev.states.get(u"temperatureInput1")
+			started=time.time()
+			standin.change_temperatures({0:31.5})
+			if (wait_for(lambda: dev.states.get(u"temperatureInput1")!=before,options.wake_within)):
+				print "change shown %.2f s after it was made (temperature %s -> %s)" % (
+						time.time()-started,before,dev.states.get(u"temperatureInput1"))
+			else:
+				failures.append("the change wasn't shown within %.1f seconds" % options.wake_within)
+
+			# 2. A subscription Nest.com doesn't answer is a failure, not "nothing changed"
+			downloads=standin.counts().get("status",0)
+			standin.stall_subscriptions(options.client_timeout*4)
+			started=time.time()
+			fallback=lambda: not plugin._subscribersHealthy() and standin.counts().get("status",0)>downloads
+			if (wait_for(fallback,options.client_timeout*3)):
+				print "fell back to polling %.2f s after subscriptions stopped being answered" % (time.time()-started)
+			else:
+				failures.append("still trusting the subscription %.1f seconds after it stopped being answered" % (time.time()-started))
+			offline=[dev.name for dev in fake_indigo.devices.values() if dev.states.get(u"online") is False]
+			intervals=[plugin._pollInterval(dev,plugin._myNest[dev.pluginProps["address"]].snapshot(allow_stale=True),
+								plugin._myNest[dev.pluginProps["address"]]) for dev in fake_indigo.devices.values()
+						if dev.name not in offline]
+			if (any(interval>=module.NEST_SUBSCRIBE_POLL_INTERVAL for interval in intervals)):
+				failures.append("devices are still polled at the subscription's safety interval")
+			print "%d device(s) offline, poll intervals %s s" % (len(offline),", ".join("%.0f" % interval for interval in sorted(set(intervals))) or "-")
+		finally:
+			standin.stall_subscriptions(0)
+			plugin.stopConcurrentThread()
+			thread.join()
+			bench.stop()
+	finally:
+		standin.stop()
+	return failures
+
+def main():
+	parser=optparse.OptionParser(usage="%prog [options]")
+	parser.add_option("--devices",type="int",default=4,help="thermostats on the account")
+	parser.add_option("--hold",type="float",default=1,help="seconds the stand-in holds a subscription with no change")
+	parser.add_option("--client-timeout",type="float",default=3,help="the plugin's subscription timeout, in seconds")
+	parser.add_option("--wake-within",type="float",default=2,help="seconds a reported change may take to be shown")
+	(options,args)=parser.parse_args()
+
+	failures=run(options)
+	for failure in failures:
+		print "failed: %s" % failure
+	sys.exit(1 if failures else 0)
+
+if __name__=="__main__":
+	main()
@@ -0,0 +1,66 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Checks that the plugin's connection pool keeps its HTTPS connection to Nest.com
+# open, against the Nest stand-in serving HTTPS with a throwaway certificate, e.g.
+#
+#	python benchmarks/tls_check.py --reads 50 --writes 20
+#
+# One thermostat logs in, downloads its status --reads times (the cache is
+# emptied before each) and writes a setpoint --writes times, one request after
+# another. Every request goes to the same host, so the pool should open one
+# connection and do one TLS handshake for all of them; the script exits with
+# status 1 if the pool or the stand-in counted more.
+
+import sys
+import json
+import optparse
+
+import harness
+
+def run(options):
+	"""Makes the requests and returns the pool's and the stand-in's counters as a dictionary."""
+	standin=harness.StandIn(2,tls=True)
+	try:
+		module=harness.load_plugin(standin.login_url,standin.context)
+		nest=module.NestThermostat("bench0@example.com","secret","Nest 0","Home")
+		session=nest.get_session()
+		# The requests are sent back to back, far faster than the request budget allows
+		session._limiter=module.NestRateLimiter(rate=1e9,burst=1e9,reserve=0)
+		for read in range(options.reads):
+			session.invalidate()
+			session.refresh_status()
+		for write in range(options.writes):
+			session.post(nest._shared_url,json.dumps({"target_temperature":20.0+write*0.1}))
+		pool=module.NEST_CONNECTION_POOL.get_stats()
+		served=standin.counts()
+		# Asking for the counters is itself a request over a new connection
+		served["tls_handshakes"]-=1
+	finally:
+		standin.stop()
+	return {"pool":pool,"served":served}
+
+def main():
+	parser=optparse.OptionParser(usage="%prog [options]")
+	parser.add_option("--reads",type="int",default=50,help="status downloads to make")
+	parser.add_option("--writes",type="int",default=20,help="setpoint writes to make")
+	(options,args)=parser.parse_args()
+
+	result=run(options)
+	(pool,served)=(result["pool"],result["served"])
+	print "%d requests over HTTPS: %d reused a connection, %d handshake(s) by the pool, %d by the stand-in" % (
+			pool["requests"],pool["reused"],pool["handshakes"],served.get("tls_handshakes",0))
+	print "stand-in answered %s" % ", ".join("%s=%d" % (kind,count) for (kind,count) in sorted(served.items()))
+	failures=[]
+	if (pool["handshakes"]!=1 or served.get("tls_handshakes",0)!=1):
+		failures.append("expected a single TLS handshake")
+	if (served.get("status",0)<options.reads or served.get("put",0)!=options.writes):
+		failures.append("the stand-in didn't answer every request")
+	if (pool["errors"] or pool["retries"]):
+		failures.append("%d request(s) failed and %d were retried" % (pool["errors"],pool["retries"]))
+	for failure in failures:
+		print "failed: %s" % failure
+	sys.exit(1 if failures else 0)
+
+if __name__=="__main__":
+	main()